@@ -8,6 +8,7 @@ import tempfile
 import shutil
 import mimetypes
 import asyncio
+from contextlib import asynccontextmanager
 from urllib.parse import urlparse
 
 from fastapi import HTTPException, Depends
@@ -18,11 +19,14 @@ from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 from pydantic import EmailStr, Field
 from pydantic_settings import BaseSettings
 
+from .models import SendEmailRequest
+from .services import attachment_cache, http_client, metrics, mime_stream, smtp_pool, spool, tracing
+
 
 api_key_scheme = HTTPBearer(
     auto_error=False,
@@ -40,10 +44,52 @@ class Config(BaseSettings):
     account_smtp_port: int = Field(env="ACCOUNT_SMTP_PORT")
     account_imap_server: str = Field(env="ACCOUNT_IMAP_SERVER")
     account_imap_port: int = Field(env="ACCOUNT_IMAP_PORT")
+    account_imap_ssl: bool = Field(default=True, env="ACCOUNT_IMAP_SSL")
     from_name: str = Field(default="", env="FROM_NAME")
     attachment_concurrency: int = Field(default=3, env="ATTACHMENT_CONCURRENCY")
     start_tls: bool = Field(default=True, env="START_TLS")
     account_reply_to: EmailStr | None = Field(default=None, env="ACCOUNT_REPLY_TO")
+    imap_pool_size: int = Field(default=4, env="IMAP_POOL_SIZE")
+    imap_pool_idle_timeout: float = Field(default=300.0, env="IMAP_POOL_IDLE_TIMEOUT")
+    imap_pool_health_check_interval: float = Field(default=30.0, env="IMAP_POOL_HEALTH_CHECK_INTERVAL")
+    imap_timeout: float = Field(default=30.0, env="IMAP_TIMEOUT")
+    header_index_path: str | None = Field(default=None, env="HEADER_INDEX_PATH")
+    header_index_max_age: float = Field(default=30.0, env="HEADER_INDEX_MAX_AGE")
+    header_index_fulltext: bool = Field(default=False, env="HEADER_INDEX_FULLTEXT")
+    fulltext_max_message_bytes: int = Field(default=1024 * 1024, env="FULLTEXT_MAX_MESSAGE_BYTES")
+    folder_cache_ttl: float = Field(default=300.0, env="FOLDER_CACHE_TTL")
+    folder_status_ttl: float = Field(default=30.0, env="FOLDER_STATUS_TTL")
+    message_cache_max_bytes: int = Field(default=32 * 1024 * 1024, env="MESSAGE_CACHE_MAX_BYTES")
+    smtp_timeout: float = Field(default=60.0, env="SMTP_TIMEOUT")
+    smtp_pool_size: int = Field(default=2, env="SMTP_POOL_SIZE")
+    smtp_pool_max_lifetime: float = Field(default=300.0, env="SMTP_POOL_MAX_LIFETIME")
+    smtp_pool_max_messages: int = Field(default=100, env="SMTP_POOL_MAX_MESSAGES")
+    smtp_pool_idle_timeout: float = Field(default=60.0, env="SMTP_POOL_IDLE_TIMEOUT")
+    batch_concurrency: int = Field(default=4, env="BATCH_CONCURRENCY")
+    max_page_size: int = Field(default=100, env="MAX_PAGE_SIZE")
+    workers: int = Field(default=1, env="WORKERS")
+    outbox_workers: int = Field(default=2, env="OUTBOX_WORKERS")
+    outbox_max_attempts: int = Field(default=5, env="OUTBOX_MAX_ATTEMPTS")
+    outbox_backoff_base: float = Field(default=2.0, env="OUTBOX_BACKOFF_BASE")
+    outbox_backoff_max: float = Field(default=300.0, env="OUTBOX_BACKOFF_MAX")
+    outbox_queue_size: int = Field(default=1000, env="OUTBOX_QUEUE_SIZE")
+    outbox_poll_interval: float = Field(default=1.0, env="OUTBOX_POLL_INTERVAL")
+    http_pool_limit: int = Field(default=100, env="HTTP_POOL_LIMIT")
+    http_pool_limit_per_host: int = Field(default=10, env="HTTP_POOL_LIMIT_PER_HOST")
+    http_dns_cache_ttl: int = Field(default=300, env="HTTP_DNS_CACHE_TTL")
+    http_keepalive_timeout: float = Field(default=30.0, env="HTTP_KEEPALIVE_TIMEOUT")
+    attachment_cache_dir: str | None = Field(default=None, env="ATTACHMENT_CACHE_DIR")
+    attachment_cache_max_bytes: int = Field(default=256 * 1024 * 1024, env="ATTACHMENT_CACHE_MAX_BYTES")
+    attachment_cache_ttl: float = Field(default=3600.0, env="ATTACHMENT_CACHE_TTL")
+    spool_path: str | None = Field(default=None, env="SPOOL_PATH")
+    spool_lease_timeout: float = Field(default=300.0, env="SPOOL_LEASE_TIMEOUT")
+    spool_commit_interval: float = Field(default=0.002, env="SPOOL_COMMIT_INTERVAL")
+    spool_replay_interval: float = Field(default=30.0, env="SPOOL_REPLAY_INTERVAL")
+    watch_folders: str = Field(default="", env="WATCH_FOLDERS")
+    watch_idle_timeout: float = Field(default=300.0, env="WATCH_IDLE_TIMEOUT")
+    watch_poll_interval: float = Field(default=30.0, env="WATCH_POLL_INTERVAL")
+    slow_request_threshold: float = Field(default=2.0, env="SLOW_REQUEST_THRESHOLD")
+    server_timing: bool = Field(default=True, env="SERVER_TIMING")
 
 
 settings: Config | None = None
@@ -61,48 +107,202 @@ ALLOWED_FILE_TYPES = {
     ".rtf",
 }
 MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024  # 20MB
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentBudget:
+    """Running total of attachment bytes downloaded for one message."""
+
+    def __init__(self, limit: int = MAX_ATTACHMENT_SIZE) -> None:
+        self.limit = limit
+        self.used = 0
+
+    def check(self, size: int) -> None:
+        if self.used + size > self.limit:
+            raise HTTPException(status_code=413, detail="Total attachment size exceeds 20MB limit")
+
+    def add(self, size: int) -> None:
+        self.check(size)
+        self.used += size
 
 
-async def fetch_file(session, url, temp_dir) -> str:
+def check_attachment_url(url: str) -> str:
+    """Reject attachment URLs that could never be fetched; returns the file name."""
     parsed = urlparse(url)
     if parsed.scheme not in {"http", "https"}:
         raise HTTPException(status_code=400, detail="Invalid URL scheme")
 
-    filename = url.split("/")[-1]
+    filename = parsed.path.split("/")[-1]
     _, file_extension = os.path.splitext(filename)
 
     # Check if the file type is allowed
     if file_extension.lower() not in ALLOWED_FILE_TYPES:
         raise HTTPException(status_code=400, detail=f"File type {file_extension} is not allowed")
+    return filename
+
+
+def _log_url(url: str) -> str:
+    """Return ``url`` without credentials, query or fragment, for spans and logs.
+
+    Presigned attachment URLs carry their signature in the query string.
+    """
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    if parsed.port is not None:
+        host = f"{host}:{parsed.port}"
+    return f"{parsed.scheme}://{host}{parsed.path}"
+
+
+async def _download(response, file_path: str, filename: str, budget: Optional[AttachmentBudget]) -> None:
+    """Stream a 200 response body to ``file_path`` within the attachment limits."""
+    declared = response.content_length
+    if declared is not None:
+        if declared > MAX_ATTACHMENT_SIZE:
+            raise HTTPException(status_code=413, detail=f"Attachment {filename} exceeds the 20MB limit")
+        if budget is not None:
+            budget.check(declared)
+
+    file_size = 0
+    async with aiofiles.open(file_path, "wb") as out_file:
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            file_size += len(chunk)
+            if file_size > MAX_ATTACHMENT_SIZE:
+                raise HTTPException(status_code=413, detail=f"Attachment {filename} exceeds the 20MB limit")
+            if budget is not None:
+                budget.add(len(chunk))
+            await out_file.write(chunk)
+    metrics.DOWNLOAD_BYTES.observe(file_size)
+    tracing.annotate(bytes=file_size)
+
+
+def _check_download_status(response, url: str) -> None:
+    if response.status != 200:
+        print(f"Failed to download file from {_log_url(url)} with status {response.status}")
+        raise HTTPException(
+            status_code=response.status,
+            detail=f"Failed to download file from {_log_url(url)}",
+        )
+
+
+async def fetch_file(session, url, temp_dir, budget: Optional[AttachmentBudget] = None) -> str:
+    """Stream ``url`` into ``temp_dir`` and return the written path.
+
+    The download is refused up front when the declared Content-Length is too
+    large, and aborted as soon as the bytes received push the file or the
+    message's shared ``budget`` past the attachment limit.
+    """
+    filename = check_attachment_url(url)
 
     # Set timeout for requests
     timeout = aiohttp.ClientTimeout(total=10)
-    async with session.get(url, timeout=timeout) as response:
-        if response.status != 200:
-            print(f"Failed to download file from {url} with status {response.status}")
-            raise HTTPException(
-                status_code=response.status,
-                detail=f"Failed to download file from {url}",
-            )
-
-        file_path = os.path.join(temp_dir, filename)
+    with tracing.span("download", url=_log_url(url)), metrics.timed(metrics.DOWNLOAD_SECONDS, metrics.DOWNLOAD_ERRORS):
+        async with session.get(url, timeout=timeout) as response:
+            _check_download_status(response, url)
+            file_path = os.path.join(temp_dir, filename)
+            await _download(response, file_path, filename, budget)
+            return file_path
+
+
+async def _store_cached(
+    url: str, filename: str, file_path: str, temp_dir: str, **validators
+) -> attachment_cache.CachedAttachment | str:
+    """Add a download to the cache, or hand back the download itself if it could not be pinned."""
+    cached = await attachment_cache.cache.store(url, filename, file_path, temp_dir, **validators)
+    if cached is not None:
+        return cached
+    target = os.path.join(temp_dir, filename)
+    shutil.move(file_path, target)
+    return target
+
+
+async def fetch_cached(
+    session, url: str, temp_dir: str, budget: Optional[AttachmentBudget] = None
+) -> attachment_cache.CachedAttachment | str:
+    """Fetch ``url`` through the attachment cache.
+
+    Fresh entries are served without touching the network; stale ones are
+    revalidated with a conditional GET and refreshed on a 304. The encoded
+    payload is linked into ``temp_dir`` rather than read into memory. In
+    the rare case the payload cannot be pinned, the raw download in
+    ``temp_dir`` is returned instead, like :func:`fetch_file`.
+    """
+    filename = check_attachment_url(url)
+    cache = attachment_cache.cache
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with cache.lock(url):
+        entry = cache.get(url)
+        headers = {}
+        if entry is not None:
+            if budget is not None:
+                budget.check(entry.size)
+            if cache.is_fresh(entry):
+                cached = await cache.read(entry, temp_dir)
+                if cached is not None:
+                    if budget is not None:
+                        budget.add(cached.size)
+                    return cached
+            else:
+                headers = cache.validators(entry)
+
+        with (
+            tracing.span("download", url=_log_url(url), revalidate=bool(headers)),
+            metrics.timed(metrics.DOWNLOAD_SECONDS, metrics.DOWNLOAD_ERRORS),
+        ):
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                if response.status == 304 and entry is not None:
+                    await cache.touch(entry)
+                    cached = await cache.read(entry, temp_dir)
+                    if cached is not None:
+                        if budget is not None:
+                            budget.add(cached.size)
+                        return cached
+                    # The payload vanished; fall back to an unconditional download.
+                else:
+                    _check_download_status(response, url)
+                    download_dir = tempfile.mkdtemp()
+                    try:
+                        file_path = os.path.join(download_dir, filename)
+                        await _download(response, file_path, filename, budget)
+                        return await _store_cached(
+                            url,
+                            filename,
+                            file_path,
+                            temp_dir,
+                            etag=response.headers.get("ETag"),
+                            last_modified=response.headers.get("Last-Modified"),
+                        )
+                    finally:
+                        shutil.rmtree(download_dir)
 
-        async with aiofiles.open(file_path, "wb") as out_file:
-            content = await response.read()
-            await out_file.write(content)
+        download_dir = tempfile.mkdtemp()
+        try:
+            file_path = await fetch_file(session, url, download_dir, budget)
+            return await _store_cached(url, filename, file_path, temp_dir)
+        finally:
+            shutil.rmtree(download_dir)
 
-        return file_path
 
-async def send_email(
+async def fetch_all(fetch, urls: list[str]) -> list[str]:
+    """Run ``fetch`` for every URL, cancelling the rest as soon as one fails."""
+    tasks = [asyncio.create_task(fetch(url)) for url in urls]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+
+def _message_root(
     to_addresses: list[EmailStr],
     subject: str,
     body: str,
-    file_urls: Optional[list[str]] = None,
     headers: Optional[dict[str, str]] = None,
-) -> None:
-    if settings is None:
-        raise RuntimeError("Settings have not been initialized")
-
+) -> MIMEMultipart:
     msg = MIMEMultipart()
     msg["From"] = f"{settings.from_name} <{settings.account_email}>"
     msg["To"] = ", ".join(to_addresses)
@@ -115,72 +315,195 @@ async def send_email(
     if headers:
         for key, value in headers.items():
             msg[key] = value
+    return msg
 
-    # Handle file attachments
-    if file_urls:
-        total_size = 0
-        temp_dir = tempfile.mkdtemp()
-        semaphore = asyncio.Semaphore(settings.attachment_concurrency)
-        connector = aiohttp.TCPConnector(limit=settings.attachment_concurrency)
 
-        async def sem_fetch(url: str) -> str:
-            async with semaphore:
-                return await fetch_file(session, url, temp_dir)
+def _content_type(filename: str) -> tuple[str, str]:
+    mime_type, _ = mimetypes.guess_type(filename)
+    main_type, sub_type = (
+        mime_type.split("/") if mime_type else ("application", "octet-stream")
+    )
+    return main_type, sub_type
 
-        try:
-            async with aiohttp.ClientSession(connector=connector) as session:
-                file_paths = await asyncio.gather(*(sem_fetch(url) for url in file_urls))
 
-                for file_path in file_paths:
-                    file_size = os.path.getsize(file_path)
+async def _fetch_attachments(
+    file_urls: list[str], temp_dir: str
+) -> list[tuple[str, str | attachment_cache.CachedAttachment]]:
+    """Download every attachment, returning ``(filename, file path or cached payload)`` pairs."""
+    total_size = 0
+    semaphore = asyncio.Semaphore(settings.attachment_concurrency)
+    budget = AttachmentBudget()
 
-                    if file_size + total_size > MAX_ATTACHMENT_SIZE:
-                        raise HTTPException(
-                            status_code=413,
-                            detail="Total attachment size exceeds 20MB limit",
-                        )
+    async def sem_fetch(url: str) -> str | attachment_cache.CachedAttachment:
+        async with semaphore:
+            if attachment_cache.cache is not None:
+                return await fetch_cached(session, url, temp_dir, budget)
+            return await fetch_file(session, url, temp_dir, budget)
 
-                    if file_size > MAX_ATTACHMENT_SIZE:
-                        raise HTTPException(
-                            status_code=413,
-                            detail=f"Attachment {os.path.basename(file_path)} exceeds the 20MB limit",
-                        )
+    try:
+        with tracing.span("attachments", count=len(file_urls)):
+            async with http_client.client(settings) as session:
+                fetched = await fetch_all(sem_fetch, file_urls)
+    except HTTPException as e:
+        print(f"HTTPException during file handling: {e.detail}")
+        raise
+    except Exception as e:
+        print(f"Unexpected error during file handling: {str(e)}")
+        raise
 
-                    total_size += file_size
-                    mime_type, _ = mimetypes.guess_type(file_path)
-                    main_type, sub_type = (
-                        mime_type.split("/") if mime_type else ("application", "octet-stream")
-                    )
-                    part = MIMEBase(main_type, sub_type)
+    attachments = []
+    for item in fetched:
+        if isinstance(item, attachment_cache.CachedAttachment):
+            filename, file_size = item.filename, item.size
+        else:
+            filename, file_size = os.path.basename(item), os.path.getsize(item)
 
-                    async with aiofiles.open(file_path, "rb") as file:
+        if file_size + total_size > MAX_ATTACHMENT_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail="Total attachment size exceeds 20MB limit",
+            )
+
+        if file_size > MAX_ATTACHMENT_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Attachment {filename} exceeds the 20MB limit",
+            )
+
+        total_size += file_size
+        attachments.append((filename, item))
+    return attachments
+
+
+async def build_email(
+    to_addresses: list[EmailStr],
+    subject: str,
+    body: str,
+    file_urls: Optional[list[str]] = None,
+    headers: Optional[dict[str, str]] = None,
+) -> MIMEMultipart:
+    """Compose the outgoing message in memory, downloading and attaching any files."""
+    if settings is None:
+        raise RuntimeError("Settings have not been initialized")
+
+    # Handle file attachments
+    temp_dir = tempfile.mkdtemp() if file_urls else None
+    try:
+        attachments = await _fetch_attachments(file_urls, temp_dir) if file_urls else []
+        # Downloads are timed on their own; this covers assembly and encoding.
+        with tracing.span("mime"), metrics.timed(metrics.MIME_BUILD_SECONDS, None, "memory"):
+            msg = _message_root(to_addresses, subject, body, headers)
+            for filename, item in attachments:
+                part = MIMEBase(*_content_type(filename))
+
+                if isinstance(item, attachment_cache.CachedAttachment):
+                    # Cached payloads are already base64-encoded.
+                    async with aiofiles.open(item.path, "r") as file:
+                        part.set_payload(await file.read())
+                    part["Content-Transfer-Encoding"] = "base64"
+                else:
+                    async with aiofiles.open(item, "rb") as file:
                         file_data = await file.read()
                     part.set_payload(file_data)
-
                     encoders.encode_base64(part)
-                    part.add_header(
-                        "Content-Disposition",
-                        f"attachment; filename={os.path.basename(file_path)}",
-                    )
-                    msg.attach(part)
-        except HTTPException as e:
-            print(f"HTTPException during file handling: {e.detail}")
-            raise
-        except Exception as e:
-            print(f"Unexpected error during file handling: {str(e)}")
-            raise
-        finally:
+                part.add_header(
+                    "Content-Disposition",
+                    f"attachment; filename={filename}",
+                )
+                msg.attach(part)
+    finally:
+        if temp_dir is not None:
             shutil.rmtree(temp_dir)
 
+    return msg
+
+
+@asynccontextmanager
+async def compose_email(
+    to_addresses: list[EmailStr],
+    subject: str,
+    body: str,
+    file_urls: Optional[list[str]] = None,
+    headers: Optional[dict[str, str]] = None,
+) -> AsyncIterator[mime_stream.StreamingMessage]:
+    """Compose a message whose attachments stay on disk until it has been sent.
+
+    Unlike ``build_email`` nothing is encoded up front: the downloaded files
+    are base64-encoded chunk by chunk while the message is written to the
+    SMTP server, and deleted when the ``async with`` block exits.
+    """
+    if settings is None:
+        raise RuntimeError("Settings have not been initialized")
+
+    temp_dir = tempfile.mkdtemp()
     try:
-        await aiosmtplib.send(
+        attachments = await _fetch_attachments(file_urls, temp_dir) if file_urls else []
+        with tracing.span("mime"), metrics.timed(metrics.MIME_BUILD_SECONDS, None, "stream"):
+            message = mime_stream.StreamingMessage(_message_root(to_addresses, subject, body, headers))
+            for filename, item in attachments:
+                if isinstance(item, attachment_cache.CachedAttachment):
+                    message.attach_encoded(filename, *_content_type(filename), item.path)
+                else:
+                    message.attach_file(filename, *_content_type(filename), item)
+        yield message
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+async def smtp_send(msg: MIMEMultipart | mime_stream.StreamingMessage, journal: bool = True) -> str:
+    """Send a composed message and return the server's final reply.
+
+    SMTP errors propagate unchanged so callers can tell temporary failures
+    from permanent ones. With a spool configured the rendered message is
+    journaled first, so it is replayed if this process dies mid-send. A
+    failure is reported to the caller, so the entry is marked failed rather
+    than left for replay, which would deliver it twice if the caller
+    retries. Pass ``journal=False`` when the caller tracks the message in
+    the spool itself.
+    """
+    if settings is None:
+        raise RuntimeError("Settings have not been initialized")
+    store = spool.spool if journal else None
+    if store is None:
+        return await _transmit(msg)
+    entry_id = await store.add(msg)
+    try:
+        reply = await _transmit(msg)
+    except Exception as e:
+        await store.mark_failed(entry_id, str(e))
+        raise
+    await store.mark_sent(entry_id, reply)
+    return reply
+
+
+async def _transmit(msg: MIMEMultipart | mime_stream.StreamingMessage) -> str:
+    if isinstance(msg, mime_stream.StreamingMessage):
+        pool = smtp_pool.pool or smtp_pool.SMTPPool.from_settings(settings)
+        try:
+            _, reply = await pool.send_stream(msg)
+        finally:
+            if pool is not smtp_pool.pool:
+                await pool.close()
+    elif smtp_pool.pool is not None:
+        _, reply = await smtp_pool.pool.send(msg)
+    else:
+        _, reply = await aiosmtplib.send(
             msg,
             hostname=settings.account_smtp_server,
             port=settings.account_smtp_port,
             username=settings.account_email,
             password=settings.account_password,
             start_tls=settings.start_tls,
+            timeout=settings.smtp_timeout,
         )
+    return reply
+
+
+async def deliver_email(msg: MIMEMultipart | mime_stream.StreamingMessage) -> str:
+    """Hand a composed message to the SMTP server."""
+    try:
+        with tracing.span("smtp"):
+            return await smtp_send(msg)
     except aiosmtplib.errors.SMTPException as e:
         print(f"SMTPException: {str(e)}")
         raise HTTPException(status_code=500, detail=f"SMTP server error: {str(e)}")
@@ -188,6 +511,58 @@ async def send_email(
         print(f"Unexpected error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+
+async def send_email(
+    to_addresses: list[EmailStr],
+    subject: str,
+    body: str,
+    file_urls: Optional[list[str]] = None,
+    headers: Optional[dict[str, str]] = None,
+) -> None:
+    with tracing.span("send_email", attachments=len(file_urls or [])):
+        async with compose_email(to_addresses, subject, body, file_urls=file_urls, headers=headers) as msg:
+            await deliver_email(msg)
+
+
+async def send_batch(requests: list[SendEmailRequest]) -> list[Optional[Exception]]:
+    """Build and send many messages over a few shared SMTP sessions.
+
+    Returns one entry per request: ``None`` once sent, otherwise the
+    exception that stopped it. Each message is built, and journaled, by
+    the pool worker about to send it, so only one message per session is
+    held in memory however large the batch. Failed messages are reported
+    to the caller and marked failed in the spool, never replayed. Without
+    a running pool a temporary one is used for the batch.
+    """
+    if settings is None:
+        raise RuntimeError("Settings have not been initialized")
+    if not requests:
+        return []
+    journal = spool.spool
+    entry_ids: dict[int, str] = {}
+
+    async def prepare(index: int, request: SendEmailRequest) -> MIMEMultipart:
+        file_urls = [str(url) for url in request.file_url] if request.file_url else None
+        msg = await build_email(request.to_addresses, request.subject, request.body, file_urls=file_urls)
+        if journal:
+            entry_ids[index] = await journal.add(msg)
+        return msg
+
+    pool = smtp_pool.pool or smtp_pool.SMTPPool.from_settings(settings)
+    try:
+        results = await pool.send_many(requests, concurrency=settings.batch_concurrency, prepare=prepare)
+    finally:
+        if pool is not smtp_pool.pool:
+            await pool.close()
+    if journal:
+        await asyncio.gather(
+            *(
+                journal.mark_sent(entry_id, "") if results[i] is None else journal.mark_failed(entry_id, str(results[i]))
+                for i, entry_id in entry_ids.items()
+            )
+        )
+    return results
+
 async def get_api_key(
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(api_key_scheme),
 ) -> Optional[str]:
@@ -1,9 +1,26 @@
 # main,py
 import os
 import aiofiles
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import JSONResponse, Response
 
 from . import dependencies
+from .services import (
+    attachment_cache,
+    folder_cache,
+    header_index,
+    http_client,
+    imap_client,
+    imap_pool,
+    mail_watcher,
+    message_cache,
+    metrics,
+    outbox,
+    smtp_pool,
+    spool,
+    tracing,
+)
 from .routes.send_email import send_router
 from .routes.read_email import read_router
 
@@ -26,6 +43,8 @@ app = FastAPI(
         }
     ]
 )
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(tracing.TimingMiddleware)
 
 
 @app.on_event("startup")
@@ -36,12 +55,87 @@ async def startup_event() -> None:
             dependencies.signature_text = await file.read()
     except FileNotFoundError:
         dependencies.signature_text = ""
+    tracing.slow_request_threshold = dependencies.settings.slow_request_threshold
+    tracing.server_timing = dependencies.settings.server_timing
+    imap_pool.pool = imap_pool.IMAPPool.from_settings(dependencies.settings)
+    await imap_pool.pool.start()
+    smtp_pool.pool = smtp_pool.SMTPPool.from_settings(dependencies.settings)
+    await smtp_pool.pool.start()
+    http_client.session = http_client.create_session(dependencies.settings)
+    if dependencies.settings.attachment_cache_dir:
+        attachment_cache.cache = attachment_cache.AttachmentCache.from_settings(dependencies.settings)
+    if dependencies.settings.header_index_path:
+        header_index.index = header_index.HeaderIndex.from_settings(dependencies.settings)
+    folder_cache.cache = folder_cache.FolderCache.from_settings(dependencies.settings)
+    folder_cache.cache.start()
+    if dependencies.settings.message_cache_max_bytes > 0:
+        message_cache.cache = message_cache.MessageCache.from_settings(dependencies.settings)
+        message_cache.cache.start()
+    if dependencies.settings.watch_folders:
+        mail_watcher.watcher = mail_watcher.MailWatcher.from_settings(dependencies.settings)
+        await mail_watcher.watcher.start()
+    if dependencies.settings.spool_path:
+        spool.spool = spool.Spool.from_settings(dependencies.settings)
+        await spool.spool.start()
+    if dependencies.settings.outbox_workers > 0:
+        if dependencies.settings.workers > 1 and spool.spool is None:
+            # Without the spool job status lives in this process, so
+            # GET /jobs/{id} would miss whenever another worker served it.
+            print("Asynchronous sending is disabled: it needs WORKERS=1 or SPOOL_PATH")
+        else:
+            outbox.outbox = outbox.Outbox.from_settings(dependencies.settings, spool.spool)
+            await outbox.outbox.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    if outbox.outbox is not None:
+        await outbox.outbox.stop()
+        outbox.outbox = None
+    if spool.spool is not None:
+        await spool.spool.close()
+        spool.spool = None
+    if mail_watcher.watcher is not None:
+        await mail_watcher.watcher.stop()
+        mail_watcher.watcher = None
+    await imap_client.stop_body_index()
+    if imap_pool.pool is not None:
+        await imap_pool.pool.close()
+        imap_pool.pool = None
+    if smtp_pool.pool is not None:
+        await smtp_pool.pool.close()
+        smtp_pool.pool = None
+    if header_index.index is not None:
+        header_index.index.close()
+        header_index.index = None
+    if folder_cache.cache is not None:
+        folder_cache.cache.stop()
+        folder_cache.cache = None
+    if message_cache.cache is not None:
+        message_cache.cache.stop()
+        message_cache.cache = None
+    if http_client.session is not None:
+        await http_client.session.close()
+        http_client.session = None
+    attachment_cache.cache = None
+    metrics.mark_process_dead()
 
 
 # Include routers for feature modules
 app.include_router(send_router)
 app.include_router(read_router)
 
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(dependencies.get_api_key)])
+async def metrics_endpoint() -> Response:
+    """Prometheus scrape target, summed across workers in multiprocess mode.
+
+    Like every other route it needs the API key when ``API_KEY`` is set;
+    scrapers send it as a bearer token.
+    """
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
+
 def custom_openapi() -> dict:
     if app.openapi_schema:
         return app.openapi_schema
@@ -1,10 +1,15 @@
 # flake8: noqa
 # models.py
-from datetime import datetime
-from typing import Optional
+import re
+from datetime import date, datetime
+from typing import Literal, Optional
 
 from pydantic import BaseModel, EmailStr, Field, HttpUrl, field_validator
 
+# A system flag such as \Seen or a keyword atom.
+FLAG_RE = re.compile(r"^\\?[^\s()\]{}%*\"\\]+$")
+
+
 class SendEmailRequest(BaseModel):
     to_addresses: list[EmailStr] = Field(
         ...,
@@ -40,6 +45,109 @@ class SendEmailRequest(BaseModel):
         raise TypeError("file_url must be a string or list of URLs")
 
 
+class BatchSendRequest(BaseModel):
+    messages: list[SendEmailRequest] = Field(
+        ...,
+        description="Emails to send in one batch.",
+        min_length=1,
+        max_length=1000,
+    )
+
+
+class BatchItemResult(BaseModel):
+    index: int = Field(..., description="Position of the email in the request.")
+    status: Literal["sent", "failed"]
+    status_code: int = Field(..., description="HTTP-style status for this email.")
+    error: str | None = None
+
+
+class BatchSendResponse(BaseModel):
+    sent: int
+    failed: int
+    results: list[BatchItemResult]
+
+
+class JobStatus(BaseModel):
+    id: str = Field(..., description="Identifier of the queued send job.")
+    status: Literal["queued", "sending", "retrying", "sent", "failed"]
+    attempts: int = Field(..., description="Delivery attempts made so far.")
+    created_at: datetime
+    updated_at: datetime
+    next_attempt_at: datetime | None = Field(None, description="When a retrying job will next be attempted.")
+    last_error: str | None = None
+    smtp_response: str | None = Field(None, description="Final reply from the SMTP server once sent.")
+
+
+# Largest number of UIDs one bulk move or delete may name once ranges are expanded.
+MAX_BULK_UIDS = 50000
+
+
+class BulkRequest(BaseModel):
+    uids: list[int] = Field(
+        ...,
+        description="UIDs to act on, as numbers or ranges such as `\"100:250\"`.",
+        min_length=1,
+    )
+
+    @field_validator("uids", mode="before")
+    @classmethod
+    def expand_ranges(cls, value: list[int | str]) -> list[int]:
+        if not isinstance(value, list):
+            raise TypeError("uids must be a list")
+        uids: list[int] = []
+        for item in value:
+            start, _, end = str(item).strip().partition(":")
+            if not start.isdigit() or (end and not end.isdigit()):
+                raise ValueError(f"invalid UID or range: {item}")
+            low, high = sorted((int(start), int(end or start)))
+            if low < 1:
+                raise ValueError("UIDs start at 1")
+            if high - low + 1 + len(uids) > MAX_BULK_UIDS:
+                raise ValueError(f"at most {MAX_BULK_UIDS} UIDs per request")
+            uids.extend(range(low, high + 1))
+        return uids
+
+
+class BulkMoveRequest(BulkRequest):
+    folder: str = Field(..., description="Destination folder.", min_length=1)
+    source_folder: str = Field("INBOX", description="Folder containing the emails.", min_length=1)
+
+
+class BulkDeleteRequest(BulkRequest):
+    folder: str = Field("INBOX", description="Folder containing the emails.", min_length=1)
+
+
+class SearchRequest(BaseModel):
+    folder: str = Field("INBOX", description="Folder to search.", min_length=1)
+    from_: str | None = Field(None, alias="from", description="Text in the From header.")
+    to: str | None = Field(None, description="Text in the To header.")
+    cc: str | None = Field(None, description="Text in the Cc header.")
+    subject: str | None = Field(None, description="Text in the Subject header.")
+    body: str | None = Field(None, description="Text in the message body.")
+    text: str | None = Field(None, description="Text anywhere in the headers or body.")
+    since: date | None = Field(None, description="Only messages received on or after this date.")
+    before: date | None = Field(None, description="Only messages received before this date.")
+    flags: list[str] = Field(default_factory=list, description="Flags or keywords the messages must have, such as `\\Flagged`.")
+    without_flags: list[str] = Field(default_factory=list, description="Flags or keywords the messages must not have, such as `\\Seen`.")
+    larger: int | None = Field(None, ge=0, description="Only messages larger than this many bytes.")
+    smaller: int | None = Field(None, ge=1, description="Only messages smaller than this many bytes.")
+    header: dict[str, str] | None = Field(None, description="Header names mapped to text they must contain.")
+    limit: int = Field(10, ge=1, description="Maximum number of emails to return, capped by the server.")
+    sort: Literal["arrival", "date", "from", "size"] = Field("arrival", description="Sort order of the results.")
+    cursor: str | None = Field(None, description="Cursor from the X-Next-Cursor header of the previous page.")
+
+    class Config:
+        populate_by_name = True
+
+    @field_validator("flags", "without_flags")
+    @classmethod
+    def check_flags(cls, value: list[str]) -> list[str]:
+        for flag in value:
+            if not FLAG_RE.match(flag):
+                raise ValueError(f"invalid flag: {flag}")
+        return value
+
+
 class EmailSummary(BaseModel):
     uid: str = Field(..., min_length=1)
     subject: str | None = None
@@ -48,9 +156,23 @@ class EmailSummary(BaseModel):
     seen: bool
 
     class Config:
-        allow_population_by_field_name = True
+        populate_by_name = True
         json_encoders = {datetime: lambda v: v.isoformat()}
 
 
+class FolderInfo(BaseModel):
+    name: str
+    delimiter: str | None = None
+    flags: list[str] = Field(default_factory=list)
+    messages: int | None = Field(None, description="Number of messages in the folder.")
+    unseen: int | None = Field(None, description="Number of messages without the \\Seen flag.")
+    uidnext: int | None = Field(None, description="UID the next message delivered to the folder will get.")
+
+
+class FulltextHit(EmailSummary):
+    folder: str
+    score: float = Field(..., description="Relevance; higher is better.")
+
+
 class MessageResponse(BaseModel):
     message: str = Field(..., min_length=1)
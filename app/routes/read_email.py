@@ -1,46 +1,174 @@
 # flake8: noqa
+import dataclasses
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from typing import AsyncIterator, Literal
 
-from fastapi import APIRouter, Depends, HTTPException, Query, Path
+from fastapi import APIRouter, Depends, HTTPException, Query, Path, Request, Response
+from fastapi.responses import StreamingResponse
 
 from ..dependencies import get_api_key, send_email
-from ..models import SendEmailRequest, EmailSummary, MessageResponse
-from ..services import imap_client
+from ..models import (
+    BulkDeleteRequest,
+    BulkMoveRequest,
+    EmailSummary,
+    FolderInfo,
+    FulltextHit,
+    MessageResponse,
+    SearchRequest,
+    SendEmailRequest,
+)
+from ..services import folder_cache, header_index, imap_client
 from .. import dependencies
 
 read_router = APIRouter(tags=["Read"])
 
+NDJSON = "application/x-ndjson"
+
+
+async def _ndjson_lines(stream: AsyncIterator) -> AsyncIterator[bytes]:
+    async for summary in stream:
+        yield summary.model_dump_json(by_alias=True).encode() + b"\n"
+
+
+def _folder_changed(folder: str) -> None:
+    """Drop cached counts for a folder that just received messages."""
+    if folder_cache.cache is not None:
+        folder_cache.cache.invalidate(folder)
+
+
+def _check_uid(uid: str) -> None:
+    """Reject path UIDs that are not plain numbers before they reach an IMAP command."""
+    if not (uid.isascii() and uid.isdigit()):
+        raise HTTPException(status_code=400, detail="UID must be a number")
+
+
+def _threading_headers(original: imap_client.ReplyContext) -> dict[str, str]:
+    headers = {}
+    if original.message_id:
+        headers["In-Reply-To"] = original.message_id
+        references = (original.references or "").split()
+        headers["References"] = " ".join(references + [original.message_id])
+    return headers
+
 
 @read_router.get(
     "/emails",
     response_model=list[EmailSummary],
     dependencies=[Depends(get_api_key)],
     summary="Fetch emails",
-    description="Return emails from the specified folder.",
+    description=(
+        "Return one page of emails from the specified folder. When more emails are available, "
+        "the `X-Next-Cursor` response header holds the cursor for the next page. Send "
+        "`Accept: application/x-ndjson` to stream one JSON summary per line as it is fetched."
+    ),
     operation_id="fetch_emails",
     responses={
+        200: {"content": {NDJSON: {}}},
         400: {"description": "Invalid request"},
         404: {"description": "Emails not found"},
         500: {"description": "Server error"},
     },
 )
 async def get_emails(
-    limit: int = Query(10, description="Maximum number of emails to return"),
+    request: Request,
+    response: Response,
+    limit: int = Query(10, ge=1, description="Maximum number of emails to return, capped by the server"),
     unread: bool = Query(False, description="Only fetch unread emails"),
     folder: str = Query("INBOX", description="Mail folder to read from"),
+    sort: Literal["arrival", "date", "from", "size"] = Query("arrival", description="Sort order of the listing"),
+    cursor: str | None = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
 ) -> list[EmailSummary]:
+    if NDJSON in request.headers.get("accept", ""):
+        stream = imap_client.stream_page(folder, limit, unread, sort, cursor)
+        try:
+            head = await anext(stream)
+        except (imap_client.InvalidCursor, imap_client.UnsupportedSort) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        headers = {"X-Next-Cursor": head.next_cursor} if head.next_cursor else None
+        return StreamingResponse(_ndjson_lines(stream), media_type=NDJSON, headers=headers)
     try:
-        return await imap_client.fetch_messages(folder, limit, unread)
+        page = await imap_client.fetch_page(folder, limit, unread, sort, cursor)
+    except (imap_client.InvalidCursor, imap_client.UnsupportedSort) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    return page.messages
+
+
+@read_router.post(
+    "/emails/search",
+    response_model=list[EmailSummary],
+    dependencies=[Depends(get_api_key)],
+    summary="Search emails",
+    description=(
+        "Return one page of emails in a folder matching every given criterion. The criteria "
+        "are compiled into a single IMAP `UID SEARCH`, so filtering happens on the mail "
+        "server. When more matches are available, the `X-Next-Cursor` response header holds "
+        "the cursor for the next page."
+    ),
+    operation_id="search_emails",
+    responses={
+        400: {"description": "Invalid request"},
+        500: {"description": "Server error"},
+    },
+)
+async def search_emails(request: SearchRequest, response: Response) -> list[EmailSummary]:
+    try:
+        criteria = imap_client.search_criteria(request)
+        page = await imap_client.search_page(criteria, request.folder, request.limit, request.sort, request.cursor)
+    except (imap_client.InvalidCursor, imap_client.UnsupportedSort) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    return page.messages
+
+
+@read_router.get(
+    "/emails/fulltext",
+    response_model=list[FulltextHit],
+    dependencies=[Depends(get_api_key)],
+    summary="Full-text search",
+    description=(
+        "Rank messages whose subject, sender, or plain-text body contain every word of `q`, "
+        "using the local full-text index instead of the IMAP server. Requires "
+        "`HEADER_INDEX_PATH` and `HEADER_INDEX_FULLTEXT`. Bodies are added in the background "
+        "after each folder sync, so the newest messages may at first match on subject and sender only."
+    ),
+    operation_id="fulltext_search",
+    responses={
+        400: {"description": "Invalid request"},
+        503: {"description": "Full-text index not enabled"},
+    },
+)
+async def fulltext_search(
+    q: str = Query(..., min_length=1, description="Words to search for"),
+    folder: str | None = Query(None, description="Only search this folder"),
+    limit: int = Query(10, ge=1, le=100, description="Maximum number of results"),
+) -> list[FulltextHit]:
+    index = header_index.index
+    if index is None or not index.fulltext:
+        raise HTTPException(status_code=503, detail="Full-text index is not enabled")
+    hits = await index.search(q, folder, limit)
+    return [FulltextHit(folder=hit.folder, score=hit.score, **hit.summary.model_dump()) for hit in hits]
 
 
 @read_router.get(
     "/folders",
     dependencies=[Depends(get_api_key)],
     summary="List mail folders",
-    description="List available mail folders.",
+    description=(
+        "List available mail folders. With `status=true` each folder is returned with its "
+        "`messages`, `unseen` and `uidnext` counts. Results are cached; `refresh=true` "
+        "re-reads them from the server."
+    ),
+    response_model=list[str] | list[FolderInfo],
     operation_id="list_folders",
     responses={
         400: {"description": "Invalid request"},
@@ -48,9 +176,65 @@ async def get_emails(
         500: {"description": "Server error"},
     },
 )
-async def get_folders() -> list[str]:
+async def get_folders(
+    status: bool = Query(False, description="Include per-folder message counts"),
+    refresh: bool = Query(False, description="Bypass the folder cache"),
+) -> list[str] | list[FolderInfo]:
+    try:
+        if folder_cache.cache is not None:
+            folders = await folder_cache.cache.folders(with_status=status, refresh=refresh)
+        else:
+            folders = await imap_client.list_folders(with_status=status)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not status:
+        return [folder.name for folder in folders]
+    return [FolderInfo(**dataclasses.asdict(folder)) for folder in folders]
+
+
+@read_router.post(
+    "/emails/move",
+    dependencies=[Depends(get_api_key)],
+    summary="Move emails in bulk",
+    description=(
+        "Move a list of UIDs or UID ranges to another folder, using one `UID MOVE` per "
+        "batch when the server supports it."
+    ),
+    response_model=MessageResponse,
+    operation_id="move_emails",
+    responses={
+        400: {"description": "Invalid request"},
+        500: {"description": "Server error"},
+    },
+)
+async def move_emails(request: BulkMoveRequest) -> MessageResponse:
+    try:
+        count = await imap_client.move_messages(request.uids, request.folder, request.source_folder)
+        _folder_changed(request.folder)
+        return MessageResponse(message=f"{count} emails moved")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@read_router.post(
+    "/emails/delete",
+    dependencies=[Depends(get_api_key)],
+    summary="Delete emails in bulk",
+    description=(
+        "Delete a list of UIDs or UID ranges from a folder. Only the named messages are "
+        "expunged when the server supports UIDPLUS."
+    ),
+    response_model=MessageResponse,
+    operation_id="delete_emails",
+    responses={
+        400: {"description": "Invalid request"},
+        500: {"description": "Server error"},
+    },
+)
+async def delete_emails(request: BulkDeleteRequest) -> MessageResponse:
     try:
-        return await imap_client.list_mailboxes()
+        count = await imap_client.delete_messages(request.uids, request.folder)
+        return MessageResponse(message=f"{count} emails deleted")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -73,8 +257,10 @@ async def move_email(
     folder: str = Query(..., description="Destination folder"),
     source_folder: str = Query("INBOX", description="Source folder"),
 ) -> MessageResponse:
+    _check_uid(uid)
     try:
         await imap_client.move_message(uid, folder, source_folder)
+        _folder_changed(folder)
         return MessageResponse(message="Email moved")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -97,15 +283,12 @@ async def forward_email(
     uid: str = Path(..., description="UID of the email to forward"),
     request: SendEmailRequest = ...,
 ) -> MessageResponse:
+    _check_uid(uid)
     try:
-        original = await imap_client.fetch_message(uid)
-        body = imap_client.extract_body(original)
-        subject = request.subject or imap_client.decode_header_value(original.get("Subject", ""))
-        msg_id = original.get("Message-ID")
-        headers = {}
-        if msg_id:
-            headers["In-Reply-To"] = msg_id
-            headers["References"] = msg_id
+        original = await imap_client.fetch_reply_context(uid)
+        body = original.body
+        subject = request.subject or imap_client.decode_header_value(original.subject)
+        headers = _threading_headers(original)
         file_urls = [str(url) for url in request.file_url] if request.file_url else None
         await send_email(
             request.to_addresses, subject, body, file_urls=file_urls, headers=headers
@@ -134,16 +317,13 @@ async def reply_email(
     uid: str = Path(..., description="UID of the email to reply to"),
     request: SendEmailRequest = ...,
 ) -> MessageResponse:
+    _check_uid(uid)
     try:
-        original = await imap_client.fetch_message(uid)
-        body = request.body or imap_client.extract_body(original)
-        subj = imap_client.decode_header_value(original.get("Subject", ""))
+        original = await imap_client.fetch_reply_context(uid)
+        body = request.body or original.body
+        subj = imap_client.decode_header_value(original.subject)
         subject = request.subject or f"Re: {subj}"
-        msg_id = original.get("Message-ID")
-        headers = {}
-        if msg_id:
-            headers["In-Reply-To"] = msg_id
-            headers["References"] = msg_id
+        headers = _threading_headers(original)
         file_urls = [str(url) for url in request.file_url] if request.file_url else None
         await send_email(
             request.to_addresses, subject, body, file_urls=file_urls, headers=headers
@@ -172,6 +352,7 @@ async def delete_email(
     uid: str = Path(..., description="UID of the email to delete"),
     folder: str = Query("INBOX", description="Folder containing the email"),
 ) -> MessageResponse:
+    _check_uid(uid)
     try:
         await imap_client.delete_message(uid, folder)
         return MessageResponse(message="Email deleted")
@@ -202,6 +383,7 @@ async def create_draft(request: SendEmailRequest) -> MessageResponse:
     msg.attach(MIMEText(request.body, "html"))
     try:
         await imap_client.append_message("Drafts", msg)
+        _folder_changed("Drafts")
         return MessageResponse(message="Draft stored")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,24 +1,73 @@
-from fastapi import APIRouter, Depends, HTTPException
-from ..models import SendEmailRequest, MessageResponse
-from ..dependencies import send_email, get_api_key
+from datetime import datetime, timezone
+
+import aiosmtplib
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from ..models import BatchItemResult, BatchSendRequest, BatchSendResponse, JobStatus, SendEmailRequest, MessageResponse
+from ..dependencies import check_attachment_url, send_batch, send_email, get_api_key
+from ..services import outbox
 
 send_router = APIRouter(tags=["Send"])
 
 
+def _timestamp(value: float | None) -> datetime | None:
+    return datetime.fromtimestamp(value, tz=timezone.utc) if value is not None else None
+
+
+def _job_status(job: outbox.Job) -> JobStatus:
+    return JobStatus(
+        id=job.id,
+        status=job.status,
+        attempts=job.attempts,
+        created_at=_timestamp(job.created_at),
+        updated_at=_timestamp(job.updated_at),
+        next_attempt_at=_timestamp(job.next_attempt_at),
+        last_error=job.last_error,
+        smtp_response=job.smtp_response,
+    )
+
+
+async def _enqueue(request: SendEmailRequest, response: Response) -> JobStatus:
+    if outbox.outbox is None:
+        raise HTTPException(status_code=503, detail="Asynchronous sending is disabled")
+    for url in request.file_url or []:
+        check_attachment_url(str(url))
+    try:
+        job = await outbox.outbox.submit(request)
+    except outbox.OutboxFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    response.status_code = 202
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return _job_status(job)
+
+
 @send_router.post(
     "/",
     operation_id="send_email",
     dependencies=[Depends(get_api_key)],
     summary="Send an email",
-    description="Send an email to one or more recipients.",
+    description=(
+        "Send an email to one or more recipients. With `async=true` (or a "
+        "`Prefer: respond-async` header) the email is queued for background "
+        "delivery and a 202 response with the job status is returned instead."
+    ),
     status_code=201,
-    response_model=MessageResponse,
+    response_model=MessageResponse | JobStatus,
     responses={
+        202: {"description": "Email queued for delivery", "model": JobStatus},
         400: {"description": "Invalid request"},
         500: {"description": "Server error"},
+        503: {"description": "Outbound queue unavailable or full"},
     },
 )
-async def send_email_endpoint(request: SendEmailRequest) -> MessageResponse:
+async def send_email_endpoint(
+    request: SendEmailRequest,
+    response: Response,
+    send_async: bool = Query(False, alias="async", description="Queue the email and return immediately."),
+    prefer: str | None = Header(None),
+) -> MessageResponse | JobStatus:
+    if send_async or (prefer and "respond-async" in prefer.lower()):
+        return await _enqueue(request, response)
+
     subject = request.subject
     body = request.body
     file_urls = (
@@ -36,3 +85,55 @@ async def send_email_endpoint(request: SendEmailRequest) -> MessageResponse:
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@send_router.get(
+    "/jobs/{job_id}",
+    operation_id="get_send_job",
+    dependencies=[Depends(get_api_key)],
+    summary="Get the status of a queued email",
+    description="Report the status, delivery attempts, and final SMTP response of an email sent asynchronously.",
+    response_model=JobStatus,
+    responses={404: {"description": "Job not found"}},
+)
+async def get_job_endpoint(job_id: str) -> JobStatus:
+    job = await outbox.outbox.get(job_id) if outbox.outbox is not None else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_status(job)
+
+
+def _batch_result(index: int, error: Exception | None) -> BatchItemResult:
+    if error is None:
+        return BatchItemResult(index=index, status="sent", status_code=201)
+    if isinstance(error, HTTPException):
+        return BatchItemResult(index=index, status="failed", status_code=error.status_code, error=str(error.detail))
+    if isinstance(error, aiosmtplib.SMTPException):
+        return BatchItemResult(index=index, status="failed", status_code=500, error=f"SMTP server error: {str(error)}")
+    return BatchItemResult(index=index, status="failed", status_code=500, error=str(error))
+
+
+@send_router.post(
+    "/batch",
+    operation_id="send_email_batch",
+    dependencies=[Depends(get_api_key)],
+    summary="Send a batch of emails",
+    description=(
+        "Send many emails over a few shared SMTP sessions. The response reports the "
+        "outcome of every email, so a partial failure does not fail the whole batch."
+    ),
+    response_model=BatchSendResponse,
+    responses={
+        400: {"description": "Invalid request"},
+        500: {"description": "Server error"},
+    },
+)
+async def send_batch_endpoint(request: BatchSendRequest) -> BatchSendResponse:
+    try:
+        errors = await send_batch(request.messages)
+    except Exception as e:
+        print(f"Unexpected error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    results = [_batch_result(index, error) for index, error in enumerate(errors)]
+    sent = sum(result.status == "sent" for result in results)
+    return BatchSendResponse(sent=sent, failed=len(results) - sent, results=results)
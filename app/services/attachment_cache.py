@@ -0,0 +1,274 @@
+# flake8: noqa
+import asyncio
+import base64
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Iterator, Optional
+
+
+@dataclass
+class CacheEntry:
+    """Metadata for one cached attachment, stored next to its payload."""
+
+    url: str
+    filename: str
+    size: int
+    encoded_size: int
+    fetched_at: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+# Raw bytes encoded per block when storing, a multiple of 57 so every
+# block encodes to whole 76-character lines.
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+# Temporary files older than this were left by a crashed writer.
+STALE_TEMP_AGE = 3600.0
+
+
+@dataclass
+class CachedAttachment:
+    """An attachment ready to be placed in a MIME part.
+
+    ``path`` holds the base64-encoded payload, linked outside the cache so
+    eviction cannot remove it while the message is being sent.
+    """
+
+    filename: str
+    size: int
+    path: str
+
+
+class AttachmentCache:
+    """Size-bounded on-disk LRU cache of downloaded attachments keyed by URL.
+
+    Payloads are kept base64-encoded, exactly as they go into the MIME part,
+    so a hit costs neither a download nor an encode. Entries younger than
+    ``ttl`` are served as-is; older ones are revalidated with the stored
+    ``ETag`` / ``Last-Modified`` validators. The least recently used entries
+    are evicted once the payloads exceed ``max_bytes``.
+
+    Every uvicorn worker shares the directory, so the on-disk metadata is
+    the index: recency is the metadata file's modification time, entries
+    stored by another worker are picked up on a miss, and eviction rescans
+    the directory under an ``fcntl`` lock so ``max_bytes`` holds across all
+    workers.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024, ttl: float = 3600.0) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self.total_bytes = 0
+        self._load()
+
+    @classmethod
+    def from_settings(cls, settings) -> "AttachmentCache":
+        return cls(
+            settings.attachment_cache_dir,
+            max_bytes=settings.attachment_cache_max_bytes,
+            ttl=settings.attachment_cache_ttl,
+        )
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _path(self, url: str, suffix: str) -> str:
+        return os.path.join(self.directory, self.key(url) + suffix)
+
+    def _temp(self, path: str) -> str:
+        """A temporary name next to ``path`` that no other writer, in any worker, can share."""
+        return f"{path}.{secrets.token_hex(8)}.tmp"
+
+    @contextlib.contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """Hold the directory-wide lock shared by every worker using the cache."""
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_meta(self, path: str) -> Optional[CacheEntry]:
+        try:
+            with open(path, "r") as file:
+                entry = CacheEntry(**json.load(file))
+        except (OSError, ValueError, TypeError):
+            return None
+        return entry if os.path.exists(self._path(entry.url, ".b64")) else None
+
+    def _scan(self) -> tuple[OrderedDict, int]:
+        """Read the index from the metadata files on disk, least recently used first."""
+        found = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                with contextlib.suppress(OSError):
+                    if now - os.path.getmtime(path) > STALE_TEMP_AGE:
+                        os.remove(path)
+                continue
+            if not name.endswith(".json"):
+                continue
+            entry = self._read_meta(path)
+            if entry is not None:
+                with contextlib.suppress(OSError):
+                    found.append((os.path.getmtime(path), entry))
+        entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        for _, entry in sorted(found, key=lambda item: item[0]):
+            entries[entry.url] = entry
+        return entries, sum(entry.encoded_size for entry in entries.values())
+
+    def _load(self) -> None:
+        self._entries, self.total_bytes = self._scan()
+
+    def lock(self, url: str) -> asyncio.Lock:
+        """Lock serialising concurrent fetches of the same URL."""
+        return self._locks.setdefault(url, asyncio.Lock())
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(url)
+        if entry is None:
+            # Possibly stored by another worker since this one last scanned.
+            entry = self._read_meta(self._path(url, ".json"))
+            if entry is None:
+                return None
+            self._entries[url] = entry
+            self.total_bytes += entry.encoded_size
+        self._entries.move_to_end(url)
+        # Recency lives on disk so eviction in any worker sees it.
+        with contextlib.suppress(OSError):
+            os.utime(self._path(url, ".json"))
+        return entry
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.fetched_at < self.ttl
+
+    def validators(self, entry: CacheEntry) -> dict[str, str]:
+        """Conditional request headers for revalidating ``entry``."""
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def _write_meta(self, entry: CacheEntry) -> None:
+        path = self._path(entry.url, ".json")
+        temp = self._temp(path)
+        with open(temp, "w") as file:
+            json.dump(asdict(entry), file)
+        os.replace(temp, path)
+
+    async def touch(self, entry: CacheEntry) -> None:
+        """Mark ``entry`` as freshly validated."""
+        entry.fetched_at = time.time()
+        await asyncio.to_thread(self._write_meta, entry)
+
+    def _link(self, url: str, source: str, directory: str) -> Optional[str]:
+        """Hard-link ``source`` into ``directory``, copying across file systems."""
+        target = os.path.join(directory, f"{self.key(url)}-{secrets.token_hex(4)}.b64")
+        try:
+            os.link(source, target)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            # Another file system, or no hard links.
+            try:
+                shutil.copyfile(source, target)
+            except FileNotFoundError:
+                return None
+        return target
+
+    def _pin(self, url: str, directory: str) -> Optional[str]:
+        return self._link(url, self._path(url, ".b64"), directory)
+
+    async def read(self, entry: CacheEntry, directory: str) -> Optional[CachedAttachment]:
+        """Pin the cached payload into ``directory``, or return ``None`` if it has vanished from disk."""
+        path = await asyncio.to_thread(self._pin, entry.url, directory)
+        if path is None:
+            self._forget(entry.url)
+            return None
+        return CachedAttachment(entry.filename, entry.size, path)
+
+    async def store(
+        self,
+        url: str,
+        filename: str,
+        source: str,
+        directory: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> Optional[CachedAttachment]:
+        """Encode the downloaded file at ``source`` into the cache, one block at a time.
+
+        The payload is pinned into ``directory`` like :meth:`read` does,
+        before it is published, so another worker's eviction cannot remove
+        it first. Returns ``None`` if it could not be pinned; ``source`` is
+        left in place for the caller to send instead.
+        """
+
+        def write() -> tuple[CacheEntry, Optional[str]]:
+            path = self._path(url, ".b64")
+            temp = self._temp(path)
+            size = encoded_size = 0
+            try:
+                with open(source, "rb") as raw, open(temp, "wb") as out:
+                    while data := raw.read(ENCODE_CHUNK_SIZE):
+                        encoded = base64.encodebytes(data)
+                        out.write(encoded)
+                        size += len(data)
+                        encoded_size += len(encoded)
+                pinned = self._link(url, temp, directory)
+                os.replace(temp, path)
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp)
+            entry = CacheEntry(url, filename, size, encoded_size, time.time(), etag, last_modified)
+            self._write_meta(entry)
+            return entry, pinned
+
+        entry, pinned = await asyncio.to_thread(write)
+        self._entries, self.total_bytes = await asyncio.to_thread(self._evict)
+        if pinned is None:
+            return None
+        return CachedAttachment(entry.filename, entry.size, pinned)
+
+    def _forget(self, url: str) -> None:
+        entry = self._entries.pop(url, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.encoded_size
+        self._remove(url)
+
+    def _remove(self, url: str) -> None:
+        for suffix in (".b64", ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(url, suffix))
+
+    def _evict(self) -> tuple[OrderedDict, int]:
+        """Evict the least recently used entries of every worker, returning the index left on disk."""
+        with self._exclusive():
+            entries, total = self._scan()
+            while total > self.max_bytes and len(entries) > 1:
+                _, entry = entries.popitem(last=False)
+                total -= entry.encoded_size
+                self._remove(entry.url)
+        return entries, total
+
+
+cache: AttachmentCache | None = None
@@ -0,0 +1,60 @@
+# flake8: noqa
+import asyncio
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+
+@dataclass
+class MailEvent:
+    """A change observed in a mail folder.
+
+    ``kind`` is one of the raw IMAP notifications (``exists``, ``expunge``,
+    ``fetch``, ``vanished``) or a change derived while syncing the header
+    index (``new``, ``expunged``, ``flags``).
+    """
+
+    folder: str
+    kind: str
+    uids: list[int] = field(default_factory=list)
+    uidvalidity: Optional[int] = None
+    number: Optional[int] = None
+
+
+class EventBus:
+    """In-process fan-out of :class:`MailEvent` objects.
+
+    Subscribers get their own bounded queue; when a slow subscriber's queue
+    is full its oldest event is dropped rather than blocking publishers.
+    Listeners are plain callables invoked synchronously on publish.
+    """
+
+    def __init__(self, queue_size: int = 1000) -> None:
+        self.queue_size = queue_size
+        self._queues: set[asyncio.Queue] = set()
+        self._listeners: list[Callable[[MailEvent], None]] = []
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self._queues.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._queues.discard(queue)
+
+    def add_listener(self, listener: Callable[[MailEvent], None]) -> None:
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[MailEvent], None]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def publish(self, event: MailEvent) -> None:
+        for listener in list(self._listeners):
+            listener(event)
+        for queue in self._queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+bus = EventBus()
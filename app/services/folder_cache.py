@@ -0,0 +1,78 @@
+# flake8: noqa
+import asyncio
+import copy
+import time
+from typing import Optional
+
+from . import events, imap_client
+from .imap_client import Folder
+
+
+class FolderCache:
+    """Folder tree and per-folder counters kept between requests.
+
+    The tree from LIST is reused for ``ttl`` seconds and counters for
+    ``status_ttl`` seconds. Mail events from the watcher or from this
+    process drop the counters of the folder they concern, and
+    ``invalidate`` without a folder forgets the whole tree. Concurrent
+    callers share one refresh instead of each querying the server.
+    """
+
+    def __init__(self, ttl: float = 300.0, status_ttl: float = 30.0) -> None:
+        self.ttl = ttl
+        self.status_ttl = status_ttl
+        self._folders: Optional[list[Folder]] = None
+        self._listed_at = 0.0
+        self._status_at: dict[str, float] = {}
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_settings(cls, settings) -> "FolderCache":
+        return cls(ttl=settings.folder_cache_ttl, status_ttl=settings.folder_status_ttl)
+
+    def start(self) -> None:
+        events.bus.add_listener(self.on_event)
+
+    def stop(self) -> None:
+        events.bus.remove_listener(self.on_event)
+
+    def on_event(self, event: events.MailEvent) -> None:
+        self.invalidate(event.folder)
+
+    def invalidate(self, folder: Optional[str] = None) -> None:
+        """Forget ``folder``'s counters, or the whole tree when no folder is given."""
+        if folder is None:
+            self._folders = None
+            self._status_at.clear()
+        else:
+            self._status_at.pop(folder, None)
+
+    def _stale(self, now: float) -> list[Folder]:
+        return [
+            folder
+            for folder in self._folders or []
+            if folder.selectable and now - self._status_at.get(folder.name, float("-inf")) >= self.status_ttl
+        ]
+
+    async def folders(self, with_status: bool = False, refresh: bool = False) -> list[Folder]:
+        """Return the folder tree, refreshing whatever is missing or expired."""
+        async with self._lock:
+            now = time.monotonic()
+            if refresh or self._folders is None or now - self._listed_at >= self.ttl:
+                folders = await imap_client.list_folders(with_status)
+                self._folders, self._listed_at = folders, now
+                self._status_at = {folder.name: now for folder in folders if with_status and folder.selectable}
+            elif with_status:
+                stale = self._stale(now)
+                if stale:
+                    fresh = await imap_client.folder_status([folder.name for folder in stale])
+                    for folder in stale:
+                        counted = fresh.get(folder.name)
+                        if counted is not None:
+                            folder.messages, folder.unseen, folder.uidnext = counted.messages, counted.unseen, counted.uidnext
+                            self._status_at[folder.name] = now
+            # Callers get copies so they never see counters change under them.
+            return copy.deepcopy(self._folders)
+
+
+cache: FolderCache | None = None
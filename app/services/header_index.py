@@ -0,0 +1,388 @@
+# flake8: noqa
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional
+
+from ..models import EmailSummary
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    uidvalidity INTEGER NOT NULL,
+    uidnext INTEGER NOT NULL,
+    highestmodseq INTEGER,
+    synced_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    subject TEXT,
+    from_addr TEXT,
+    date TEXT,
+    seen INTEGER NOT NULL,
+    size INTEGER,
+    modseq INTEGER,
+    PRIMARY KEY (folder, uidvalidity, uid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_unseen ON messages (folder, uidvalidity, seen, uid);
+"""
+
+# Full-text documents: ``fulltext_docs`` maps each message to the rowid of
+# its row in the FTS5 table so expunges can delete it directly.
+FULLTEXT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fulltext_docs (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    UNIQUE (folder, uidvalidity, uid)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5(
+    subject, from_addr, body, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+# bm25 weights for the subject, from and body columns.
+FULLTEXT_WEIGHTS = (3.0, 2.0, 1.0)
+
+# SQL expressions ordering listings for each supported sort.
+SORT_COLUMNS = {
+    "arrival": "uid",
+    "date": "COALESCE(julianday(date), 0)",
+    "from": "COALESCE(LOWER(from_addr), '')",
+    "size": "COALESCE(size, 0)",
+}
+
+
+@dataclass
+class FolderState:
+    """Server state the index was last synchronised against."""
+
+    folder: str
+    uidvalidity: int
+    uidnext: int
+    highestmodseq: Optional[int]
+    synced_at: float
+
+
+@dataclass
+class FulltextHit:
+    folder: str
+    summary: EmailSummary
+    score: float
+
+
+@dataclass
+class IndexedMessage:
+    summary: EmailSummary
+    size: Optional[int] = None
+    modseq: Optional[int] = None
+
+
+class HeaderIndex:
+    """On-disk SQLite index of message summaries keyed by (folder, UIDVALIDITY, UID).
+
+    All access goes through one connection guarded by a lock and runs in a
+    worker thread so disk I/O never blocks the event loop. With ``fulltext``
+    the subject, sender and plain-text body of each message are also kept
+    in an FTS5 table that follows the same expunges and resets.
+    """
+
+    def __init__(self, path: str, max_age: float = 0.0, fulltext: bool = False) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.fulltext = fulltext
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        if fulltext:
+            self._db.executescript(FULLTEXT_SCHEMA)
+        self._lock = threading.Lock()
+        self._sync_locks: dict[str, asyncio.Lock] = {}
+        # Folders a watcher keeps current in real time; these never go stale.
+        self.live_folders: set[str] = set()
+
+    @classmethod
+    def from_settings(cls, settings) -> "HeaderIndex":
+        return cls(
+            settings.header_index_path,
+            max_age=settings.header_index_max_age,
+            fulltext=settings.header_index_fulltext,
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def sync_lock(self, folder: str) -> asyncio.Lock:
+        """Lock serialising concurrent syncs of the same folder."""
+        return self._sync_locks.setdefault(folder, asyncio.Lock())
+
+    async def _call(self, func, *args):
+        def locked():
+            with self._lock:
+                return func(*args)
+
+        return await asyncio.to_thread(locked)
+
+    async def folder_state(self, folder: str) -> Optional[FolderState]:
+        def query() -> Optional[FolderState]:
+            row = self._db.execute(
+                "SELECT folder, uidvalidity, uidnext, highestmodseq, synced_at FROM folders WHERE folder = ?",
+                (folder,),
+            ).fetchone()
+            return FolderState(*row) if row else None
+
+        return await self._call(query)
+
+    def is_fresh(self, folder: str, state: Optional[FolderState]) -> bool:
+        if state is None:
+            return False
+        return folder in self.live_folders or time.time() - state.synced_at < self.max_age
+
+    async def reset_folder(self, folder: str) -> None:
+        """Forget every row for ``folder``, e.g. after a UIDVALIDITY change."""
+
+        def reset() -> None:
+            with self._db:
+                self._db.execute("DELETE FROM messages WHERE folder = ?", (folder,))
+                self._db.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+                if self.fulltext:
+                    self._db.execute(
+                        "DELETE FROM fulltext WHERE rowid IN (SELECT id FROM fulltext_docs WHERE folder = ?)", (folder,)
+                    )
+                    self._db.execute("DELETE FROM fulltext_docs WHERE folder = ?", (folder,))
+
+        await self._call(reset)
+
+    async def save_state(self, folder: str, uidvalidity: int, uidnext: int, highestmodseq: Optional[int]) -> None:
+        def save() -> None:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO folders (folder, uidvalidity, uidnext, highestmodseq, synced_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (folder, uidvalidity, uidnext, highestmodseq, time.time()),
+                )
+
+        await self._call(save)
+
+    async def upsert(self, folder: str, uidvalidity: int, messages: Iterable[IndexedMessage]) -> None:
+        rows = [
+            (
+                folder,
+                uidvalidity,
+                int(message.summary.uid),
+                message.summary.subject,
+                message.summary.from_,
+                message.summary.date.isoformat() if message.summary.date else None,
+                int(message.summary.seen),
+                message.size,
+                message.modseq,
+            )
+            for message in messages
+        ]
+
+        def insert() -> None:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO messages "
+                    "(folder, uidvalidity, uid, subject, from_addr, date, seen, size, modseq) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+
+        await self._call(insert)
+
+    async def update_flags(self, folder: str, uidvalidity: int, flags: Iterable[tuple[int, bool, Optional[int]]]) -> None:
+        rows = [(int(seen), modseq, folder, uidvalidity, uid) for uid, seen, modseq in flags]
+
+        def update() -> None:
+            with self._db:
+                self._db.executemany(
+                    "UPDATE messages SET seen = ?, modseq = COALESCE(?, modseq) "
+                    "WHERE folder = ? AND uidvalidity = ? AND uid = ?",
+                    rows,
+                )
+
+        await self._call(update)
+
+    async def delete_uids(self, folder: str, uidvalidity: int, uids: Iterable[int]) -> None:
+        rows = [(folder, uidvalidity, int(uid)) for uid in uids]
+
+        def delete() -> None:
+            with self._db:
+                self._db.executemany(
+                    "DELETE FROM messages WHERE folder = ? AND uidvalidity = ? AND uid = ?",
+                    rows,
+                )
+                if self.fulltext:
+                    self._db.executemany(
+                        "DELETE FROM fulltext WHERE rowid = "
+                        "(SELECT id FROM fulltext_docs WHERE folder = ? AND uidvalidity = ? AND uid = ?)",
+                        rows,
+                    )
+                    self._db.executemany(
+                        "DELETE FROM fulltext_docs WHERE folder = ? AND uidvalidity = ? AND uid = ?",
+                        rows,
+                    )
+
+        await self._call(delete)
+
+    async def uids(self, folder: str, uidvalidity: int) -> list[int]:
+        def query() -> list[int]:
+            cursor = self._db.execute(
+                "SELECT uid FROM messages WHERE folder = ? AND uidvalidity = ? ORDER BY uid",
+                (folder, uidvalidity),
+            )
+            return [row[0] for row in cursor]
+
+        return await self._call(query)
+
+    async def count(self, folder: str, uidvalidity: int) -> int:
+        def query() -> int:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM messages WHERE folder = ? AND uidvalidity = ?",
+                (folder, uidvalidity),
+            ).fetchone()[0]
+
+        return await self._call(query)
+
+    async def unindexed(self, folder: str, uidvalidity: int, limit: int) -> list[tuple[int, Optional[int]]]:
+        """Return ``(uid, size)`` of up to ``limit`` messages missing from the full-text index, newest first."""
+
+        def query() -> list[tuple[int, Optional[int]]]:
+            return self._db.execute(
+                "SELECT uid, size FROM messages m WHERE folder = ? AND uidvalidity = ? AND NOT EXISTS "
+                "(SELECT 1 FROM fulltext_docs d WHERE d.folder = m.folder AND d.uidvalidity = m.uidvalidity "
+                "AND d.uid = m.uid) ORDER BY uid DESC LIMIT ?",
+                (folder, uidvalidity, limit),
+            ).fetchall()
+
+        return await self._call(query)
+
+    async def add_bodies(self, folder: str, uidvalidity: int, bodies: Iterable[tuple[int, str]]) -> None:
+        """Index ``(uid, body)`` pairs together with the stored subject and sender."""
+        rows = [(folder, uidvalidity, int(uid), body) for uid, body in bodies]
+
+        def insert() -> None:
+            with self._db:
+                for folder_, uidvalidity_, uid, body in rows:
+                    header = self._db.execute(
+                        "SELECT subject, from_addr FROM messages WHERE folder = ? AND uidvalidity = ? AND uid = ?",
+                        (folder_, uidvalidity_, uid),
+                    ).fetchone()
+                    if header is None:
+                        continue
+                    cursor = self._db.execute(
+                        "INSERT OR IGNORE INTO fulltext_docs (folder, uidvalidity, uid) VALUES (?, ?, ?)",
+                        (folder_, uidvalidity_, uid),
+                    )
+                    if cursor.rowcount:
+                        self._db.execute(
+                            "INSERT INTO fulltext (rowid, subject, from_addr, body) VALUES (?, ?, ?, ?)",
+                            (cursor.lastrowid, header[0] or "", header[1] or "", body),
+                        )
+
+        await self._call(insert)
+
+    async def search(self, text: str, folder: Optional[str] = None, limit: int = 10) -> list[FulltextHit]:
+        """Return the best ``limit`` matches for ``text``, best first.
+
+        Every whitespace-separated term must appear; terms are matched as
+        literal tokens, so FTS5 query syntax in ``text`` has no effect. Only
+        messages from each folder's current UIDVALIDITY are returned.
+        """
+        terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+        if not terms:
+            return []
+
+        def query() -> list[FulltextHit]:
+            sql = (
+                "SELECT d.folder, m.uid, m.subject, m.from_addr, m.date, m.seen, bm25(fulltext, ?, ?, ?) AS rank "
+                "FROM fulltext JOIN fulltext_docs d ON d.id = fulltext.rowid "
+                "JOIN folders f ON f.folder = d.folder AND f.uidvalidity = d.uidvalidity "
+                "JOIN messages m ON m.folder = d.folder AND m.uidvalidity = d.uidvalidity AND m.uid = d.uid "
+                "WHERE fulltext MATCH ?"
+            )
+            params: list = [*FULLTEXT_WEIGHTS, " ".join(terms)]
+            if folder is not None:
+                sql += " AND d.folder = ?"
+                params.append(folder)
+            sql += " ORDER BY rank LIMIT ?"
+            params.append(limit)
+            return [
+                FulltextHit(
+                    folder_,
+                    EmailSummary(
+                        uid=str(uid),
+                        subject=subject,
+                        from_=from_addr,
+                        date=datetime.fromisoformat(date) if date else None,
+                        seen=bool(seen),
+                    ),
+                    -rank,
+                )
+                for folder_, uid, subject, from_addr, date, seen, rank in self._db.execute(sql, params)
+            ]
+
+        return await self._call(query)
+
+    async def query(
+        self,
+        folder: str,
+        limit: int = 10,
+        unread_only: bool = False,
+        sort: str = "arrival",
+        before: Optional[tuple] = None,
+    ) -> list[tuple[EmailSummary, object]]:
+        """Return the last ``limit`` summaries in ascending ``sort`` order.
+
+        ``before`` is the ``(key, uid)`` of the first row of the previous
+        page; only rows ordered before it are returned. Each summary comes
+        paired with its sort key so callers can build the next cursor.
+        """
+        column = SORT_COLUMNS[sort]
+
+        def query() -> list[tuple[EmailSummary, object]]:
+            sql = (
+                f"SELECT uid, subject, from_addr, date, seen, {column} FROM messages "
+                "WHERE folder = ? AND uidvalidity = (SELECT uidvalidity FROM folders WHERE folder = ?)"
+            )
+            params: list = [folder, folder]
+            if unread_only:
+                sql += " AND seen = 0"
+            if before is not None:
+                sql += f" AND ({column}, uid) < (?, ?)"
+                params.extend(before)
+            sql += f" ORDER BY {column} DESC, uid DESC"
+            if limit:
+                sql += " LIMIT ?"
+                params.append(limit)
+            rows = self._db.execute(sql, params).fetchall()
+            return [
+                (
+                    EmailSummary(
+                        uid=str(uid),
+                        subject=subject,
+                        from_=from_addr,
+                        date=datetime.fromisoformat(date) if date else None,
+                        seen=bool(seen),
+                    ),
+                    key,
+                )
+                for uid, subject, from_addr, date, seen, key in reversed(rows)
+            ]
+
+        return await self._call(query)
+
+index: HeaderIndex | None = None
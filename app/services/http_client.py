@@ -0,0 +1,34 @@
+# flake8: noqa
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiohttp
+
+
+def create_session(settings) -> aiohttp.ClientSession:
+    """Build the keep-alive session used for every attachment download.
+
+    Connections to the same host are reused across requests, bounded by
+    ``HTTP_POOL_LIMIT`` overall and ``HTTP_POOL_LIMIT_PER_HOST`` per host,
+    and DNS answers are cached for ``HTTP_DNS_CACHE_TTL`` seconds.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=settings.http_pool_limit,
+        limit_per_host=settings.http_pool_limit_per_host,
+        ttl_dns_cache=settings.http_dns_cache_ttl,
+        keepalive_timeout=settings.http_keepalive_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+@asynccontextmanager
+async def client(settings) -> AsyncIterator[aiohttp.ClientSession]:
+    """Yield the shared session, or a temporary one when the app has not started it."""
+    if session is not None and not session.closed:
+        yield session
+        return
+    async with create_session(settings) as temporary:
+        yield temporary
+
+
+session: aiohttp.ClientSession | None = None
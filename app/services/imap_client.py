@@ -1,15 +1,131 @@
 # flake8: noqa
 import asyncio
+import base64
+import binascii
+import contextvars
+import hashlib
 import imaplib
+import itertools
 import email
+import json
+import quopri
 import time
-import re
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import parsedate_to_datetime
+from typing import AsyncIterator
 
 from .. import dependencies
-from ..models import EmailSummary
+from ..models import EmailSummary, SearchRequest
+from . import events, header_index, imap_pool, message_cache, tracing
+from .header_index import HeaderIndex, IndexedMessage
+from .imap_protocol import IMAPConnection, IMAPError, Literal, fetch_items, parse_uid_set, quote
+
+# Headers for at most this many messages are requested per FETCH while indexing.
+SYNC_BATCH_SIZE = 500
+
+# Page cap applied when settings have not been loaded.
+MAX_PAGE_SIZE = 100
+
+# Messages whose bodies are fetched per FETCH, and at most how many are
+# added to the full-text index per backfill, so a large backlog fills in
+# over several runs instead of holding a session for one long one.
+FULLTEXT_BATCH_SIZE = 50
+FULLTEXT_SYNC_LIMIT = 1000
+
+# Larger text parts are not downloaded for the full-text index; the
+# message's subject and sender are still indexed.
+FULLTEXT_MAX_MESSAGE_BYTES = 1024 * 1024
+
+# UIDs per MOVE/STORE command in bulk operations, keeping command lines short
+# even when the UIDs are scattered.
+BULK_BATCH_SIZE = 1000
+
+# Items fetched to build an EmailSummary. ENVELOPE carries Subject, From and
+# Date pre-parsed by the server in a fraction of the bytes of the full header.
+SUMMARY_ITEMS = "UID FLAGS INTERNALDATE ENVELOPE"
+
+# Counters requested for each folder by LIST-STATUS or STATUS.
+STATUS_ITEMS = "(MESSAGES UNSEEN UIDNEXT)"
+
+# Listing sort orders mapped to their IMAP SORT keys (RFC 5256). Arrival
+# order follows UIDs and never needs SORT.
+SORT_KEYS = {"arrival": None, "date": "DATE", "from": "FROM", "size": "SIZE"}
+
+# Full UID SORT results kept per folder, order and criteria, so paging
+# through a listing on a server without CONTEXT=SORT sorts it once.
+SORT_CACHE_SIZE = 32
+SORT_CACHE_TTL = 60.0
+
+# Search keys for the system flags, as (set, not set).
+SYSTEM_FLAGS = {
+    "\\SEEN": ("SEEN", "UNSEEN"),
+    "\\ANSWERED": ("ANSWERED", "UNANSWERED"),
+    "\\FLAGGED": ("FLAGGED", "UNFLAGGED"),
+    "\\DELETED": ("DELETED", "UNDELETED"),
+    "\\DRAFT": ("DRAFT", "UNDRAFT"),
+}
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# Original headers a reply or forward needs for its subject and threading.
+REPLY_HEADERS = "SUBJECT MESSAGE-ID REFERENCES"
+
+
+_sort_cache: OrderedDict[tuple, tuple[tuple, float, list[int]]] = OrderedDict()
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor is malformed or no longer applies."""
+
+
+@dataclass
+class PageCursor:
+    """Position in a listing, handed to clients as an opaque token.
+
+    ``uid`` and ``key`` identify the first message of the page already
+    returned; ``offset`` is only used when that message has disappeared
+    from a server-side SORT result. ``query`` fingerprints the criteria
+    of a search so its cursor cannot be replayed against another one.
+    """
+
+    sort: str
+    unread: bool
+    uid: int
+    uidvalidity: int | None = None
+    key: object = None
+    offset: int = 0
+    query: str | None = None
+
+    def encode(self) -> str:
+        data = [self.sort, self.unread, self.uid, self.uidvalidity, self.key, self.offset]
+        if self.query is not None:
+            data.append(self.query)
+        raw = json.dumps(data, separators=(",", ":")).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, token: str) -> "PageCursor":
+        try:
+            cursor = cls(*json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))))
+        except (TypeError, ValueError) as exc:
+            raise InvalidCursor("Invalid cursor") from exc
+        if cursor.sort not in SORT_KEYS or not isinstance(cursor.uid, int) or not isinstance(cursor.offset, int):
+            raise InvalidCursor("Invalid cursor")
+        # The key is bound into the index query, which only accepts scalars.
+        if cursor.key is not None and not isinstance(cursor.key, (str, int)):
+            raise InvalidCursor("Invalid cursor")
+        return cursor
+
+
+@dataclass
+class MessagePage:
+    messages: list[EmailSummary]
+    next_cursor: str | None = None
 
 
 def _decode_header(value: str) -> str:
@@ -44,144 +160,1026 @@ def extract_body(msg: email.message.Message) -> str:
     return _extract_body(msg)
 
 
-async def list_mailboxes() -> list[str]:
-    """Return a list of mailbox names."""
+async def _run(func, folder: str | None = None, retry: bool = True):
+    """Run ``func`` on a pooled session, or a one-off session without a pool.
 
-    def inner() -> list[str]:
+    The call is traced as a span named after the helper that defined
+    ``func`` (``fetch_message``, ``fetch_page``...).
+    """
+    with tracing.span(func.__qualname__.split(".")[0], folder=folder):
+        if imap_pool.pool is not None:
+            return await imap_pool.pool.run(func, folder=folder, retry=retry)
         if dependencies.settings is None:
             raise RuntimeError("Settings have not been initialized")
-        with imaplib.IMAP4_SSL(
-            dependencies.settings.account_imap_server,
-            dependencies.settings.account_imap_port,
-        ) as imap:
-            imap.login(dependencies.settings.account_email, dependencies.settings.account_password)
-            typ, data = imap.list()
-            if typ != "OK" or data is None:
-                return []
-            mailboxes: list[str] = []
-            for mbox in data:
-                line = mbox.decode()
-                match = re.search(r'"((?:\\"|[^"])*)"$', line)
-                if match:
-                    name = match.group(1).replace('\\"', '"')
-                else:
-                    name = line.split()[-1]
-                mailboxes.append(name)
-            return mailboxes
-
-    return await asyncio.to_thread(inner)
+        conn = await imap_pool.open_connection(**imap_pool.connection_kwargs(dependencies.settings))
+        try:
+            return await imap_pool._call(conn, func, folder)
+        finally:
+            await conn.logout()
+
+
+@asynccontextmanager
+async def _session(folder: str | None = None) -> AsyncIterator[IMAPConnection]:
+    """Hold one session, pooled when possible, for the whole ``async with`` block."""
+    if imap_pool.pool is not None:
+        async with imap_pool.pool.connection() as conn:
+            if folder is not None:
+                await conn.select(folder)
+            yield conn
+        return
+    if dependencies.settings is None:
+        raise RuntimeError("Settings have not been initialized")
+    conn = await imap_pool.open_connection(**imap_pool.connection_kwargs(dependencies.settings))
+    try:
+        if folder is not None:
+            await conn.select(folder)
+        yield conn
+    finally:
+        await conn.logout()
+
+
+def _as_bytes(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return (value or "").encode("utf-8")
+
+
+def _as_str(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value or ""
+
+
+@dataclass
+class Folder:
+    """A mailbox from LIST, with its STATUS counters when requested."""
+
+    name: str
+    delimiter: str | None = None
+    flags: list[str] = field(default_factory=list)
+    messages: int | None = None
+    unseen: int | None = None
+    uidnext: int | None = None
+
+    @property
+    def selectable(self) -> bool:
+        return not {"\\NOSELECT", "\\NONEXISTENT"} & {flag.upper() for flag in self.flags}
+
+
+def _parse_list(item) -> Folder | None:
+    # Each LIST reply is (flags) delimiter name.
+    if len(item.data) < 3:
+        return None
+    flags = item.data[0] if isinstance(item.data[0], list) else []
+    delimiter = item.data[1]
+    return Folder(
+        _as_str(item.data[2]),
+        _as_str(delimiter) if delimiter is not None else None,
+        [_as_str(flag) for flag in flags],
+    )
+
+
+def _apply_status(folders: dict[str, Folder], response) -> None:
+    for item in response.of_kind("STATUS"):
+        if len(item.data) < 2 or not isinstance(item.data[1], list):
+            continue
+        folder = folders.get(_as_str(item.data[0]))
+        if folder is None:
+            continue
+        values = item.data[1]
+        counters = {str(values[i]).upper(): values[i + 1] for i in range(0, len(values) - 1, 2)}
+        for key in ("MESSAGES", "UNSEEN", "UIDNEXT"):
+            if str(counters.get(key, "")).isdigit():
+                setattr(folder, key.lower(), int(counters[key]))
+
+
+async def _status(conn: IMAPConnection, folders: list[Folder]) -> None:
+    """Fill in counters with STATUS commands pipelined over ``conn``."""
+    by_name = {folder.name: folder for folder in folders if folder.selectable}
+    inline, separate = [], []
+    for name in by_name:
+        (separate if isinstance(quote(name), Literal) and not conn.has_capability("LITERAL+") else inline).append(name)
+    for response in await conn.pipeline([("STATUS", quote(name), STATUS_ITEMS) for name in inline]):
+        _apply_status(by_name, response)
+    for name in separate:
+        _apply_status(by_name, await conn.command("STATUS", quote(name), STATUS_ITEMS))
+
+
+async def list_folders(with_status: bool = False) -> list[Folder]:
+    """List every mailbox, optionally with MESSAGES/UNSEEN/UIDNEXT counters.
+
+    Counters come back with the listing itself when the server supports
+    LIST-STATUS (RFC 5819); otherwise one STATUS per folder is pipelined
+    over the same session.
+    """
+
+    async def inner(conn: IMAPConnection) -> list[Folder]:
+        list_status = with_status and conn.has_capability("LIST-STATUS")
+        args = ['""', '"*"'] + ([f"RETURN (STATUS {STATUS_ITEMS})"] if list_status else [])
+        response = await conn.command("LIST", *args)
+        if not response.ok:
+            return []
+        folders = [folder for folder in map(_parse_list, response.of_kind("LIST")) if folder is not None]
+        if list_status:
+            _apply_status({folder.name: folder for folder in folders}, response)
+        elif with_status:
+            await _status(conn, folders)
+        return folders
+
+    return await _run(inner)
+
+
+async def folder_status(names: list[str]) -> dict[str, Folder]:
+    """Fetch counters for the named folders with pipelined STATUS commands."""
+
+    async def inner(conn: IMAPConnection) -> dict[str, Folder]:
+        folders = [Folder(name) for name in names]
+        await _status(conn, folders)
+        return {folder.name: folder for folder in folders}
+
+    return await _run(inner)
+
+
+async def list_mailboxes() -> list[str]:
+    """Return a list of mailbox names."""
+    return [folder.name for folder in await list_folders()]
+
+
+def _compress_uids(uids: list[int]) -> str:
+    """Render UIDs as a compact IMAP sequence set such as ``1:5,9,12``."""
+    ranges: list[str] = []
+    ordered = sorted(set(uids))
+    i = 0
+    while i < len(ordered):
+        start = end = ordered[i]
+        while i + 1 < len(ordered) and ordered[i + 1] == end + 1:
+            i += 1
+            end = ordered[i]
+        ranges.append(str(start) if start == end else f"{start}:{end}")
+        i += 1
+    return ",".join(ranges)
+
+
+def _search_uids(response) -> list[int]:
+    uids: list[int] = []
+    for item in response.of_kind("SEARCH"):
+        uids.extend(int(value) for value in item.data if value and value.isdigit())
+    return uids
+
+
+def _envelope_address(addresses) -> str:
+    """Bare address of the first ``(name adl mailbox host)`` entry of an ENVELOPE address list."""
+    if not isinstance(addresses, list) or not addresses or not isinstance(addresses[0], list):
+        return ""
+    address = addresses[0]
+    mailbox, host = (_as_str(address[2]), _as_str(address[3])) if len(address) > 3 else ("", "")
+    return f"{mailbox}@{host}" if mailbox and host else mailbox
+
+
+def _internaldate(value) -> datetime | None:
+    """Parse an INTERNALDATE such as ``17-Jul-1996 02:44:25 -0700``."""
+    try:
+        day, month, rest = _as_str(value).strip().split("-", 2)
+        return datetime.strptime(
+            f"{day.strip()}-{MONTHS.index(month) + 1}-{rest}", "%d-%m-%Y %H:%M:%S %z"
+        )
+    except ValueError:
+        return None
+
+
+def _parse_summary(items: dict) -> EmailSummary | None:
+    """Build a summary from ``UID FLAGS INTERNALDATE ENVELOPE`` fetch items.
+
+    ENVELOPE arrives already split into fields by the server, so only the
+    subject's encoded words and the date need decoding; INTERNALDATE stands
+    in when the Date header is missing or malformed.
+    """
+    uid = items.get("UID")
+    if not uid:
+        return None
+    flags = items.get("FLAGS") or []
+    envelope = items.get("ENVELOPE")
+    if not isinstance(envelope, list) or len(envelope) < 3:
+        envelope = [None, None, None]
+    subject = _decode_header(_as_str(envelope[1]))
+    from_ = _envelope_address(envelope[2])
+    try:
+        date = parsedate_to_datetime(_as_str(envelope[0])) if envelope[0] else None
+    except (TypeError, ValueError):
+        date = None
+    if date is None and items.get("INTERNALDATE"):
+        date = _internaldate(items["INTERNALDATE"])
+    seen = "\\Seen" in flags
+    return EmailSummary(uid=str(uid), subject=subject or "", from_=from_, date=date, seen=seen)
+
+
+def _flag_update(items: dict) -> tuple[int, bool, int | None] | None:
+    uid = items.get("UID")
+    if not uid:
+        return None
+    modseq = items.get("MODSEQ")
+    return int(uid), "\\Seen" in (items.get("FLAGS") or []), int(modseq[0]) if modseq else None
+
+
+async def sync_folder_index(conn: IMAPConnection, index: HeaderIndex, folder: str) -> None:
+    """Bring the local header index for ``folder`` up to date.
+
+    Only messages at or above the stored UIDNEXT are downloaded. Flag
+    changes come from QRESYNC/CONDSTORE when the server supports them, and
+    a UIDVALIDITY change discards everything stored for the folder.
+    Derived ``new``/``flags``/``expunged`` events are published on the bus.
+    """
+    stored = await index.folder_state(folder)
+    qresync = conn.has_capability("QRESYNC")
+    condstore = qresync or conn.has_capability("CONDSTORE")
+    params = None
+    if qresync:
+        await conn.enable("QRESYNC")
+    if qresync and stored is not None and stored.highestmodseq:
+        params = f"(QRESYNC ({stored.uidvalidity} {stored.highestmodseq}))"
+    elif condstore:
+        params = "(CONDSTORE)"
+
+    changes: list = []
+    conn.untagged_handlers.append(changes.append)
+    try:
+        state = await conn.select(folder, params=params, force=True)
+    finally:
+        conn.untagged_handlers.remove(changes.append)
+
+    uidvalidity = state.uidvalidity or 0
+    if stored is not None and stored.uidvalidity != uidvalidity:
+        await index.reset_folder(folder)
+        stored = None
+    last_uidnext = stored.uidnext if stored is not None else 1
+    max_uid = last_uidnext - 1
+
+    if state.uidnext is None or state.uidnext > last_uidnext:
+        response = (await conn.uid("SEARCH", f"UID {last_uidnext}:*")).check()
+        new_uids = sorted(uid for uid in _search_uids(response) if uid >= last_uidnext)
+        items = f"({SUMMARY_ITEMS} RFC822.SIZE MODSEQ)" if condstore else f"({SUMMARY_ITEMS} RFC822.SIZE)"
+        for start in range(0, len(new_uids), SYNC_BATCH_SIZE):
+            batch = new_uids[start:start + SYNC_BATCH_SIZE]
+            response = (await conn.uid("FETCH", _compress_uids(batch), items)).check()
+            messages = []
+            for item in response.of_kind("FETCH"):
+                data = fetch_items(item)
+                summary = _parse_summary(data)
+                if summary is not None:
+                    update = _flag_update(data)
+                    messages.append(IndexedMessage(summary, int(data.get("RFC822.SIZE") or 0), update[2]))
+            await index.upsert(folder, uidvalidity, messages)
+        if new_uids:
+            max_uid = max(max_uid, new_uids[-1])
+            events.bus.publish(events.MailEvent(folder, "new", new_uids, uidvalidity))
+
+    if stored is not None and last_uidnext > 1:
+        known = f"1:{last_uidnext - 1}"
+        flag_items: list = []
+        vanished: list[int] = []
+        if params is not None and params.startswith("(QRESYNC"):
+            # The SELECT already reported changed flags and expunged UIDs.
+            flag_items = [item for item in changes if item.kind == "FETCH"]
+            for item in changes:
+                if item.kind == "VANISHED" and item.data:
+                    vanished.extend(parse_uid_set(item.data[-1]))
+        elif condstore and stored.highestmodseq and state.highestmodseq:
+            if state.highestmodseq != stored.highestmodseq:
+                response = await conn.uid("FETCH", known, "(UID FLAGS)", f"(CHANGEDSINCE {stored.highestmodseq})")
+                flag_items = response.check().of_kind("FETCH")
+        else:
+            flag_items = (await conn.uid("FETCH", known, "(UID FLAGS)")).check().of_kind("FETCH")
+        updates = [update for update in map(_flag_update, map(fetch_items, flag_items)) if update]
+        if updates:
+            await index.update_flags(folder, uidvalidity, updates)
+            events.bus.publish(events.MailEvent(folder, "flags", [update[0] for update in updates], uidvalidity))
+        if not vanished and await index.count(folder, uidvalidity) != state.exists:
+            response = (await conn.uid("SEARCH", "ALL")).check()
+            present = set(_search_uids(response))
+            vanished = [uid for uid in await index.uids(folder, uidvalidity) if uid not in present]
+        if vanished:
+            await index.delete_uids(folder, uidvalidity, vanished)
+            events.bus.publish(events.MailEvent(folder, "expunged", vanished, uidvalidity))
+
+    await index.save_state(folder, uidvalidity, max(state.uidnext or 0, max_uid + 1), state.highestmodseq)
+
+
+async def index_bodies(conn: IMAPConnection, index: HeaderIndex, folder: str) -> None:
+    """Add the plain-text bodies of not yet indexed messages to the full-text index.
+
+    ``conn`` must have ``folder`` selected. Like :func:`fetch_reply_context`
+    only the ``BODYSTRUCTURE`` and the text part are fetched, never
+    attachments; text parts over ``FULLTEXT_MAX_MESSAGE_BYTES`` are indexed
+    with an empty body. At most ``FULLTEXT_SYNC_LIMIT`` messages are added
+    per call. This runs outside the folder's sync lock, from the mail
+    watcher or :func:`schedule_body_index`, never in a listing request.
+    """
+    uidvalidity = conn.mailbox.uidvalidity if conn.mailbox is not None else None
+    if uidvalidity is None:
+        return
+    pending = sorted(uid for uid, _ in await index.unindexed(folder, uidvalidity, FULLTEXT_SYNC_LIMIT))
+    max_bytes = (
+        dependencies.settings.fulltext_max_message_bytes if dependencies.settings is not None else FULLTEXT_MAX_MESSAGE_BYTES
+    )
+    for start in range(0, len(pending), FULLTEXT_BATCH_SIZE):
+        batch = pending[start:start + FULLTEXT_BATCH_SIZE]
+        response = (await conn.uid("FETCH", _compress_uids(batch), "(UID BODYSTRUCTURE)")).check()
+        bodies: dict[int, str] = {uid: "" for uid in batch}
+        sections: dict[str, dict[int, list]] = {}
+        for item in response.of_kind("FETCH"):
+            data = fetch_items(item)
+            structure = data.get("BODYSTRUCTURE")
+            if not data.get("UID") or not isinstance(structure, list) or not structure:
+                continue
+            found = _text_section(structure)
+            if found is None:
+                continue
+            section, part = found
+            size = part[6] if len(part) > 6 else None
+            if isinstance(size, str) and size.isdigit() and int(size) > max_bytes:
+                continue
+            sections.setdefault(section, {})[int(data["UID"])] = part
+        # Most messages share a handful of text sections ("1", "1.1"), so one
+        # FETCH per distinct section covers the batch.
+        for section, parts in sections.items():
+            response = (await conn.uid("FETCH", _compress_uids(sorted(parts)), f"(UID BODY.PEEK[{section}])")).check()
+            for item in response.of_kind("FETCH"):
+                data = fetch_items(item)
+                uid = int(data["UID"]) if data.get("UID") else None
+                text = _item(data, f"BODY[{section}]")
+                if uid in parts and text is not None:
+                    bodies[uid] = _decode_part(_as_bytes(text), parts[uid])
+        await index.add_bodies(folder, uidvalidity, bodies.items())
+
+
+_body_tasks: dict[str, asyncio.Task] = {}
+
+
+async def _backfill_bodies(folder: str) -> None:
+    index = header_index.index
+    if index is None or not index.fulltext:
+        return
+    try:
+        await _run(lambda conn: index_bodies(conn, index, folder), folder)
+    except Exception as e:
+        print(f"Full-text backfill for {folder} failed: {str(e)}")
+
+
+def schedule_body_index(folder: str) -> None:
+    """Start a background full-text backfill for ``folder`` unless one is running."""
+    if folder in _body_tasks:
+        return
+    # Run in an empty context so the backfill's spans are not added to the
+    # request that happened to trigger it.
+    task = contextvars.Context().run(asyncio.create_task, _backfill_bodies(folder))
+    _body_tasks[folder] = task
+    task.add_done_callback(lambda done: _body_tasks.pop(folder, None) if _body_tasks.get(folder) is done else None)
+
+
+async def stop_body_index() -> None:
+    """Cancel running full-text backfills."""
+    tasks = list(_body_tasks.values())
+    _body_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _forget(conn: IMAPConnection, folder: str, uids: list[str]) -> None:
+    """Report expunged messages and drop them from the header index."""
+    numeric = [int(uid) for uid in uids if uid.isdigit()]
+    uidvalidity = conn.mailbox.uidvalidity if conn.mailbox is not None else None
+    if not numeric or uidvalidity is None:
+        return
+    if header_index.index is not None:
+        await header_index.index.delete_uids(folder, uidvalidity, numeric)
+    events.bus.publish(events.MailEvent(folder, "expunged", numeric, uidvalidity))
+
+
+def _page_size(limit: int) -> int:
+    """Clamp ``limit`` to the configured page cap; non-positive means a full page."""
+    cap = dependencies.settings.max_page_size if dependencies.settings is not None else MAX_PAGE_SIZE
+    return cap if limit <= 0 else min(limit, cap)
+
+
+def _check_uidvalidity(position: PageCursor | None, uidvalidity: int | None) -> None:
+    if position is None or position.uidvalidity is None or uidvalidity is None:
+        return
+    if position.uidvalidity != uidvalidity:
+        raise InvalidCursor("Cursor is no longer valid for this folder")
+
+
+def _search_args(criteria: list) -> list:
+    """Prefix ``CHARSET UTF-8`` when the criteria carry any string values."""
+    if any(isinstance(arg, Literal) or str(arg).startswith('"') for arg in criteria):
+        return ["CHARSET", "UTF-8", *criteria]
+    return criteria
+
+
+async def _uids_before(conn: IMAPConnection, criteria: list, count: int, before: int | None, hint: int | None) -> list[int]:
+    """Return up to ``count`` of the highest matching UIDs below ``before``.
+
+    UIDs are searched in windows growing geometrically downwards from
+    ``before`` (or from the ``hint`` UIDNEXT on the first page), so pages
+    near the top of a large folder never pull the folder's full UID list.
+    """
+    if before is None and hint is None:
+        response = await conn.uid("SEARCH", *_search_args(criteria))
+        return sorted(_search_uids(response))[-count:] if response.ok else []
+    if before is not None:
+        high, upper = before - 1, str(before - 1)
+    else:
+        # UIDNEXT may be stale on a reused session, so the first window is open-ended.
+        high, upper = max(hint - 1, 1), "*"
+    if high < 1:
+        return []
+    found: list[int] = []
+    window = max(count * 2, 64)
+    while len(found) < count:
+        low = max(1, high - window + 1)
+        response = await conn.uid("SEARCH", *_search_args(criteria), f"UID {low}:{upper}")
+        if not response.ok:
+            return []
+        found = sorted(uid for uid in _search_uids(response) if uid >= low) + found
+        if low == 1:
+            break
+        high = low - 1
+        upper = str(high)
+        window *= 4
+    return found[-count:]
+
+
+class UnsupportedSort(ValueError):
+    """Raised when a listing order cannot be served without loading the whole folder."""
+
+
+def _sort_set(value) -> list[int]:
+    """Expand a PARTIAL result such as ``10,3,9:7`` keeping the order of its ranges."""
+    uids: list[int] = []
+    for part in _as_str(value or "").split(","):
+        if not part:
+            continue
+        start, _, end = part.partition(":")
+        if end:
+            step = 1 if int(end) >= int(start) else -1
+            uids.extend(range(int(start), int(end) + step, step))
+        else:
+            uids.append(int(start))
+    return uids
+
+
+def _sort_cache_key(conn: IMAPConnection, criteria: list, sort: str) -> tuple | None:
+    mailbox = conn.mailbox
+    if mailbox is None or mailbox.uidvalidity is None:
+        return None
+    return (mailbox.name, mailbox.uidvalidity, sort, _query_key(criteria))
+
+
+async def _partial_sort(conn: IMAPConnection, criteria: list, key: str, start: int, count: int) -> list[int]:
+    """Fetch the ``count`` UIDs after ``start`` of a ``UID SORT``, plus the one at ``start`` itself."""
+    response = await conn.uid(
+        "SORT", f"RETURN (PARTIAL {max(start, 1)}:{start + count})", f"(REVERSE {key})", "UTF-8", *criteria
+    )
+    if not response.ok:
+        return []
+    for item in response.of_kind("ESEARCH"):
+        for name, value in zip(item.data, item.data[1:]):
+            if isinstance(name, str) and name.upper() == "PARTIAL" and isinstance(value, list) and len(value) > 1:
+                return _sort_set(value[1])
+    return []
+
+
+async def _sorted_page(
+    conn: IMAPConnection, criteria: list, sort: str, position: PageCursor | None, count: int
+) -> tuple[list[int], int]:
+    """Return up to ``count`` matching UIDs in descending ``sort`` order and the offset of the first.
+
+    Servers with CONTEXT=SORT (RFC 5267) return just the page's window of
+    the order through ``RETURN (PARTIAL ...)``. With plain SORT the full
+    ordering is fetched once and kept while the mailbox's UIDVALIDITY,
+    UIDNEXT, message count and HIGHESTMODSEQ are unchanged, for at most
+    ``SORT_CACHE_TTL`` seconds. Without SORT the order would have to be
+    computed from every message's headers, so :class:`UnsupportedSort` is
+    raised instead.
+    """
+    key = SORT_KEYS[sort]
+    start = position.offset if position is not None else 0
+    if conn.has_capability("CONTEXT=SORT"):
+        window = await _partial_sort(conn, criteria, key, start, count)
+        if start and window and window[0] != position.uid and position.uid in window:
+            # Messages arrived ahead of the cursor; ask again from its new place.
+            start += window.index(position.uid)
+            window = await _partial_sort(conn, criteria, key, start, count)
+        return (window[1:] if start else window)[:count], start
+    if not conn.has_capability("SORT"):
+        raise UnsupportedSort(f"Sorting by {sort} needs a server with SORT or a header index")
+
+    mailbox = conn.mailbox
+    cache_key = _sort_cache_key(conn, criteria, sort)
+    state = (mailbox.uidnext, mailbox.exists, mailbox.highestmodseq) if mailbox is not None else None
+    cached = _sort_cache.get(cache_key) if cache_key is not None else None
+    if cached is not None and cached[0] == state and time.monotonic() - cached[1] < SORT_CACHE_TTL:
+        ordered = cached[2]
+        _sort_cache.move_to_end(cache_key)
+    else:
+        response = await conn.uid("SORT", f"(REVERSE {key})", "UTF-8", *criteria)
+        if not response.ok:
+            return [], start
+        ordered = [int(value) for item in response.of_kind("SORT") for value in item.data if value and value.isdigit()]
+        if cache_key is not None:
+            _sort_cache[cache_key] = (state, time.monotonic(), ordered)
+            _sort_cache.move_to_end(cache_key)
+            while len(_sort_cache) > SORT_CACHE_SIZE:
+                _sort_cache.popitem(last=False)
+    if position is not None and position.uid in ordered:
+        start = ordered.index(position.uid) + 1
+    return ordered[start:start + count], start
+
+
+async def _page_uids(
+    conn: IMAPConnection,
+    limit: int,
+    unread_only: bool,
+    sort: str,
+    position: PageCursor | None,
+    criteria: list | None = None,
+    query: str | None = None,
+) -> tuple[list[int], str | None]:
+    """Pick the UIDs on the requested page and the cursor for the one after it."""
+    mailbox = conn.mailbox
+    uidvalidity = mailbox.uidvalidity if mailbox is not None else None
+    _check_uidvalidity(position, uidvalidity)
+    criteria = criteria or ["UNSEEN" if unread_only else "ALL"]
+    start = 0
+    if sort == "arrival":
+        before = position.uid if position is not None else None
+        hint = mailbox.uidnext if mailbox is not None else None
+        uids = await _uids_before(conn, criteria, limit + 1, before, hint)
+    else:
+        ordered, start = await _sorted_page(conn, criteria, sort, position, limit + 1)
+        uids = list(reversed(ordered))
+    page = uids[-limit:]
+    next_cursor = None
+    if len(uids) > limit:
+        next_cursor = PageCursor(sort, unread_only, page[0], uidvalidity, offset=start + len(page), query=query).encode()
+    return page, next_cursor
+
+
+async def _imap_page(
+    conn: IMAPConnection,
+    limit: int,
+    unread_only: bool,
+    sort: str,
+    position: PageCursor | None,
+    criteria: list | None = None,
+    query: str | None = None,
+) -> MessagePage:
+    page, next_cursor = await _page_uids(conn, limit, unread_only, sort, position, criteria, query)
+    if not page:
+        return MessagePage([])
+    response = await conn.uid("FETCH", _compress_uids(page), f"({SUMMARY_ITEMS})")
+    if not response.ok:
+        return MessagePage([])
+    summaries: dict[str, EmailSummary] = {}
+    for item in response.of_kind("FETCH"):
+        summary = _parse_summary(fetch_items(item))
+        if summary is not None:
+            summaries[summary.uid] = summary
+    return MessagePage([summaries[str(uid)] for uid in page if str(uid) in summaries], next_cursor)
+
+
+async def _iter_summaries(conn: IMAPConnection, uids: list[int]) -> AsyncIterator[EmailSummary]:
+    """Yield summaries in ``uids`` order as their FETCH responses arrive.
+
+    Servers answer in sequence order, so only summaries arriving ahead of
+    their place in a non-arrival sort are held back.
+    """
+    pending: dict[str, EmailSummary] = {}
+    position = 0
+    async for item in conn.stream("UID", "FETCH", _compress_uids(uids), f"({SUMMARY_ITEMS})"):
+        if item.kind != "FETCH":
+            continue
+        summary = _parse_summary(fetch_items(item))
+        if summary is None:
+            continue
+        pending[summary.uid] = summary
+        while position < len(uids) and str(uids[position]) in pending:
+            yield pending.pop(str(uids[position]))
+            position += 1
+    for uid in uids[position:]:
+        if str(uid) in pending:
+            yield pending.pop(str(uid))
+
+
+def _position(sort: str, unread_only: bool, cursor: str | None, query: str | None = None) -> PageCursor | None:
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unsupported sort order: {sort}")
+    position = PageCursor.decode(cursor) if cursor else None
+    if position is not None and (position.sort != sort or position.unread != unread_only or position.query != query):
+        raise InvalidCursor("Cursor does not match the requested sort or filter")
+    return position
+
+
+async def fetch_page(
+    folder: str = "INBOX",
+    limit: int = 10,
+    unread_only: bool = False,
+    sort: str = "arrival",
+    cursor: str | None = None,
+) -> MessagePage:
+    """Return one page of message summaries and the cursor for the next one.
+
+    Pages walk backwards from the end of the ``sort`` order; each page is
+    returned in ascending order. ``cursor`` is the ``next_cursor`` of the
+    previous page. With a header index configured the folder is synced
+    incrementally, at most every ``max_age`` seconds and only for the first
+    page of a listing, and the page is served from the index. Otherwise
+    arrival-order pages come from windowed ``UID SEARCH`` ranges and other
+    orders from ``UID SORT`` (:class:`UnsupportedSort` without it), and the
+    headers for the page are requested with a single ``UID FETCH``.
+    """
+    position = _position(sort, unread_only, cursor)
+    limit = _page_size(limit)
+
+    index = header_index.index
+    if index is not None:
+        async with index.sync_lock(folder):
+            state = await index.folder_state(folder)
+            # Later pages continue the snapshot the first page synced.
+            if state is None or (position is None and not index.is_fresh(folder, state)):
+                await _run(lambda conn: sync_folder_index(conn, index, folder))
+                state = await index.folder_state(folder)
+                if index.fulltext:
+                    schedule_body_index(folder)
+        uidvalidity = state.uidvalidity if state is not None else None
+        _check_uidvalidity(position, uidvalidity)
+        before = (position.key, position.uid) if position is not None else None
+        rows = await index.query(folder, limit + 1, unread_only, sort, before)
+        page = rows[-limit:]
+        next_cursor = None
+        if len(rows) > limit:
+            first, key = page[0]
+            next_cursor = PageCursor(sort, unread_only, int(first.uid), uidvalidity, key).encode()
+        return MessagePage([summary for summary, _ in page], next_cursor)
+
+    return await _run(lambda conn: _imap_page(conn, limit, unread_only, sort, position), folder)
+
+
+async def stream_page(
+    folder: str = "INBOX",
+    limit: int = 10,
+    unread_only: bool = False,
+    sort: str = "arrival",
+    cursor: str | None = None,
+) -> AsyncIterator[MessagePage | EmailSummary]:
+    """Streaming variant of :func:`fetch_page`.
+
+    The first item is an empty :class:`MessagePage` carrying the next
+    cursor, so callers can send headers and surface errors before any
+    summary is produced. Summaries follow one at a time as they are parsed
+    out of the ``UID FETCH`` reply, on one session held for the whole walk.
+    """
+    if header_index.index is not None:
+        # Index pages are read from SQLite in one capped query.
+        page = await fetch_page(folder, limit, unread_only, sort, cursor)
+        yield MessagePage([], page.next_cursor)
+        for summary in page.messages:
+            yield summary
+        return
+    position = _position(sort, unread_only, cursor)
+    limit = _page_size(limit)
+    async with _session(folder) as conn:
+        uids, next_cursor = await _page_uids(conn, limit, unread_only, sort, position)
+        yield MessagePage([], next_cursor)
+        if uids:
+            async for summary in _iter_summaries(conn, uids):
+                yield summary
+
+
+def _imap_date(value: date) -> str:
+    return f"{value.day}-{MONTHS[value.month - 1]}-{value.year}"
+
+
+def search_criteria(request: SearchRequest) -> list:
+    """Compile structured search criteria into ``UID SEARCH`` arguments.
+
+    All criteria are ANDed, as IMAP does for a plain list of keys. String
+    values are quoted, or sent as literals when they are not ASCII.
+    """
+    criteria: list = []
+    for key, value in (
+        ("FROM", request.from_),
+        ("TO", request.to),
+        ("CC", request.cc),
+        ("SUBJECT", request.subject),
+        ("BODY", request.body),
+        ("TEXT", request.text),
+    ):
+        if value:
+            criteria += [key, quote(value)]
+    if request.since:
+        criteria += ["SINCE", _imap_date(request.since)]
+    if request.before:
+        criteria += ["BEFORE", _imap_date(request.before)]
+    for flag in request.flags:
+        system = SYSTEM_FLAGS.get(flag.upper())
+        criteria += [system[0]] if system else ["KEYWORD", flag]
+    for flag in request.without_flags:
+        system = SYSTEM_FLAGS.get(flag.upper())
+        criteria += [system[1]] if system else ["UNKEYWORD", flag]
+    if request.larger is not None:
+        criteria += ["LARGER", str(request.larger)]
+    if request.smaller is not None:
+        criteria += ["SMALLER", str(request.smaller)]
+    for name, value in (request.header or {}).items():
+        criteria += ["HEADER", quote(name), quote(value)]
+    return criteria or ["ALL"]
+
+
+def _query_key(criteria: list) -> str:
+    raw = b"\0".join(arg.data if isinstance(arg, Literal) else str(arg).encode("utf-8") for arg in criteria)
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+
+async def search_page(
+    criteria: list,
+    folder: str = "INBOX",
+    limit: int = 10,
+    sort: str = "arrival",
+    cursor: str | None = None,
+) -> MessagePage:
+    """Return one page of messages matching ``criteria``, filtered by the server.
+
+    ``criteria`` comes from :func:`search_criteria`. Pages are walked like
+    :func:`fetch_page` without a header index: arrival order in windowed
+    ``UID SEARCH`` ranges, other orders through ``UID SORT``, and the page's
+    headers in one ``UID FETCH``.
+    """
+    query = _query_key(criteria)
+    position = _position(sort, False, cursor, query)
+    limit = _page_size(limit)
+    return await _run(lambda conn: _imap_page(conn, limit, False, sort, position, criteria, query), folder)
 
 
 async def fetch_messages(folder: str = "INBOX", limit: int = 10, unread_only: bool = False) -> list[EmailSummary]:
-    """Fetch message headers from a folder and return summaries."""
+    """Return the newest ``limit`` message summaries in ascending UID order."""
+    return (await fetch_page(folder, limit, unread_only)).messages
 
-    def inner() -> list[EmailSummary]:
-        if dependencies.settings is None:
-            raise RuntimeError("Settings have not been initialized")
-        with imaplib.IMAP4_SSL(
-            dependencies.settings.account_imap_server,
-            dependencies.settings.account_imap_port,
-        ) as imap:
-            imap.login(dependencies.settings.account_email, dependencies.settings.account_password)
-            imap.select(folder)
-            criteria = "UNSEEN" if unread_only else "ALL"
-            typ, data = imap.search(None, criteria)
-            if typ != "OK" or not data or not data[0]:
-                return []
-            uids = data[0].split()
-            if limit:
-                uids = uids[-limit:]
-            summaries: list[EmailSummary] = []
-            for uid in uids:
-                typ, msg_data = imap.uid('fetch', uid, '(RFC822.HEADER FLAGS)')
-                if typ != "OK" or msg_data is None:
-                    continue
-                header_bytes = msg_data[0][1]
-                flag_info = msg_data[0][0].decode()
-                msg = email.message_from_bytes(header_bytes)
-                subject = _decode_header(msg.get('Subject', ''))
-                from_raw = _decode_header(msg.get('From', ''))
-                from_ = email.utils.parseaddr(from_raw)[1]
-                date_raw = msg.get('Date', '')
-                date = parsedate_to_datetime(date_raw) if date_raw else None
-                seen = "\\Seen" in flag_info
-                summaries.append(EmailSummary(uid=uid.decode(), subject=subject or "", from_=from_, date=date, seen=seen))
-            return summaries
-
-    return await asyncio.to_thread(inner)
 
+def _batches(uids: list[int]) -> list[list[int]]:
+    ordered = sorted(set(uids))
+    return [ordered[i : i + BULK_BATCH_SIZE] for i in range(0, len(ordered), BULK_BATCH_SIZE)]
 
-async def move_message(uid: str, folder: str, source_folder: str = "INBOX") -> None:
-    """Move a message to another folder."""
 
-    def inner() -> None:
-        if dependencies.settings is None:
-            raise RuntimeError("Settings have not been initialized")
-        with imaplib.IMAP4_SSL(
-            dependencies.settings.account_imap_server,
-            dependencies.settings.account_imap_port,
-        ) as imap:
-            imap.login(dependencies.settings.account_email, dependencies.settings.account_password)
-            imap.select(source_folder)
-            imap.uid("COPY", uid, folder)
-            imap.uid("STORE", uid, "+FLAGS", "(\\Deleted)")
-            imap.expunge()
+async def _expunge(conn: IMAPConnection, uid_set: str) -> None:
+    """Expunge only ``uid_set``; without UIDPLUS fall back to a folder-wide EXPUNGE."""
+    if conn.has_capability("UIDPLUS"):
+        (await conn.uid("EXPUNGE", uid_set)).check()
+    else:
+        (await conn.command("EXPUNGE")).check()
 
-    await asyncio.to_thread(inner)
 
+async def move_messages(uids: list[int], folder: str, source_folder: str = "INBOX") -> int:
+    """Move messages to another folder with one ``UID MOVE`` per batch.
 
-async def delete_message(uid: str, folder: str = "INBOX") -> None:
-    """Delete a message from a folder."""
+    Servers without MOVE (RFC 6851) get ``UID COPY`` followed by flagging
+    and expunging the batch. Returns the number of UIDs requested.
 
-    def inner() -> None:
-        if dependencies.settings is None:
-            raise RuntimeError("Settings have not been initialized")
-        with imaplib.IMAP4_SSL(
-            dependencies.settings.account_imap_server,
-            dependencies.settings.account_imap_port,
-        ) as imap:
-            imap.login(dependencies.settings.account_email, dependencies.settings.account_password)
-            imap.select(folder)
-            imap.uid("STORE", uid, "+FLAGS", "(\\Deleted)")
-            imap.expunge()
+    When the session drops, the pool replays ``inner`` on a fresh one, which
+    resumes at the first unfinished batch. ``UID COPY`` is not idempotent,
+    so a batch whose COPY was sent but never answered is not replayed.
+    """
+    batches = _batches(uids)
+    done = 0
+    copy_state = None  # "sent" while a COPY awaits its reply, "ok" once it succeeded
+
+    async def inner(conn: IMAPConnection) -> None:
+        nonlocal done, copy_state
+        if copy_state == "sent":
+            raise IMAPError(f"Connection lost during UID COPY to {folder}; the messages may have been copied")
+        for batch in batches[done:]:
+            uid_set = _compress_uids(batch)
+            if conn.has_capability("MOVE"):
+                (await conn.uid("MOVE", uid_set, quote(folder))).check()
+            else:
+                if copy_state is None:
+                    copy_state = "sent"
+                    (await conn.uid("COPY", uid_set, quote(folder))).check()
+                    copy_state = "ok"
+                (await conn.uid("STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)")).check()
+                await _expunge(conn, uid_set)
+            await _forget(conn, source_folder, [str(uid) for uid in batch])
+            done += 1
+            copy_state = None
+
+    await _run(inner, source_folder)
+    return len(set(uids))
 
-    await asyncio.to_thread(inner)
+
+async def delete_messages(uids: list[int], folder: str = "INBOX") -> int:
+    """Delete messages with one ``UID STORE`` and ``UID EXPUNGE`` per batch."""
+
+    async def inner(conn: IMAPConnection) -> None:
+        for batch in _batches(uids):
+            uid_set = _compress_uids(batch)
+            (await conn.uid("STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)")).check()
+            await _expunge(conn, uid_set)
+            await _forget(conn, folder, [str(uid) for uid in batch])
+
+    await _run(inner, folder)
+    return len(set(uids))
+
+
+async def move_message(uid: str, folder: str, source_folder: str = "INBOX") -> None:
+    """Move a message to another folder."""
+    await move_messages([int(uid)], folder, source_folder)
+
+
+async def delete_message(uid: str, folder: str = "INBOX") -> None:
+    """Delete a message from a folder."""
+    await delete_messages([int(uid)], folder)
 
 
 async def append_message(folder: str, msg: MIMEMultipart) -> None:
     """Append a raw message to the specified folder."""
 
-    def inner() -> None:
-        if dependencies.settings is None:
-            raise RuntimeError("Settings have not been initialized")
-        with imaplib.IMAP4_SSL(
-            dependencies.settings.account_imap_server,
-            dependencies.settings.account_imap_port,
-        ) as imap:
-            imap.login(dependencies.settings.account_email, dependencies.settings.account_password)
-            imap.append(folder, "", imaplib.Time2Internaldate(time.time()), msg.as_bytes())
+    async def inner(conn: IMAPConnection) -> None:
+        date_time = imaplib.Time2Internaldate(time.time())
+        (await conn.append(folder, "", date_time, msg.as_bytes())).check()
+
+    # APPEND is not idempotent, so never replay it on a fresh session.
+    await _run(inner, retry=False)
+
 
-    await asyncio.to_thread(inner)
+def _cache_key(conn: IMAPConnection, folder: str, uid: str) -> tuple | None:
+    """Message cache key for ``uid`` in the folder selected on ``conn``, if caching applies."""
+    uidvalidity = conn.mailbox.uidvalidity if conn.mailbox is not None else None
+    if message_cache.cache is None or uidvalidity is None or not uid.isdigit():
+        return None
+    return folder, uidvalidity, int(uid)
 
 
 async def fetch_message(uid: str, folder: str = "INBOX") -> email.message.Message:
     """Fetch a full message by UID."""
 
-    def inner() -> email.message.Message:
-        if dependencies.settings is None:
-            raise RuntimeError("Settings have not been initialized")
-        with imaplib.IMAP4_SSL(
-            dependencies.settings.account_imap_server,
-            dependencies.settings.account_imap_port,
-        ) as imap:
-            imap.login(
-                dependencies.settings.account_email,
-                dependencies.settings.account_password,
-            )
-            imap.select(folder)
-            typ, msg_data = imap.uid("fetch", uid, "(RFC822)")
-            if typ != "OK" or msg_data is None or not msg_data[0]:
-                raise RuntimeError("Failed to fetch message")
-            return email.message_from_bytes(msg_data[0][1])
-
-    return await asyncio.to_thread(inner)
+    async def inner(conn: IMAPConnection) -> email.message.Message:
+        key = _cache_key(conn, folder, uid)
+        cached = message_cache.cache.get(*key) if key else None
+        if cached is not None and cached.raw is not None:
+            return email.message_from_bytes(cached.raw)
+        response = await conn.uid("FETCH", uid, "(RFC822)")
+        if response.ok:
+            for item in response.of_kind("FETCH"):
+                raw = fetch_items(item).get("RFC822")
+                if raw:
+                    raw = _as_bytes(raw)
+                    if key:
+                        message_cache.cache.put(*key, raw=raw)
+                    return email.message_from_bytes(raw)
+        raise RuntimeError("Failed to fetch message")
+
+    return await _run(inner, folder)
+
+
+@dataclass
+class ReplyContext:
+    """The parts of an original message needed to reply to or forward it."""
+
+    subject: str
+    message_id: str | None
+    references: str | None
+    body: str
+
+
+def _params(values) -> dict[str, str]:
+    """Turn a BODYSTRUCTURE parameter list into a dict keyed by upper-cased name."""
+    if not isinstance(values, list):
+        return {}
+    return {str(values[i]).upper(): _as_str(values[i + 1]) for i in range(0, len(values) - 1, 2)}
+
+
+def _has_filename(part: list) -> bool:
+    disposition = part[9] if len(part) > 9 else None
+    if isinstance(disposition, list) and "FILENAME" in _params(disposition[1] if len(disposition) > 1 else None):
+        return True
+    return "NAME" in _params(part[2])
+
+
+def _text_section(structure: list, section: str = "") -> tuple[str, list] | None:
+    """Find the first text/plain part without a filename in a BODYSTRUCTURE.
+
+    Returns the part's section number and its structure, walking parts in
+    the same order as ``email.message.Message.walk``, including bodies of
+    attached messages. A single-part message is returned as section 1
+    whatever its type, like ``extract_body`` decodes any non-multipart body.
+    """
+    if isinstance(structure[0], list):
+        children = itertools.takewhile(lambda child: isinstance(child, list), structure)
+        for number, child in enumerate(children, 1):
+            found = _text_section(child, f"{section}.{number}" if section else str(number))
+            if found:
+                return found
+        return None
+    if not section:
+        return "1", structure
+    kind = f"{_as_str(structure[0])}/{_as_str(structure[1])}".lower()
+    if kind == "text/plain" and not _has_filename(structure):
+        return section, structure
+    if kind == "message/rfc822" and len(structure) > 8 and isinstance(structure[8], list):
+        inner = structure[8]
+        # An attached message's parts are numbered under its own section;
+        # a single-part attached message has its body at ``section.1``.
+        return _text_section(inner, section if isinstance(inner[0], list) else f"{section}.1")
+    return None
+
+
+_NOT_BASE64 = bytes(set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"))
+
+
+def _b64decode(data: bytes) -> bytes:
+    """Decode base64 leniently, as ``get_payload(decode=True)`` does, instead of raising on bad padding."""
+    try:
+        return base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        pass
+    data = data.translate(None, _NOT_BASE64)
+    if len(data) % 4 == 1:
+        # A lone trailing character carries no whole byte.
+        data = data[:-1]
+    return base64.b64decode(data + b"=" * (-len(data) % 4))
+
+
+def _decode_part(data: bytes, part: list) -> str:
+    encoding = _as_str(part[5]).lower() if len(part) > 5 and part[5] else ""
+    if encoding == "base64":
+        data = _b64decode(data)
+    elif encoding == "quoted-printable":
+        data = quopri.decodestring(data)
+    charset = _params(part[2]).get("CHARSET") or "utf-8"
+    try:
+        return data.decode(charset, errors="ignore")
+    except LookupError:
+        return data.decode("utf-8", errors="ignore")
+
+
+def _item(items: dict, prefix: str):
+    """Return the FETCH item whose name starts with ``prefix``, if any."""
+    for name, value in items.items():
+        if name.startswith(prefix):
+            return value
+    return None
+
+
+async def fetch_reply_context(uid: str, folder: str = "INBOX") -> ReplyContext:
+    """Fetch what a reply or forward needs without downloading the whole message.
+
+    One ``UID FETCH`` returns the ``BODYSTRUCTURE`` and the threading
+    headers; a second fetches only the plain-text body section, so large
+    attachments never cross the wire. Results are kept in the message
+    cache, and a message already cached whole is decoded locally.
+    """
+
+    async def inner(conn: IMAPConnection) -> ReplyContext:
+        key = _cache_key(conn, folder, uid)
+        cached = message_cache.cache.get(*key) if key else None
+        if cached is not None and cached.context is not None:
+            return cached.context
+        if cached is not None and cached.raw is not None:
+            msg = email.message_from_bytes(cached.raw)
+            context = ReplyContext(msg.get("Subject", ""), msg.get("Message-ID"), msg.get("References"), extract_body(msg))
+            message_cache.cache.put(*key, context=context)
+            return context
+        response = await conn.uid("FETCH", uid, f"(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({REPLY_HEADERS})])")
+        items = {}
+        if response.ok:
+            for item in response.of_kind("FETCH"):
+                items = fetch_items(item)
+                if "BODYSTRUCTURE" in items:
+                    break
+        structure = items.get("BODYSTRUCTURE")
+        if not isinstance(structure, list) or not structure:
+            raise RuntimeError("Failed to fetch message")
+        headers = email.message_from_bytes(_as_bytes(_item(items, "BODY[HEADER") or b""))
+
+        body = ""
+        found = _text_section(structure)
+        if found:
+            section, part = found
+            response = await conn.uid("FETCH", uid, f"(BODY.PEEK[{section}])")
+            if response.ok:
+                for item in response.of_kind("FETCH"):
+                    data = _item(fetch_items(item), f"BODY[{section}]")
+                    if data:
+                        body = _decode_part(_as_bytes(data), part)
+                        break
+        context = ReplyContext(
+            subject=headers.get("Subject", ""),
+            message_id=headers.get("Message-ID"),
+            references=headers.get("References"),
+            body=body,
+        )
+        if key:
+            message_cache.cache.put(*key, context=context)
+        return context
+
+    return await _run(inner, folder)
@@ -0,0 +1,208 @@
+# flake8: noqa
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from . import metrics, tracing
+from .imap_protocol import IMAPAbort, IMAPConnection
+
+T = TypeVar("T")
+
+# Errors that indicate the underlying session is unusable and must be replaced.
+CONNECTION_ERRORS = (IMAPAbort, OSError, EOFError)
+
+
+async def open_connection(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    use_ssl: bool = True,
+    timeout: Optional[float] = 30.0,
+) -> IMAPConnection:
+    """Connect and log in, returning a ready-to-use session."""
+    with tracing.span("imap.connect"):
+        conn = IMAPConnection(host, port, use_ssl=use_ssl, timeout=timeout)
+        await conn.open()
+        try:
+            await conn.login(username, password)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+
+def connection_kwargs(settings) -> dict:
+    return {
+        "host": settings.account_imap_server,
+        "port": settings.account_imap_port,
+        "username": settings.account_email,
+        "password": settings.account_password,
+        "use_ssl": settings.account_imap_ssl,
+        "timeout": settings.imap_timeout,
+    }
+
+
+class IMAPPool:
+    """Bounded pool of authenticated IMAP sessions.
+
+    Sessions are opened lazily, health checked with NOOP after sitting idle,
+    evicted once they exceed ``idle_timeout`` and replaced when a command
+    fails with a connection error.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        size: int = 4,
+        idle_timeout: float = 300.0,
+        health_check_interval: float = 30.0,
+        use_ssl: bool = True,
+        timeout: Optional[float] = 30.0,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self._idle: deque[IMAPConnection] = deque()
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle_gauge = metrics.POOL_SESSIONS.labels("imap", "idle")
+        self._in_use_gauge = metrics.POOL_SESSIONS.labels("imap", "in_use")
+        self._reaper: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @classmethod
+    def from_settings(cls, settings) -> "IMAPPool":
+        return cls(
+            **connection_kwargs(settings),
+            size=settings.imap_pool_size,
+            idle_timeout=settings.imap_pool_idle_timeout,
+            health_check_interval=settings.imap_pool_health_check_interval,
+        )
+
+    async def start(self) -> None:
+        """Start the background task that evicts idle sessions."""
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_idle())
+
+    async def close(self) -> None:
+        """Stop the reaper and log out every idle session."""
+        self._closed = True
+        if self._reaper is not None:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+        idle = list(self._idle)
+        self._idle.clear()
+        self._idle_gauge.set(0)
+        await asyncio.gather(*(conn.logout() for conn in idle), return_exceptions=True)
+
+    async def _open(self) -> IMAPConnection:
+        return await open_connection(
+            self.host,
+            self.port,
+            self.username,
+            self.password,
+            use_ssl=self.use_ssl,
+            timeout=self.timeout,
+        )
+
+    async def _acquire(self) -> IMAPConnection:
+        while self._idle:
+            conn = self._idle.pop()
+            self._idle_gauge.set(len(self._idle))
+            idle_for = time.monotonic() - conn.last_used
+            if conn.broken or idle_for > self.idle_timeout:
+                await conn.logout()
+                continue
+            if idle_for > self.health_check_interval and not await conn.noop():
+                await conn.logout()
+                continue
+            return conn
+        return await self._open()
+
+    async def _release(self, conn: IMAPConnection) -> None:
+        if conn.broken or self._closed:
+            await conn.logout()
+            return
+        conn.last_used = time.monotonic()
+        self._idle.append(conn)
+        self._idle_gauge.set(len(self._idle))
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[IMAPConnection]:
+        """Check out a session for the duration of the ``async with`` block."""
+        if self._closed:
+            raise RuntimeError("IMAP pool is closed")
+        async with self._semaphore:
+            conn = await self._acquire()
+            self._in_use_gauge.inc()
+            try:
+                yield conn
+            except (*CONNECTION_ERRORS, asyncio.CancelledError):
+                # A dead or interrupted session is in an unknown state.
+                conn.broken = True
+                raise
+            finally:
+                self._in_use_gauge.dec()
+                await self._release(conn)
+
+    async def run(
+        self,
+        func: Callable[[IMAPConnection], Awaitable[T]],
+        folder: Optional[str] = None,
+        retry: bool = True,
+    ) -> T:
+        """Run ``func`` against a pooled session.
+
+        When the session turns out to be dead the call is retried once on a
+        fresh session if ``retry`` is set.
+        """
+        try:
+            async with self.connection() as conn:
+                return await _call(conn, func, folder)
+        except CONNECTION_ERRORS:
+            if not retry:
+                raise
+        async with self.connection() as conn:
+            return await _call(conn, func, folder)
+
+    async def _reap_idle(self) -> None:
+        interval = max(min(self.idle_timeout, self.health_check_interval), 1.0)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            keep: deque[IMAPConnection] = deque()
+            expired: list[IMAPConnection] = []
+            while self._idle:
+                conn = self._idle.popleft()
+                if now - conn.last_used > self.idle_timeout:
+                    expired.append(conn)
+                else:
+                    keep.append(conn)
+            self._idle.extend(keep)
+            self._idle_gauge.set(len(self._idle))
+            for conn in expired:
+                await conn.logout()
+
+
+async def _call(conn: IMAPConnection, func: Callable[[IMAPConnection], Awaitable[T]], folder: Optional[str]) -> T:
+    if folder is not None:
+        await conn.select(folder)
+    return await func(conn)
+
+
+pool: IMAPPool | None = None
@@ -0,0 +1,621 @@
+# flake8: noqa
+import asyncio
+import re
+import ssl
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Optional
+
+from . import metrics, tracing
+
+LITERAL_RE = re.compile(rb"\{(\d+)\+?\}\r\n$")
+RESPONSE_CODE_RE = re.compile(r"^\[([^\]]*)\]\s*(.*)$", re.DOTALL)
+STATUS_KINDS = {"OK", "NO", "BAD", "BYE", "PREAUTH"}
+ATOM_SPECIALS = b' ()"{\r\n'
+# Large enough for long SEARCH/SORT result lines on big mailboxes.
+STREAM_LIMIT = 16 * 1024 * 1024
+
+
+class IMAPError(RuntimeError):
+    """The server answered a command with NO or BAD."""
+
+
+class IMAPAbort(IMAPError):
+    """The session failed and can no longer be used."""
+
+
+class Literal:
+    """A command argument that must be sent as an IMAP literal."""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+
+def quote(value: str) -> "str | Literal":
+    """Quote a string argument, falling back to a literal when required."""
+    if not value.isascii() or "\r" in value or "\n" in value:
+        return Literal(value.encode("utf-8"))
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+@dataclass
+class Untagged:
+    """A parsed untagged (``*``) response."""
+
+    kind: str
+    number: Optional[int] = None
+    data: list = field(default_factory=list)
+    text: str = ""
+    code: Optional[str] = None
+
+
+@dataclass
+class IMAPResponse:
+    """Completion of a tagged command along with the untagged data it produced."""
+
+    status: str
+    text: str
+    untagged: list[Untagged] = field(default_factory=list)
+    code: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "OK"
+
+    def check(self) -> "IMAPResponse":
+        if not self.ok:
+            raise IMAPError(f"{self.status} {self.text}".strip())
+        return self
+
+    def of_kind(self, kind: str) -> list[Untagged]:
+        return [item for item in self.untagged if item.kind == kind]
+
+
+@dataclass
+class MailboxState:
+    """What the server told us about the currently selected mailbox."""
+
+    name: str
+    exists: int = 0
+    uidvalidity: Optional[int] = None
+    uidnext: Optional[int] = None
+    highestmodseq: Optional[int] = None
+
+
+class _Parser:
+    """Tokenizer for IMAP response data.
+
+    Atoms and quoted strings become ``str``, literals ``bytes``, ``NIL``
+    ``None`` and parenthesised lists Python lists.
+    """
+
+    def __init__(self, data: bytes, pos: int = 0) -> None:
+        self.data = data
+        self.pos = pos
+
+    def parse_all(self) -> list:
+        items: list = []
+        while True:
+            self._skip_spaces()
+            if self.pos >= len(self.data) or self.data[self.pos:self.pos + 2] == b"\r\n":
+                return items
+            items.append(self._parse_item())
+
+    def _skip_spaces(self) -> None:
+        while self.pos < len(self.data) and self.data[self.pos] == 0x20:
+            self.pos += 1
+
+    def _parse_item(self) -> Any:
+        char = self.data[self.pos:self.pos + 1]
+        if char == b"(":
+            self.pos += 1
+            items: list = []
+            while True:
+                self._skip_spaces()
+                if self.pos >= len(self.data):
+                    raise IMAPError("Unterminated list in server response")
+                if self.data[self.pos:self.pos + 1] == b")":
+                    self.pos += 1
+                    return items
+                items.append(self._parse_item())
+        if char == b'"':
+            return self._parse_quoted()
+        if char == b"{":
+            return self._parse_literal()
+        return self._parse_atom()
+
+    def _parse_quoted(self) -> str:
+        self.pos += 1
+        out = bytearray()
+        while self.pos < len(self.data):
+            byte = self.data[self.pos]
+            if byte == 0x5C:  # backslash
+                out.append(self.data[self.pos + 1])
+                self.pos += 2
+                continue
+            if byte == 0x22:
+                self.pos += 1
+                return out.decode("utf-8", errors="replace")
+            out.append(byte)
+            self.pos += 1
+        raise IMAPError("Unterminated quoted string in server response")
+
+    def _parse_literal(self) -> bytes:
+        end = self.data.index(b"}", self.pos)
+        size = int(self.data[self.pos + 1:end].rstrip(b"+"))
+        start = end + 3  # skip "}\r\n"
+        self.pos = start + size
+        return self.data[start:self.pos]
+
+    def _parse_atom(self) -> Optional[str]:
+        start = self.pos
+        while self.pos < len(self.data):
+            byte = self.data[self.pos]
+            if byte == 0x5B:  # "[" - section specs like BODY[HEADER.FIELDS (A B)]
+                self.pos = self.data.index(b"]", self.pos) + 1
+                continue
+            if byte in ATOM_SPECIALS:
+                break
+            self.pos += 1
+        atom = self.data[start:self.pos].decode("utf-8", errors="replace")
+        if not atom:
+            raise IMAPError(f"Unexpected character in server response at offset {start}")
+        return None if atom.upper() == "NIL" else atom
+
+
+def parse_data(raw: bytes) -> list:
+    """Tokenize a fragment of IMAP response data."""
+    return _Parser(raw).parse_all()
+
+
+def parse_untagged(raw: bytes) -> Untagged:
+    """Parse a complete untagged response, literals included."""
+    parser = _Parser(raw, 2)  # skip "* "
+    first = parser._parse_atom() or ""
+    number = None
+    if first.isdigit():
+        number = int(first)
+        parser._skip_spaces()
+        first = parser._parse_atom() or ""
+    kind = first.upper()
+    parser._skip_spaces()
+    if kind in STATUS_KINDS:
+        text = raw[parser.pos:].decode("utf-8", errors="replace").rstrip("\r\n")
+        code, text = _split_code(text)
+        return Untagged(kind, number, text=text, code=code)
+    return Untagged(kind, number, data=parser.parse_all())
+
+
+def _split_code(text: str) -> tuple[Optional[str], str]:
+    match = RESPONSE_CODE_RE.match(text)
+    if match:
+        return match.group(1), match.group(2)
+    return None, text
+
+
+def parse_uid_set(value: str) -> list[int]:
+    """Expand a sequence set like ``1:3,7`` into ``[1, 2, 3, 7]``."""
+    uids: list[int] = []
+    for part in (value or "").split(","):
+        if not part:
+            continue
+        start, _, end = part.partition(":")
+        if end:
+            low, high = sorted((int(start), int(end)))
+            uids.extend(range(low, high + 1))
+        else:
+            uids.append(int(start))
+    return uids
+
+
+def _metric_label(name: str, args: tuple) -> str:
+    """Label commands by name, keeping the subcommand of ``UID`` (``UID FETCH``)."""
+    if name.upper() == "UID" and args:
+        return f"UID {str(args[0]).upper()}"
+    return name.upper()
+
+
+def _span_name(label: str) -> str:
+    """Server-Timing friendly span name for a command label (``imap.uid-fetch``)."""
+    return "imap." + label.lower().replace(" ", "-")
+
+
+def fetch_items(untagged: Untagged) -> dict[str, Any]:
+    """Turn a FETCH response into a dict keyed by upper-cased item name."""
+    if untagged.kind != "FETCH" or not untagged.data or not isinstance(untagged.data[0], list):
+        return {}
+    pairs = untagged.data[0]
+    return {str(pairs[i]).upper(): pairs[i + 1] for i in range(0, len(pairs) - 1, 2)}
+
+
+class IMAPConnection:
+    """A single IMAP session speaking the protocol directly on asyncio streams.
+
+    Commands are serialised per connection. If a command is cancelled or
+    times out part way through, the session is closed and marked broken, so
+    no work continues on the server's behalf and it is never reused.
+    """
+
+    def __init__(self, host: str, port: int, use_ssl: bool = True, timeout: Optional[float] = 30.0) -> None:
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.capabilities: set[str] = set()
+        self.enabled: set[str] = set()
+        self.selected: Optional[str] = None
+        self.mailbox: Optional[MailboxState] = None
+        self.untagged_handlers: list[Callable[[Untagged], None]] = []
+        self.broken = False
+        self.last_used = 0.0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+        self._tag_counter = 0
+
+    async def open(self) -> None:
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=ssl_context, limit=STREAM_LIMIT),
+                self.timeout,
+            )
+            greeting = parse_untagged(await asyncio.wait_for(self._read_response(), self.timeout))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as exc:
+            self.close()
+            raise IMAPAbort(f"Failed to connect to IMAP server: {exc}") from exc
+        if greeting.kind == "BYE":
+            self.close()
+            raise IMAPAbort(f"IMAP server refused connection: {greeting.text}")
+        self._update_capabilities(greeting.code)
+
+    async def login(self, username: str, password: str) -> None:
+        response = await self.command("LOGIN", quote(username), quote(password))
+        response.check()
+        if not self._update_capabilities(response.code):
+            await self.refresh_capabilities()
+
+    async def refresh_capabilities(self) -> None:
+        response = (await self.command("CAPABILITY")).check()
+        for item in response.of_kind("CAPABILITY"):
+            self.capabilities = {str(cap).upper() for cap in item.data}
+
+    def has_capability(self, name: str) -> bool:
+        return name.upper() in self.capabilities
+
+    async def enable(self, *extensions: str) -> None:
+        """Enable extensions (RFC 5161) that are not already enabled."""
+        wanted = [ext for ext in extensions if ext.upper() not in self.enabled]
+        if not wanted or not self.has_capability("ENABLE"):
+            return
+        response = (await self.command("ENABLE", *wanted)).check()
+        for item in response.of_kind("ENABLED"):
+            self.enabled.update(str(ext).upper() for ext in item.data)
+
+    async def select(
+        self,
+        folder: str,
+        readonly: bool = False,
+        params: Optional[str] = None,
+        force: bool = False,
+    ) -> MailboxState:
+        """Select ``folder`` unless it is already the selected mailbox.
+
+        ``params`` is appended verbatim, e.g. ``(CONDSTORE)``; ``force``
+        re-selects to obtain fresh UIDNEXT/HIGHESTMODSEQ values.
+        """
+        if not force and self.selected == folder and self.mailbox is not None:
+            return self.mailbox
+        self.selected = None
+        self.mailbox = MailboxState(folder)
+        args: list[Any] = [quote(folder)]
+        if params:
+            args.append(params)
+        response = await self.command("EXAMINE" if readonly else "SELECT", *args)
+        if not response.ok:
+            self.mailbox = None
+            raise IMAPError(f"Failed to select folder {folder}: {response.text}")
+        self.selected = folder
+        return self.mailbox
+
+    async def noop(self) -> bool:
+        """Return ``True`` if the server still answers on this session."""
+        try:
+            return (await self.command("NOOP")).ok
+        except IMAPAbort:
+            return False
+
+    async def uid(self, name: str, *args: Any, timeout: Optional[float] = None) -> IMAPResponse:
+        return await self.command("UID", name, *args, timeout=timeout)
+
+    async def append(self, folder: str, flags: str, date_time: str, message: bytes) -> IMAPResponse:
+        args: list[Any] = [quote(folder)]
+        if flags:
+            args.append(flags)
+        if date_time:
+            args.append(date_time)
+        args.append(Literal(message))
+        return await self.command("APPEND", *args)
+
+    async def logout(self) -> None:
+        if self._writer is None:
+            return
+        try:
+            if not self.broken:
+                await self.command("LOGOUT", timeout=5)
+        except IMAPError:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+        self.selected = None
+
+    async def command(self, name: str, *args: Any, timeout: Optional[float] = None) -> IMAPResponse:
+        """Send a tagged command and wait for its completion."""
+        label = _metric_label(name, args)
+        with (
+            tracing.span(_span_name(label)),
+            metrics.timed(metrics.IMAP_COMMAND_SECONDS, metrics.IMAP_COMMAND_ERRORS, label),
+        ):
+            response = await self._guarded(name, self._execute(name, args), timeout or self.timeout)
+        if not response.ok:
+            metrics.IMAP_COMMAND_ERRORS.labels(label).inc()
+        return response
+
+    async def pipeline(self, commands: list[tuple], timeout: Optional[float] = None) -> list[IMAPResponse]:
+        """Send ``(name, *args)`` commands back to back and return their completions in order.
+
+        Every command is written before any reply is read, so the batch costs
+        one round trip. Synchronising literals would stall the pipeline, so
+        literal arguments need LITERAL+. Each returned response carries all
+        untagged data received while the pipeline ran.
+        """
+        if not commands:
+            return []
+        if not self.has_capability("LITERAL+") and any(isinstance(arg, Literal) for command in commands for arg in command):
+            raise IMAPError("Pipelined commands cannot use literals without LITERAL+")
+        with (
+            tracing.span("imap.pipeline", commands=len(commands)),
+            metrics.timed(metrics.IMAP_COMMAND_SECONDS, metrics.IMAP_COMMAND_ERRORS, "PIPELINE"),
+        ):
+            return await self._guarded("pipeline", self._pipeline(commands), timeout or self.timeout)
+
+    async def stream(self, name: str, *args: Any, timeout: Optional[float] = None) -> AsyncIterator[Untagged]:
+        """Send a tagged command and yield its untagged responses as they arrive.
+
+        The connection stays locked until the iterator is exhausted and
+        ``timeout`` applies to each response rather than the whole command.
+        Abandoning the iterator early closes the connection, as the rest of
+        the reply can no longer be read in order. A non-OK completion raises
+        :class:`IMAPError`.
+        """
+        timeout = timeout or self.timeout
+        label = _metric_label(name, args)
+        async with self._lock:
+            if self.broken or self._writer is None:
+                raise IMAPAbort("IMAP connection is closed")
+            tag = self._next_tag()
+            finished = False
+            start = time.perf_counter()
+            try:
+                untagged: list[Untagged] = []
+                done = await asyncio.wait_for(self._send(tag, self._encode(tag, name, args), untagged), timeout)
+                while True:
+                    for item in untagged:
+                        yield item
+                    if done is not None:
+                        break
+                    untagged = []
+                    raw = await asyncio.wait_for(self._read_response(), timeout)
+                    done = self._handle(raw, tag, untagged)
+                finished = True
+            except asyncio.TimeoutError as exc:
+                raise IMAPAbort(f"IMAP command {name} timed out") from exc
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as exc:
+                raise IMAPAbort(f"IMAP connection lost: {exc}") from exc
+            finally:
+                metrics.IMAP_COMMAND_SECONDS.labels(label).observe(time.perf_counter() - start)
+                if not finished:
+                    metrics.IMAP_COMMAND_ERRORS.labels(label).inc()
+                    self._abandon()
+        if not done.ok:
+            metrics.IMAP_COMMAND_ERRORS.labels(label).inc()
+        done.check()
+
+    async def idle(self, duration: float) -> list[Untagged]:
+        """Run IDLE (RFC 2177) until the server reports something or ``duration`` passes.
+
+        Returns every untagged response received, including those sent
+        after DONE and before the command completed.
+        """
+        return (await self._guarded("IDLE", self._idle(duration), duration + (self.timeout or 0))).untagged
+
+    async def _guarded(self, name: str, operation, timeout: Optional[float]) -> IMAPResponse:
+        async with self._lock:
+            if self.broken or self._writer is None:
+                operation.close()
+                raise IMAPAbort("IMAP connection is closed")
+            try:
+                return await asyncio.wait_for(operation, timeout)
+            except asyncio.TimeoutError as exc:
+                self._abandon()
+                raise IMAPAbort(f"IMAP command {name} timed out") from exc
+            except (asyncio.CancelledError, IMAPAbort):
+                self._abandon()
+                raise
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as exc:
+                self._abandon()
+                raise IMAPAbort(f"IMAP connection lost: {exc}") from exc
+
+    async def _idle(self, duration: float) -> IMAPResponse:
+        tag = self._next_tag()
+        untagged: list[Untagged] = []
+        self._writer.write(tag + b" IDLE\r\n")
+        await self._writer.drain()
+        done = await self._wait_continuation(tag, untagged)
+        if done is not None:
+            return done
+        # Read in a task so the timeout never interrupts a response half way.
+        pending = asyncio.ensure_future(self._read_response())
+        try:
+            await asyncio.wait({pending}, timeout=duration)
+            self._writer.write(b"DONE\r\n")
+            await self._writer.drain()
+            raw = await pending
+        except BaseException:
+            pending.cancel()
+            raise
+        while True:
+            done = self._handle(raw, tag, untagged)
+            if done is not None:
+                return done
+            raw = await self._read_response()
+
+    def _abandon(self) -> None:
+        self.broken = True
+        self.close()
+
+    def _next_tag(self) -> bytes:
+        self._tag_counter += 1
+        return f"A{self._tag_counter:04d}".encode()
+
+    async def _execute(self, name: str, args: tuple) -> IMAPResponse:
+        tag = self._next_tag()
+        untagged: list[Untagged] = []
+        done = await self._send(tag, self._encode(tag, name, args), untagged)
+        if done is not None:
+            return done
+        while True:
+            raw = await self._read_response()
+            done = self._handle(raw, tag, untagged)
+            if done is not None:
+                return done
+
+    async def _pipeline(self, commands: list[tuple]) -> list[IMAPResponse]:
+        untagged: list[Untagged] = []
+        # Encode every command first so a bad argument fails before anything is written.
+        encoded = []
+        for name, *args in commands:
+            tag = self._next_tag()
+            encoded.append((tag, self._encode(tag, name, tuple(args))))
+        tags = [tag for tag, _ in encoded]
+        for tag, segments in encoded:
+            await self._send(tag, segments, untagged)
+        done: dict[bytes, IMAPResponse] = {}
+        while len(done) < len(tags):
+            raw = await self._read_response()
+            tag = raw.split(b" ", 1)[0]
+            if tag in tags:
+                done[tag] = self._handle(raw, tag, untagged)
+            else:
+                self._handle(raw, b"", untagged)
+        return [done[tag] for tag in tags]
+
+    async def _send(self, tag: bytes, segments: list, untagged: list[Untagged]) -> Optional[IMAPResponse]:
+        """Write an encoded command, waiting for continuations between literals.
+
+        Returns the completion if the server finished the command early.
+        """
+        non_sync = self.has_capability("LITERAL+")
+        for index, segment in enumerate(segments):
+            if isinstance(segment, Literal):
+                self._writer.write(segment.data)
+                continue
+            if index + 1 < len(segments):
+                size = len(segments[index + 1].data)
+                marker = f"{{{size}+}}\r\n" if non_sync else f"{{{size}}}\r\n"
+                self._writer.write(segment + marker.encode())
+                if not non_sync:
+                    await self._writer.drain()
+                    done = await self._wait_continuation(tag, untagged)
+                    if done is not None:
+                        return done
+            else:
+                self._writer.write(segment + b"\r\n")
+        await self._writer.drain()
+        return None
+
+    def _encode(self, tag: bytes, name: str, args: tuple) -> list:
+        segments: list = []
+        current = tag + b" " + name.encode()
+        for arg in args:
+            if isinstance(arg, Literal):
+                segments.append(current + b" ")
+                segments.append(arg)
+                current = b""
+                continue
+            piece = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            if b"\r" in piece or b"\n" in piece:
+                # A line break would end the command and start another one.
+                raise ValueError("IMAP command arguments cannot contain CR or LF; send them as a Literal")
+            current += b" " + piece
+        segments.append(current)
+        return segments
+
+    async def _wait_continuation(self, tag: bytes, untagged: list[Untagged]) -> Optional[IMAPResponse]:
+        while True:
+            raw = await self._read_response()
+            if raw.startswith(b"+"):
+                return None
+            done = self._handle(raw, tag, untagged)
+            if done is not None:
+                return done
+
+    def _handle(self, raw: bytes, tag: bytes, untagged: list[Untagged]) -> Optional[IMAPResponse]:
+        if raw.startswith(b"* "):
+            item = parse_untagged(raw)
+            self._dispatch(item)
+            untagged.append(item)
+            if item.kind == "BYE":
+                self.broken = True
+            return None
+        if raw.startswith(tag + b" "):
+            rest = raw[len(tag) + 1:].decode("utf-8", errors="replace").rstrip("\r\n")
+            status, _, text = rest.partition(" ")
+            code, text = _split_code(text)
+            return IMAPResponse(status.upper(), text, untagged, code)
+        if raw.startswith(b"+"):
+            # Stray continuation request; nothing is waiting on it.
+            return None
+        raise IMAPAbort(f"Unexpected IMAP response: {raw[:80]!r}")
+
+    def _dispatch(self, item: Untagged) -> None:
+        mailbox = self.mailbox
+        if mailbox is not None:
+            if item.kind == "EXISTS" and item.number is not None:
+                mailbox.exists = item.number
+            elif item.kind == "EXPUNGE" and mailbox.exists:
+                mailbox.exists -= 1
+            elif item.kind == "VANISHED" and item.data and item.data[0] is not None and not isinstance(item.data[0], list):
+                # VANISHED (EARLIER) only reports history, not a live expunge.
+                mailbox.exists = max(mailbox.exists - len(parse_uid_set(item.data[-1])), 0)
+            elif item.kind == "OK" and item.code:
+                key, _, value = item.code.partition(" ")
+                key = key.upper()
+                if key in ("UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ") and value.isdigit():
+                    setattr(mailbox, key.lower(), int(value))
+        if item.kind == "CAPABILITY":
+            self.capabilities = {str(cap).upper() for cap in item.data}
+        for handler in self.untagged_handlers:
+            handler(item)
+
+    def _update_capabilities(self, code: Optional[str]) -> bool:
+        if code and code.upper().startswith("CAPABILITY "):
+            self.capabilities = {cap.upper() for cap in code.split()[1:]}
+            return True
+        return False
+
+    async def _read_response(self) -> bytes:
+        chunks: list[bytes] = []
+        while True:
+            line = await self._reader.readuntil(b"\r\n")
+            chunks.append(line)
+            match = LITERAL_RE.search(line)
+            if match is None:
+                return b"".join(chunks)
+            chunks.append(await self._reader.readexactly(int(match.group(1))))
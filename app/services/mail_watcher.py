@@ -0,0 +1,114 @@
+# flake8: noqa
+import asyncio
+from typing import Optional
+
+from . import events, header_index, imap_client, imap_pool
+from .imap_protocol import IMAPConnection, Untagged, fetch_items, parse_uid_set
+
+NOTIFICATION_KINDS = {"EXISTS", "EXPUNGE", "FETCH", "VANISHED"}
+
+
+class MailWatcher:
+    """Background watcher holding one IDLE session per configured folder.
+
+    Servers without IDLE are polled with NOOP instead. Every notification is
+    published on the event bus and, when a header index is configured, the
+    folder is re-synced so listings are served from pre-fetched data, and
+    new bodies are added to the full-text index after the sync lock is
+    released.
+    """
+
+    def __init__(
+        self,
+        folders: list[str],
+        connection_kwargs: dict,
+        idle_timeout: float = 300.0,
+        poll_interval: float = 30.0,
+        retry_delay: float = 5.0,
+    ) -> None:
+        self.folders = folders
+        self.connection_kwargs = connection_kwargs
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._tasks: list[asyncio.Task] = []
+
+    @classmethod
+    def from_settings(cls, settings) -> "MailWatcher":
+        folders = [folder.strip() for folder in settings.watch_folders.split(",") if folder.strip()]
+        return cls(
+            folders,
+            imap_pool.connection_kwargs(settings),
+            idle_timeout=settings.watch_idle_timeout,
+            poll_interval=settings.watch_poll_interval,
+        )
+
+    async def start(self) -> None:
+        for folder in self.folders:
+            self._tasks.append(asyncio.create_task(self._run(folder)))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self, folder: str) -> None:
+        while True:
+            conn: Optional[IMAPConnection] = None
+            try:
+                conn = await imap_pool.open_connection(**self.connection_kwargs)
+                await self._watch(conn, folder)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Mail watcher for {folder} failed: {str(e)}")
+            finally:
+                if header_index.index is not None:
+                    header_index.index.live_folders.discard(folder)
+                if conn is not None:
+                    await conn.logout()
+            await asyncio.sleep(self.retry_delay)
+
+    async def _watch(self, conn: IMAPConnection, folder: str) -> None:
+        await self._sync(conn, folder)
+        index = header_index.index
+        if index is not None:
+            index.live_folders.add(folder)
+        while True:
+            if conn.has_capability("IDLE"):
+                received = await conn.idle(self.idle_timeout)
+            else:
+                await asyncio.sleep(self.poll_interval)
+                received = (await conn.command("NOOP")).check().untagged
+            notifications = [item for item in received if item.kind in NOTIFICATION_KINDS]
+            if not notifications:
+                continue
+            uidvalidity = conn.mailbox.uidvalidity if conn.mailbox is not None else None
+            for item in notifications:
+                events.bus.publish(_to_event(folder, item, uidvalidity))
+            await self._sync(conn, folder)
+
+    async def _sync(self, conn: IMAPConnection, folder: str) -> None:
+        index = header_index.index
+        if index is None:
+            await conn.select(folder, readonly=True)
+            return
+        async with index.sync_lock(folder):
+            await imap_client.sync_folder_index(conn, index, folder)
+        if index.fulltext:
+            await imap_client.index_bodies(conn, index, folder)
+
+
+def _to_event(folder: str, item: Untagged, uidvalidity: Optional[int]) -> events.MailEvent:
+    uids: list[int] = []
+    if item.kind == "FETCH":
+        uid = fetch_items(item).get("UID")
+        if uid:
+            uids.append(int(uid))
+    elif item.kind == "VANISHED" and item.data:
+        uids = parse_uid_set(item.data[-1])
+    return events.MailEvent(folder, item.kind.lower(), uids, uidvalidity, item.number)
+
+
+watcher: MailWatcher | None = None
@@ -0,0 +1,119 @@
+# flake8: noqa
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional
+
+from . import events, metrics
+
+# Rough per-entry bookkeeping cost added to the payload size.
+ENTRY_OVERHEAD = 256
+
+
+@dataclass
+class CachedMessage:
+    """What has been downloaded or decoded for one message so far."""
+
+    raw: Optional[bytes] = None
+    context: Any = None
+
+    @property
+    def size(self) -> int:
+        size = ENTRY_OVERHEAD + len(self.raw or b"")
+        if self.context is not None:
+            size += sum(len(value or "") for value in vars(self.context).values())
+        return size
+
+
+class MessageCache:
+    """Memory-bounded LRU of messages keyed by ``(folder, uidvalidity, uid)``.
+
+    A message can never change while its folder's UIDVALIDITY and its UID
+    stay the same, so entries need no revalidation; they only leave the
+    cache when evicted to stay under ``max_bytes`` or when an expunge is
+    published on the event bus. Each entry holds the raw message and/or
+    the decoded headers and body used by reply and forward. Hits, misses,
+    evictions and the cache's size are exported as ``message_cache_*``
+    metrics as well as through :meth:`stats`.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[tuple, CachedMessage] = OrderedDict()
+        self._hit_counter = metrics.MESSAGE_CACHE_LOOKUPS.labels("hit")
+        self._miss_counter = metrics.MESSAGE_CACHE_LOOKUPS.labels("miss")
+
+    @classmethod
+    def from_settings(cls, settings) -> "MessageCache":
+        return cls(settings.message_cache_max_bytes)
+
+    def start(self) -> None:
+        events.bus.add_listener(self.on_event)
+
+    def stop(self) -> None:
+        events.bus.remove_listener(self.on_event)
+
+    def on_event(self, event: events.MailEvent) -> None:
+        if event.kind in ("expunged", "vanished") and event.uidvalidity is not None:
+            self.discard(event.folder, event.uidvalidity, event.uids)
+
+    def get(self, folder: str, uidvalidity: int, uid: int) -> Optional[CachedMessage]:
+        entry = self._entries.get((folder, uidvalidity, uid))
+        if entry is None:
+            self.misses += 1
+            self._miss_counter.inc()
+            return None
+        self.hits += 1
+        self._hit_counter.inc()
+        self._entries.move_to_end((folder, uidvalidity, uid))
+        return entry
+
+    def put(self, folder: str, uidvalidity: int, uid: int, raw: Optional[bytes] = None, context: Any = None) -> None:
+        """Store ``raw`` and/or ``context``, keeping whatever the entry already had."""
+        key = (folder, uidvalidity, uid)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+        else:
+            entry = CachedMessage()
+        if raw is not None:
+            entry.raw = raw
+        if context is not None:
+            entry.context = context
+        if entry.size > self.max_bytes:
+            self._update_size()
+            return
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+            self.evictions += 1
+            metrics.MESSAGE_CACHE_EVICTIONS.inc()
+        self._update_size()
+
+    def discard(self, folder: str, uidvalidity: int, uids: Iterable[int]) -> None:
+        for uid in uids:
+            entry = self._entries.pop((folder, uidvalidity, int(uid)), None)
+            if entry is not None:
+                self.total_bytes -= entry.size
+        self._update_size()
+
+    def _update_size(self) -> None:
+        metrics.MESSAGE_CACHE_BYTES.set(self.total_bytes)
+        metrics.MESSAGE_CACHE_ENTRIES.set(len(self._entries))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+cache: MessageCache | None = None
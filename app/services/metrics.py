@@ -0,0 +1,114 @@
+# flake8: noqa
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# Network round trips: sub-millisecond pipelined commands up to slow fetches.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 4194304, 10485760, 20971520)
+
+IMAP_COMMAND_SECONDS = Histogram(
+    "imap_command_seconds", "IMAP command round trip time.", ["command"], buckets=LATENCY_BUCKETS
+)
+IMAP_COMMAND_ERRORS = Counter(
+    "imap_command_errors_total", "IMAP commands that failed or completed with NO/BAD.", ["command"]
+)
+SMTP_SECONDS = Histogram(
+    "smtp_operation_seconds", "SMTP connect, auth and message transaction time.", ["operation"], buckets=LATENCY_BUCKETS
+)
+SMTP_ERRORS = Counter("smtp_operation_errors_total", "SMTP operations that raised.", ["operation"])
+DOWNLOAD_SECONDS = Histogram(
+    "attachment_download_seconds", "Attachment download time, including revalidation.", buckets=LATENCY_BUCKETS
+)
+DOWNLOAD_BYTES = Histogram("attachment_download_bytes", "Attachment bytes written per download.", buckets=SIZE_BUCKETS)
+DOWNLOAD_ERRORS = Counter("attachment_download_errors_total", "Attachment downloads that failed.")
+MIME_BUILD_SECONDS = Histogram(
+    "mime_build_seconds", "Time spent assembling outgoing MIME messages.", ["mode"], buckets=LATENCY_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "HTTP request latency by route template.", ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+# Gauges are per process; "livesum" adds up the live workers when scraped.
+POOL_SESSIONS = Gauge(
+    "pool_sessions", "Pooled sessions by pool and state.", ["pool", "state"], multiprocess_mode="livesum"
+)
+OUTBOX_QUEUE_DEPTH = Gauge("outbox_queue_depth", "Jobs waiting for an outbox worker.", multiprocess_mode="livesum")
+MESSAGE_CACHE_LOOKUPS = Counter("message_cache_lookups_total", "Message cache lookups by result.", ["result"])
+MESSAGE_CACHE_EVICTIONS = Counter("message_cache_evictions_total", "Message cache entries evicted to stay under the byte limit.")
+MESSAGE_CACHE_BYTES = Gauge("message_cache_bytes", "Bytes held by the message cache.", multiprocess_mode="livesum")
+MESSAGE_CACHE_ENTRIES = Gauge("message_cache_entries", "Messages held by the message cache.", multiprocess_mode="livesum")
+
+
+def multiprocess_enabled() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+@contextmanager
+def timed(histogram, errors=None, *labels: str) -> Iterator[None]:
+    """Observe the block's duration on ``histogram`` and count it on ``errors`` when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            (errors.labels(*labels) if labels else errors).inc()
+        raise
+    finally:
+        (histogram.labels(*labels) if labels else histogram).observe(time.perf_counter() - start)
+
+
+def render() -> tuple[bytes, str]:
+    """Return the exposition text and its content type.
+
+    With ``PROMETHEUS_MULTIPROC_DIR`` set, every uvicorn worker writes its
+    samples to that directory and a scrape of any worker reports the sum
+    across all of them.
+    """
+    if multiprocess_enabled():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: Optional[int] = None) -> None:
+    """Drop this worker's live gauges from the multiprocess directory."""
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording ``REQUEST_SECONDS`` per matched route.
+
+    Routes are labelled with their path template so UIDs and job IDs do
+    not create new series; requests that match no route share one label.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.labels(
+                scope["method"], getattr(route, "path", "unmatched"), str(status)
+            ).observe(time.perf_counter() - start)
@@ -0,0 +1,172 @@
+# flake8: noqa
+import base64
+import email.policy
+import io
+import math
+import os
+import secrets
+from dataclasses import dataclass
+from email.generator import BytesGenerator
+from email.message import Message
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from typing import AsyncIterator, Union
+
+import aiofiles
+
+# Raw bytes read per chunk: a multiple of 57, so every chunk encodes to
+# whole 76-character base64 lines and chunks always end on a line break.
+CHUNK_SIZE = 57 * 1024
+
+POLICY = email.policy.compat32.clone(linesep="\r\n")
+
+# Bytes of an already encoded file read per chunk: whole lines of 76
+# characters plus their newline, so chunks always end on a line break.
+ENCODED_CHUNK_SIZE = 77 * 1024
+
+# Headers that never go on the wire.
+HIDDEN_HEADERS = {"bcc", "resent-bcc"}
+
+
+@dataclass
+class _Encoded:
+    """A file that already holds base64 lines ending in ``\n``."""
+
+    path: str
+
+
+def encoded_length(size: int) -> int:
+    """Length of ``size`` bytes encoded as CRLF-terminated 76-character base64 lines."""
+    lines, rest = divmod(size, 57)
+    total = lines * 78
+    if rest:
+        total += 4 * math.ceil(rest / 3) + 2
+    return total
+
+
+def _render(part: Message) -> bytes:
+    with io.BytesIO() as buffer:
+        BytesGenerator(buffer, mangle_from_=False, policy=POLICY).flatten(part)
+        return buffer.getvalue()
+
+
+def _headers(message: Message) -> bytes:
+    folded = b"".join(
+        POLICY.fold_binary(name, value) for name, value in message.items() if name.lower() not in HIDDEN_HEADERS
+    )
+    return folded + b"\r\n"
+
+
+class StreamingMessage:
+    """A multipart message whose attachments are encoded from disk as it is written.
+
+    ``headers`` holds the envelope headers and any small inline parts such
+    as the HTML body. Attachments added with ``attach_file`` are read and
+    base64-encoded one ``CHUNK_SIZE`` block at a time by ``chunks``, and
+    those added with ``attach_encoded`` are copied in blocks, so writing
+    the message never holds more than one block of any file.
+    """
+
+    def __init__(self, headers: MIMEMultipart) -> None:
+        self.headers = headers
+        self.boundary = "===============" + secrets.token_hex(12) + "=="
+        headers.set_boundary(self.boundary)
+        self._parts: list[tuple[Message, Union[str, _Encoded, None]]] = [(part, None) for part in headers.get_payload()]
+
+    def _attachment(self, filename: str, main_type: str, sub_type: str) -> MIMEBase:
+        part = MIMEBase(main_type, sub_type)
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header("Content-Disposition", f"attachment; filename={filename}")
+        return part
+
+    def attach_file(self, filename: str, main_type: str, sub_type: str, path: str) -> None:
+        """Attach the file at ``path``, which must exist until the message is sent."""
+        self._parts.append((self._attachment(filename, main_type, sub_type), path))
+
+    def attach_encoded(self, filename: str, main_type: str, sub_type: str, path: str) -> None:
+        """Attach the file at ``path``, which already holds the base64-encoded payload."""
+        self._parts.append((self._attachment(filename, main_type, sub_type), _Encoded(path)))
+
+    def __len__(self) -> int:
+        """Exact number of bytes ``chunks`` yields."""
+        delimiter = len(self.boundary) + 6
+        total = len(_headers(self.headers)) + delimiter - 2 + (len(self._parts) - 1) * delimiter + delimiter + 2
+        for part, source in self._parts:
+            if source is None:
+                total += len(_render(part))
+            elif isinstance(source, _Encoded):
+                size = os.path.getsize(source.path)
+                # Every line gains a carriage return.
+                total += len(_headers(part)) + size + math.ceil(size / 77)
+            else:
+                total += len(_headers(part)) + encoded_length(os.path.getsize(source))
+        return total
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """Yield the message with CRLF line endings, each chunk ending on a line break."""
+        boundary = self.boundary.encode("ascii")
+        # Headers, delimiters and inline parts are gathered until the next
+        # attachment so that every chunk starts and ends on a line boundary.
+        head = _headers(self.headers)
+        for index, (part, source) in enumerate(self._parts):
+            head += (b"--" if index == 0 else b"\r\n--") + boundary + b"\r\n"
+            if source is None:
+                head += _render(part)
+                continue
+            yield head + _headers(part)
+            head = b""
+            if isinstance(source, _Encoded):
+                async with aiofiles.open(source.path, "rb") as file:
+                    while True:
+                        data = await file.read(ENCODED_CHUNK_SIZE)
+                        if not data:
+                            break
+                        yield data.replace(b"\n", b"\r\n")
+            else:
+                async with aiofiles.open(source, "rb") as file:
+                    while True:
+                        data = await file.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        yield base64.encodebytes(data).replace(b"\n", b"\r\n")
+        yield head + b"\r\n--" + boundary + b"--\r\n"
+
+    async def read(self) -> bytes:
+        """Render the whole message into memory."""
+        return b"".join([chunk async for chunk in self.chunks()])
+
+
+class RenderedFile:
+    """A message already rendered to ``path``, written out like ``StreamingMessage``.
+
+    Used to replay spooled messages. The file holds the exact bytes of
+    the message with CRLF line endings; ``chunks`` reads it one block at a
+    time and cuts every chunk at a line break. The envelope is not in the
+    file (Bcc is never rendered), so senders pass it separately.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def __len__(self) -> int:
+        return os.path.getsize(self.path)
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        rest = b""
+        async with aiofiles.open(self.path, "rb") as file:
+            while True:
+                data = await file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                data = rest + data
+                end = data.rfind(b"\n") + 1
+                if end:
+                    yield data[:end]
+                rest = data[end:]
+        if rest:
+            yield rest
+
+    async def read(self) -> bytes:
+        """Load the whole message into memory."""
+        async with aiofiles.open(self.path, "rb") as file:
+            return await file.read()
@@ -0,0 +1,267 @@
+# flake8: noqa
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+from fastapi import HTTPException
+
+from .. import dependencies
+from ..models import SendEmailRequest
+from . import metrics, smtp_pool, spool
+
+QUEUED = "queued"
+SENDING = "sending"
+RETRYING = "retrying"
+SENT = "sent"
+FAILED = "failed"
+
+
+class OutboxFull(RuntimeError):
+    """Raised when the outbound queue cannot take another job."""
+
+
+@dataclass
+class Job:
+    """An email accepted for background delivery."""
+
+    request: SendEmailRequest
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    attempts: int = 0
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    next_attempt_at: Optional[float] = None
+    last_error: Optional[str] = None
+    smtp_response: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (SENT, FAILED)
+
+
+def is_permanent(exc: Exception) -> bool:
+    """Whether retrying ``exc`` can never succeed."""
+    if isinstance(exc, HTTPException):
+        return exc.status_code < 500
+    return smtp_pool.is_permanent(exc)
+
+
+def _error_text(exc: Exception) -> str:
+    return str(exc.detail) if isinstance(exc, HTTPException) else str(exc)
+
+
+def _job_from_spool(record: spool.SpoolJob) -> Job:
+    if record.status in (spool.SENT, spool.FAILED):
+        status = SENT if record.status == spool.SENT else FAILED
+    elif record.attempts == 0:
+        status = QUEUED
+    elif record.owner is None:
+        status = RETRYING
+    else:
+        status = SENDING
+    return Job(
+        SendEmailRequest.model_validate_json(record.request),
+        id=record.id,
+        status=status,
+        attempts=record.attempts,
+        created_at=record.created_at,
+        updated_at=record.updated_at,
+        next_attempt_at=record.lease_expires if status == RETRYING else None,
+        last_error=record.last_error,
+        smtp_response=record.smtp_response,
+    )
+
+
+class Outbox:
+    """Queue of emails delivered by a bounded set of workers.
+
+    Failed deliveries are retried with exponential backoff until
+    ``max_attempts`` is reached or the failure is permanent (a 5xx SMTP
+    reply or a rejected attachment).
+
+    Without a ``journal`` jobs live in this process: finished ones are kept
+    for ``job_ttl`` seconds so their status can be looked up, and queued
+    ones are lost if it exits. With one, each job is written to the spool
+    before it is accepted and its status is read back from there, so every
+    worker sharing the spool can report it. A retry is scheduled by
+    releasing the job's lease until its backoff has passed; each process
+    claims due jobs every ``poll_interval`` seconds, including those left
+    behind by a process that died.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        max_attempts: int = 5,
+        backoff_base: float = 2.0,
+        backoff_max: float = 300.0,
+        queue_size: int = 1000,
+        job_ttl: float = 3600.0,
+        journal: Optional[spool.Spool] = None,
+        poll_interval: float = 1.0,
+    ) -> None:
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_size = queue_size
+        self.job_ttl = job_ttl
+        self.journal = journal
+        self.poll_interval = poll_interval
+        self.jobs: dict[str, Job] = {}
+        # Journaled jobs this process holds a lease on, with the attempts made so far.
+        self._held: dict[str, tuple[SendEmailRequest, int]] = {}
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._timers: set[asyncio.Task] = set()
+
+    @classmethod
+    def from_settings(cls, settings, journal: Optional[spool.Spool] = None) -> "Outbox":
+        return cls(
+            workers=settings.outbox_workers,
+            max_attempts=settings.outbox_max_attempts,
+            backoff_base=settings.outbox_backoff_base,
+            backoff_max=settings.outbox_backoff_max,
+            queue_size=settings.outbox_queue_size,
+            journal=journal,
+            poll_interval=settings.outbox_poll_interval,
+        )
+
+    async def start(self) -> None:
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._work()))
+        if self.journal is not None and self.workers > 0:
+            self._tasks.append(asyncio.create_task(self._claim_loop()))
+
+    async def stop(self) -> None:
+        for task in [*self._tasks, *self._timers]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._timers, return_exceptions=True)
+        self._tasks = []
+        self._timers = set()
+
+    def pending(self) -> int:
+        if self.journal is not None:
+            return len(self._held)
+        return sum(not job.finished for job in self.jobs.values())
+
+    async def submit(self, request: SendEmailRequest) -> Job:
+        self._prune()
+        if self.pending() >= self.queue_size:
+            raise OutboxFull("Outbound queue is full")
+        job = Job(request)
+        if self.journal is not None:
+            job.id = await self.journal.add_job(request.model_dump_json())
+            self._held[job.id] = (request, 0)
+        else:
+            self.jobs[job.id] = job
+        self._queue.put_nowait(job.id)
+        metrics.OUTBOX_QUEUE_DEPTH.set(self._queue.qsize())
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        if self.journal is not None:
+            record = await self.journal.job(job_id)
+            return _job_from_spool(record) if record is not None else None
+        return self.jobs.get(job_id)
+
+    def backoff(self, attempts: int) -> float:
+        return min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.job_ttl
+        for job_id in [job.id for job in self.jobs.values() if job.finished and job.updated_at < cutoff]:
+            del self.jobs[job_id]
+
+    async def _work(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            metrics.OUTBOX_QUEUE_DEPTH.set(self._queue.qsize())
+            if self.journal is not None:
+                await self._attempt_journaled(job_id)
+                continue
+            job = self.jobs.get(job_id)
+            if job is not None:
+                await self._attempt(job)
+
+    async def _claim_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            free = min(self.workers - self._queue.qsize(), self.queue_size - self.pending())
+            if free <= 0:
+                continue
+            try:
+                entries = await self.journal.claim(free, jobs=True)
+            except Exception as exc:
+                print(f"Outbox claim failed: {exc}")
+                continue
+            for entry in entries:
+                if entry.id in self._held:
+                    # Still waiting here past its lease; it is queued already.
+                    continue
+                self._held[entry.id] = (SendEmailRequest.model_validate_json(entry.request), entry.attempts)
+                self._queue.put_nowait(entry.id)
+            metrics.OUTBOX_QUEUE_DEPTH.set(self._queue.qsize())
+
+    async def _send(self, request: SendEmailRequest) -> str:
+        file_urls = [str(url) for url in request.file_url] if request.file_url else None
+        async with dependencies.compose_email(
+            request.to_addresses, request.subject, request.body, file_urls=file_urls
+        ) as msg:
+            if self.journal is not None:
+                # The job's own entry tracks the message.
+                return await dependencies.smtp_send(msg, journal=False)
+            return await dependencies.smtp_send(msg)
+
+    async def _attempt_journaled(self, job_id: str) -> None:
+        request, attempts = self._held[job_id]
+        try:
+            if not await self.journal.begin(job_id):
+                # Our lease expired while the job waited and another process took it.
+                return
+            attempts += 1
+            try:
+                reply = await self._send(request)
+            except Exception as e:
+                if is_permanent(e) or attempts >= self.max_attempts:
+                    await self.journal.mark_failed(job_id, _error_text(e))
+                else:
+                    await self.journal.release(job_id, _error_text(e), self.backoff(attempts))
+                return
+            await self.journal.mark_sent(job_id, reply)
+        finally:
+            del self._held[job_id]
+
+    async def _attempt(self, job: Job) -> None:
+        job.status = SENDING
+        job.attempts += 1
+        job.next_attempt_at = None
+        job.updated_at = time.time()
+        try:
+            job.smtp_response = await self._send(job.request)
+        except Exception as e:
+            job.last_error = _error_text(e)
+            job.updated_at = time.time()
+            if is_permanent(e) or job.attempts >= self.max_attempts:
+                job.status = FAILED
+                return
+            job.status = RETRYING
+            delay = self.backoff(job.attempts)
+            job.next_attempt_at = time.time() + delay
+            timer = asyncio.create_task(self._requeue(job.id, delay))
+            self._timers.add(timer)
+            timer.add_done_callback(self._timers.discard)
+            return
+        job.status = SENT
+        job.last_error = None
+        job.updated_at = time.time()
+
+    async def _requeue(self, job_id: str, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(job_id)
+        metrics.OUTBOX_QUEUE_DEPTH.set(self._queue.qsize())
+
+
+outbox: Outbox | None = None
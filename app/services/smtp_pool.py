@@ -0,0 +1,596 @@
+# flake8: noqa
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from email.message import Message
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+import aiosmtplib
+from aiosmtplib import SMTPResponse, SMTPStatus
+from aiosmtplib.email import extract_recipients, extract_sender, flatten_message, quote_address
+from aiosmtplib.protocol import LINE_ENDINGS_REGEX, PERIOD_REGEX
+
+from . import metrics, tracing
+
+# Errors that indicate the underlying session is unusable and must be replaced.
+CONNECTION_ERRORS = (aiosmtplib.SMTPServerDisconnected, OSError)
+
+# "Service not available, closing transmission channel" (RFC 5321).
+SERVICE_CLOSING = 421
+
+
+def is_connection_error(exc: BaseException) -> bool:
+    if isinstance(exc, CONNECTION_ERRORS):
+        return True
+    return isinstance(exc, aiosmtplib.SMTPResponseException) and exc.code == SERVICE_CLOSING
+
+
+def is_permanent(exc: BaseException) -> bool:
+    """Whether the server rejected the message for good (a 5xx reply)."""
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return all(error.code >= 500 for error in exc.recipients)
+    if isinstance(exc, aiosmtplib.SMTPResponseException):
+        return exc.code >= 500
+    return isinstance(exc, (aiosmtplib.SMTPNotSupported, ValueError))
+
+
+async def open_connection(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    start_tls: bool = True,
+    timeout: Optional[float] = 60.0,
+) -> aiosmtplib.SMTP:
+    """Connect, negotiate STARTTLS, and authenticate, returning a ready session."""
+    smtp = aiosmtplib.SMTP(hostname=host, port=port, start_tls=start_tls, timeout=timeout)
+    with tracing.span("smtp.connect"), metrics.timed(metrics.SMTP_SECONDS, metrics.SMTP_ERRORS, "connect"):
+        await smtp.connect()
+    try:
+        with tracing.span("smtp.auth"), metrics.timed(metrics.SMTP_SECONDS, metrics.SMTP_ERRORS, "auth"):
+            await smtp.login(username, password)
+    except Exception:
+        smtp.close()
+        raise
+    return smtp
+
+
+async def _transaction(send: Awaitable):
+    """Await one message transaction, from MAIL FROM to the final reply, timing it."""
+    with tracing.span("smtp.data"), metrics.timed(metrics.SMTP_SECONDS, metrics.SMTP_ERRORS, "data"):
+        return await send
+
+
+@contextmanager
+def _keep_early_replies(protocol):
+    """Buffer replies that arrive while no read is pending.
+
+    aiosmtplib's protocol drops data received after its response waiter has
+    resolved but before the next read starts, which is exactly when the
+    later replies of a pipelined group arrive in separate packets.
+    """
+    original = protocol.data_received
+
+    def data_received(data: bytes) -> None:
+        waiter = protocol._response_waiter
+        if waiter is not None and waiter.done():
+            protocol._buffer.extend(data)
+        else:
+            original(data)
+
+    protocol.data_received = data_received
+    try:
+        yield
+    finally:
+        del protocol.data_received
+
+
+def _ends_message(data: bytes) -> bool:
+    """Whether a write completes a message: the DATA terminator or the last BDAT chunk."""
+    if data.startswith(b"BDAT "):
+        return data.split(b"\r\n", 1)[0].endswith(b" LAST")
+    return data == b".\r\n" or data.endswith(b"\r\n.\r\n")
+
+
+class _Transmission:
+    """Whether the whole message has been written to the server."""
+
+    complete = False
+
+    def may_have_delivered(self, exc: BaseException) -> bool:
+        """Whether ``exc`` left the message's fate unknown.
+
+        After the end of the message has been written, a dropped connection
+        may have lost the server's acceptance rather than the message, so
+        resending could deliver it twice. A reply such as 421 means it was
+        not accepted.
+        """
+        return self.complete and not isinstance(exc, aiosmtplib.SMTPResponseException)
+
+
+@contextmanager
+def _track_end_of_data(smtp: aiosmtplib.SMTP) -> Iterator[_Transmission]:
+    """Watch the session's writes, covering aiosmtplib's own DATA as well as ours."""
+    transmission = _Transmission()
+    protocol = getattr(smtp, "protocol", None)
+    if protocol is None:
+        yield transmission
+        return
+    original = protocol.write
+
+    def write(data: bytes) -> None:
+        original(data)
+        if _ends_message(data):
+            transmission.complete = True
+
+    protocol.write = write
+    try:
+        yield transmission
+    finally:
+        del protocol.write
+
+
+async def _next_reply(protocol, timeout: Optional[float]) -> SMTPResponse:
+    buffered = protocol._read_response_from_buffer()
+    if buffered is not None:
+        return buffered
+    return await protocol.read_response(timeout=timeout)
+
+
+def _mail_from(smtp: aiosmtplib.SMTP, sender: str, size: Optional[int]) -> str:
+    options: list[str] = []
+    if size is not None and smtp.supports_extension("size"):
+        options.append(f"SIZE={size}")
+    if smtp.supports_extension("8bitmime"):
+        options.append("BODY=8BITMIME")
+    return " ".join([f"MAIL FROM:{quote_address(sender)}", *options])
+
+
+async def _exchange(protocol, commands: list[str], pipelined: bool, timeout: Optional[float]) -> list[SMTPResponse]:
+    """Send ``commands`` in one write when ``pipelined``, otherwise one at a time."""
+    if pipelined:
+        protocol.write("".join(f"{command}\r\n" for command in commands).encode("ascii"))
+        return [await _next_reply(protocol, timeout) for _ in commands]
+    replies = []
+    for command in commands:
+        protocol.write(f"{command}\r\n".encode("ascii"))
+        replies.append(await _next_reply(protocol, timeout))
+    return replies
+
+
+def _refused(recipients: list[str], replies: list[SMTPResponse]) -> list[aiosmtplib.SMTPRecipientRefused]:
+    return [
+        aiosmtplib.SMTPRecipientRefused(reply.code, reply.message, recipient)
+        for recipient, reply in zip(recipients, replies)
+        if reply.code not in (SMTPStatus.completed, SMTPStatus.will_forward)
+    ]
+
+
+def _check_envelope(sender: str, recipients: list[str], mail_reply: SMTPResponse, refused: list) -> None:
+    if mail_reply.code != SMTPStatus.completed:
+        raise aiosmtplib.SMTPSenderRefused(mail_reply.code, mail_reply.message, sender)
+    if len(refused) == len(recipients):
+        raise aiosmtplib.SMTPRecipientsRefused(refused)
+
+
+async def send_message(smtp: aiosmtplib.SMTP, message: Message) -> tuple[dict, str]:
+    """Send ``message``, pipelining its envelope (RFC 2920) when advertised.
+
+    MAIL FROM, every RCPT TO and DATA go out in one write and their replies
+    are read back together, so the envelope costs a single round trip.
+    Returns the same ``(refused recipients, reply)`` pair as
+    ``SMTP.send_message``, which is used when PIPELINING is unavailable or
+    an address needs SMTPUTF8.
+    """
+    if smtp.is_ehlo_or_helo_needed:
+        await smtp.ehlo()
+    sender = extract_sender(message)
+    recipients = extract_recipients(message)
+    if not smtp.supports_extension("pipelining") or not sender or not recipients:
+        return await smtp.send_message(message)
+    if not all(address.isascii() for address in (sender, *recipients)):
+        return await smtp.send_message(message)
+
+    cte_type = "8bit" if smtp.supports_extension("8bitmime") else "7bit"
+    data = flatten_message(message, cte_type=cte_type)
+    commands = [_mail_from(smtp, sender, len(data))]
+    commands += [f"RCPT TO:{quote_address(recipient)}" for recipient in recipients]
+    commands.append("DATA")
+
+    protocol = getattr(smtp, "protocol", None)
+    if protocol is None:
+        raise aiosmtplib.SMTPServerDisconnected("Server not connected")
+    with _keep_early_replies(protocol):
+        replies = await _exchange(protocol, commands, True, smtp.timeout)
+        mail_reply, data_reply = replies[0], replies[-1]
+        if data_reply.code == SMTPStatus.start_input:
+            data = PERIOD_REGEX.sub(b"..", LINE_ENDINGS_REGEX.sub(b"\r\n", data))
+            if not data.endswith(b"\r\n"):
+                data += b"\r\n"
+            protocol.write(data + b".\r\n")
+            data_reply = await _next_reply(protocol, smtp.timeout)
+    refused = _refused(recipients, replies[1:-1])
+    _check_envelope(sender, recipients, mail_reply, refused)
+    if data_reply.code != SMTPStatus.completed:
+        raise aiosmtplib.SMTPDataError(data_reply.code, data_reply.message)
+    return {error.recipient: SMTPResponse(error.code, error.message) for error in refused}, data_reply.message
+
+
+async def send_stream(
+    smtp: aiosmtplib.SMTP, message, sender: Optional[str] = None, recipients: Optional[list[str]] = None
+) -> tuple[dict, str]:
+    """Send a ``StreamingMessage`` without rendering it into memory.
+
+    Chunks are written as they are produced, waiting for the socket to
+    drain between them. With CHUNKING (RFC 3030) each chunk goes out as a
+    BDAT command; otherwise the message is dot-stuffed into DATA. The
+    envelope comes from the message's headers unless ``sender`` and
+    ``recipients`` are given, as for a ``RenderedFile``. Returns the same
+    ``(refused recipients, reply)`` pair as ``send_message``.
+    """
+    if smtp.is_ehlo_or_helo_needed:
+        await smtp.ehlo()
+    if sender is None:
+        sender = extract_sender(message.headers)
+    if recipients is None:
+        recipients = extract_recipients(message.headers)
+    if not sender or not recipients or not all(address.isascii() for address in (sender, *recipients)):
+        # Let aiosmtplib handle SMTPUTF8 and report missing addresses.
+        return await smtp.sendmail(sender or "", recipients, await message.read())
+
+    protocol = getattr(smtp, "protocol", None)
+    if protocol is None:
+        raise aiosmtplib.SMTPServerDisconnected("Server not connected")
+    pipelined = smtp.supports_extension("pipelining")
+    chunking = smtp.supports_extension("chunking")
+    commands = [_mail_from(smtp, sender, len(message))]
+    commands += [f"RCPT TO:{quote_address(recipient)}" for recipient in recipients]
+    if not chunking:
+        commands.append("DATA")
+
+    with _keep_early_replies(protocol):
+        replies = await _exchange(protocol, commands, pipelined, smtp.timeout)
+        mail_reply = replies[0]
+        refused = _refused(recipients, replies[1 : len(recipients) + 1])
+        if chunking:
+            _check_envelope(sender, recipients, mail_reply, refused)
+            data_reply = await _write_bdat(protocol, message, pipelined, smtp.timeout)
+        else:
+            data_reply = replies[-1]
+            if data_reply.code == SMTPStatus.start_input:
+                async for chunk in message.chunks():
+                    protocol.write(PERIOD_REGEX.sub(b"..", LINE_ENDINGS_REGEX.sub(b"\r\n", chunk)))
+                    await protocol._drain_helper()
+                protocol.write(b".\r\n")
+                data_reply = await _next_reply(protocol, smtp.timeout)
+            _check_envelope(sender, recipients, mail_reply, refused)
+    if data_reply.code != SMTPStatus.completed:
+        raise aiosmtplib.SMTPDataError(data_reply.code, data_reply.message)
+    return {error.recipient: SMTPResponse(error.code, error.message) for error in refused}, data_reply.message
+
+
+async def _write_bdat(protocol, message, pipelined: bool, timeout: Optional[float]) -> SMTPResponse:
+    """Send ``message`` as BDAT chunks, returning the first failure or the final reply."""
+    replies: list[SMTPResponse] = []
+    outstanding = 0
+
+    async def send(chunk: bytes, last: bool) -> None:
+        nonlocal outstanding
+        command = f"BDAT {len(chunk)}{' LAST' if last else ''}\r\n".encode("ascii")
+        protocol.write(command + chunk)
+        await protocol._drain_helper()
+        if pipelined:
+            outstanding += 1
+            return
+        reply = await _next_reply(protocol, timeout)
+        if reply.code != SMTPStatus.completed:
+            raise aiosmtplib.SMTPDataError(reply.code, reply.message)
+        replies.append(reply)
+
+    previous: Optional[bytes] = None
+    async for chunk in message.chunks():
+        if previous is not None:
+            await send(previous, last=False)
+        previous = chunk
+    await send(previous or b"", last=True)
+    for _ in range(outstanding):
+        replies.append(await _next_reply(protocol, timeout))
+    return next((reply for reply in replies if reply.code != SMTPStatus.completed), replies[-1])
+
+
+def connection_kwargs(settings) -> dict:
+    return {
+        "host": settings.account_smtp_server,
+        "port": settings.account_smtp_port,
+        "username": settings.account_email,
+        "password": settings.account_password,
+        "start_tls": settings.start_tls,
+        "timeout": settings.smtp_timeout,
+    }
+
+
+class PooledSMTP:
+    """An SMTP session with the bookkeeping the pool needs to retire it."""
+
+    def __init__(self, smtp: aiosmtplib.SMTP) -> None:
+        self.smtp = smtp
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.messages = 0
+        self.broken = False
+
+    async def quit(self) -> None:
+        try:
+            if self.smtp.is_connected:
+                await self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+
+
+class SMTPPool:
+    """Bounded pool of authenticated SMTP sessions.
+
+    A reused session is reset with RSET before its next message, which also
+    proves it is still alive. Sessions are retired after ``max_lifetime``
+    seconds or ``max_messages`` messages, evicted after sitting idle for
+    ``idle_timeout``, and replaced when the server disconnects or answers
+    421. Closing the pool waits for in-flight sends before quitting.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        size: int = 2,
+        max_lifetime: float = 300.0,
+        max_messages: int = 100,
+        idle_timeout: float = 60.0,
+        start_tls: bool = True,
+        timeout: Optional[float] = 60.0,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.start_tls = start_tls
+        self.timeout = timeout
+        self._idle: deque[PooledSMTP] = deque()
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle_gauge = metrics.POOL_SESSIONS.labels("smtp", "idle")
+        self._in_use_gauge = metrics.POOL_SESSIONS.labels("smtp", "in_use")
+        self._reaper: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @classmethod
+    def from_settings(cls, settings) -> "SMTPPool":
+        return cls(
+            **connection_kwargs(settings),
+            size=settings.smtp_pool_size,
+            max_lifetime=settings.smtp_pool_max_lifetime,
+            max_messages=settings.smtp_pool_max_messages,
+            idle_timeout=settings.smtp_pool_idle_timeout,
+        )
+
+    async def start(self) -> None:
+        """Start the background task that evicts idle sessions."""
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_idle())
+
+    async def close(self, timeout: Optional[float] = 30.0) -> None:
+        """Stop accepting sends, wait for in-flight ones, and quit every session."""
+        self._closed = True
+        if self._reaper is not None:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+
+        async def drain() -> None:
+            for _ in range(self.size):
+                await self._semaphore.acquire()
+
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        idle = list(self._idle)
+        self._idle.clear()
+        self._idle_gauge.set(0)
+        await asyncio.gather(*(session.quit() for session in idle), return_exceptions=True)
+
+    async def _open(self) -> PooledSMTP:
+        smtp = await open_connection(
+            self.host,
+            self.port,
+            self.username,
+            self.password,
+            start_tls=self.start_tls,
+            timeout=self.timeout,
+        )
+        return PooledSMTP(smtp)
+
+    def _expired(self, session: PooledSMTP, now: float) -> bool:
+        return (
+            session.broken
+            or not session.smtp.is_connected
+            or now - session.created > self.max_lifetime
+            or now - session.last_used > self.idle_timeout
+        )
+
+    async def _acquire(self) -> PooledSMTP:
+        while self._idle:
+            session = self._idle.pop()
+            self._idle_gauge.set(len(self._idle))
+            if self._expired(session, time.monotonic()):
+                await session.quit()
+                continue
+            try:
+                await session.smtp.rset()
+            except aiosmtplib.SMTPException:
+                session.smtp.close()
+                continue
+            return session
+        return await self._open()
+
+    async def _release(self, session: PooledSMTP) -> None:
+        if self._closed or session.broken or session.messages >= self.max_messages:
+            await session.quit()
+            return
+        session.last_used = time.monotonic()
+        self._idle.append(session)
+        self._idle_gauge.set(len(self._idle))
+
+    @asynccontextmanager
+    async def _checkout(self) -> AsyncIterator[PooledSMTP]:
+        if self._closed:
+            raise RuntimeError("SMTP pool is closed")
+        async with self._semaphore:
+            session = await self._acquire()
+            self._in_use_gauge.inc()
+            try:
+                yield session
+            except asyncio.CancelledError:
+                session.broken = True
+                raise
+            except Exception as exc:
+                if is_connection_error(exc):
+                    session.broken = True
+                raise
+            finally:
+                self._in_use_gauge.dec()
+                await self._release(session)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[aiosmtplib.SMTP]:
+        """Check out a session for one message in the ``async with`` block."""
+        async with self._checkout() as session:
+            session.messages += 1
+            yield session.smtp
+
+    async def _deliver(self, deliver, retry: bool):
+        try:
+            async with self.connection() as smtp:
+                with _track_end_of_data(smtp) as transmission:
+                    return await _transaction(deliver(smtp))
+        except Exception as exc:
+            if not retry or not is_connection_error(exc) or transmission.may_have_delivered(exc):
+                raise
+        async with self.connection() as smtp:
+            return await _transaction(deliver(smtp))
+
+    async def send(self, message: Message, retry: bool = True):
+        """Send ``message`` on a pooled session.
+
+        When the session turns out to be dead, or the server closes it with
+        421, the message is retried once on a fresh session. A connection
+        lost after the end of the message was written is not retried, since
+        the server may already have accepted it.
+        """
+        return await self._deliver(lambda smtp: send_message(smtp, message), retry)
+
+    async def send_stream(
+        self, message, retry: bool = True, sender: Optional[str] = None, recipients: Optional[list[str]] = None
+    ):
+        """Send a ``StreamingMessage`` or ``RenderedFile``, with the same retry as ``send``."""
+        return await self._deliver(lambda smtp: send_stream(smtp, message, sender, recipients), retry)
+
+    async def send_raw(self, sender: str, recipients: list[str], data: bytes, retry: bool = True):
+        """Send an already rendered message, with the same retry as ``send``."""
+        return await self._deliver(lambda smtp: smtp.sendmail(sender, recipients, data), retry)
+
+    async def send_many(
+        self,
+        messages: list,
+        concurrency: Optional[int] = None,
+        prepare: Optional[Callable[[int, Any], Awaitable[Message]]] = None,
+    ) -> list[Optional[Exception]]:
+        """Send ``messages`` over up to ``concurrency`` sessions held for the whole batch.
+
+        Returns one entry per message: ``None`` once delivered, otherwise the
+        exception that stopped it. A message whose session drops before its
+        end was written is retried once on a fresh session; if no session
+        can be opened at all, every remaining message fails with that error.
+
+        With ``prepare``, ``messages`` may hold anything ``prepare(index,
+        item)`` turns into a message. Each one is prepared by the worker
+        about to send it and dropped once it is finished, so at most one
+        message per session is held in memory.
+        """
+        results: list[Optional[Exception]] = [None] * len(messages)
+        attempts = [0] * len(messages)
+        queue = deque(range(len(messages)))
+        prepared: dict[int, Message] = {}
+
+        async def worker() -> None:
+            while queue:
+                opened = False
+                try:
+                    async with self._checkout() as session:
+                        opened = True
+                        while queue and session.messages < self.max_messages:
+                            i = queue.popleft()
+                            if i not in prepared:
+                                try:
+                                    prepared[i] = messages[i] if prepare is None else await prepare(i, messages[i])
+                                except Exception as exc:
+                                    results[i] = exc
+                                    continue
+                            attempts[i] += 1
+                            session.messages += 1
+                            try:
+                                with _track_end_of_data(session.smtp) as transmission:
+                                    await _transaction(send_message(session.smtp, prepared[i]))
+                            except Exception as exc:
+                                if not is_connection_error(exc):
+                                    results[i] = exc
+                                    del prepared[i]
+                                    try:
+                                        await session.smtp.rset()
+                                    except Exception:
+                                        # Carry on with the rest of the batch on a fresh session.
+                                        session.broken = True
+                                        break
+                                    continue
+                                if attempts[i] < 2 and not transmission.may_have_delivered(exc):
+                                    queue.appendleft(i)
+                                else:
+                                    results[i] = exc
+                                    del prepared[i]
+                                raise
+                            del prepared[i]
+                except Exception as exc:
+                    if opened and is_connection_error(exc):
+                        continue
+                    while queue:
+                        results[queue.popleft()] = exc
+
+        workers = min(concurrency or self.size, self.size, len(messages))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        return results
+
+    async def _reap_idle(self) -> None:
+        interval = max(min(self.idle_timeout, self.max_lifetime), 1.0)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            keep: deque[PooledSMTP] = deque()
+            expired: list[PooledSMTP] = []
+            while self._idle:
+                session = self._idle.popleft()
+                (expired if self._expired(session, now) else keep).append(session)
+            self._idle.extend(keep)
+            self._idle_gauge.set(len(self._idle))
+            for session in expired:
+                await session.quit()
+
+
+pool: SMTPPool | None = None
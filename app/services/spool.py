@@ -0,0 +1,405 @@
+# flake8: noqa
+import asyncio
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from email.message import Message
+from typing import Optional
+
+import aiofiles
+from aiosmtplib.email import extract_recipients, extract_sender, flatten_message
+
+from . import mime_stream, smtp_pool
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id TEXT PRIMARY KEY,
+    sender TEXT NOT NULL,
+    recipients TEXT NOT NULL,
+    message BLOB,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    last_error TEXT,
+    smtp_response TEXT,
+    request TEXT
+);
+CREATE INDEX IF NOT EXISTS spool_due ON spool (status, lease_expires);
+"""
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+
+@dataclass
+class SpoolEntry:
+    id: str
+    sender: str
+    recipients: list[str]
+    message: Optional[bytes]
+    attempts: int
+    request: Optional[str] = None
+    path: Optional[str] = None
+
+
+@dataclass
+class SpoolJob:
+    """Delivery state of a queued job as recorded in the spool."""
+
+    id: str
+    request: str
+    status: str
+    attempts: int
+    owner: Optional[str]
+    lease_expires: float
+    created_at: float
+    updated_at: float
+    last_error: Optional[str]
+    smtp_response: Optional[str]
+
+
+class Spool:
+    """Durable SQLite journal of outgoing messages for at-least-once delivery.
+
+    Every message is written with its fully rendered bytes before the first
+    SMTP attempt and marked sent or failed afterwards. Streaming messages
+    are written block by block to a file in ``<path>.messages`` and
+    replayed from it the same way, so journaling never holds a whole
+    message in memory; other messages are already in memory and are
+    stored in the database. A pending entry is
+    leased to the process sending it; if that process dies, the lease
+    expires and any process sharing the file replays the message. SQLite's
+    file locking serialises writers across uvicorn workers.
+
+    Writes are group-committed: everything queued within ``commit_interval``
+    seconds goes into one transaction, so a burst of enqueues shares a
+    single fsync.
+
+    Jobs accepted for asynchronous sending are journaled as their request
+    instead, since their attachments are only downloaded when they are
+    sent. The outbox claims and delivers those; :meth:`replay` only resends
+    rendered messages.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease_timeout: float = 300.0,
+        commit_interval: float = 0.002,
+        replay_interval: float = 30.0,
+        max_attempts: int = 5,
+        retention: float = 86400.0,
+        connection_kwargs: Optional[dict] = None,
+    ) -> None:
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.commit_interval = commit_interval
+        self.replay_interval = replay_interval
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.connection_kwargs = connection_kwargs or {}
+        self.owner = uuid.uuid4().hex
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.message_dir = f"{path}.messages"
+        os.makedirs(self.message_dir, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(SCHEMA)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(spool)")]
+        if "request" not in columns:
+            # Spool files written before jobs were journaled.
+            self._db.execute("ALTER TABLE spool ADD COLUMN request TEXT")
+        self._lock = threading.Lock()
+        self._pending: list[tuple[str, tuple, asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._replayer: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_settings(cls, settings) -> "Spool":
+        return cls(
+            settings.spool_path,
+            lease_timeout=settings.spool_lease_timeout,
+            commit_interval=settings.spool_commit_interval,
+            replay_interval=settings.spool_replay_interval,
+            connection_kwargs=smtp_pool.connection_kwargs(settings),
+        )
+
+    async def start(self) -> None:
+        """Start replaying entries whose sender died, including from earlier runs."""
+        if self._replayer is None:
+            self._replayer = asyncio.create_task(self._replay_loop())
+
+    async def close(self) -> None:
+        if self._replayer is not None:
+            self._replayer.cancel()
+            try:
+                await self._replayer
+            except asyncio.CancelledError:
+                pass
+            self._replayer = None
+        if self._flusher is not None:
+            await self._flusher
+        with self._lock:
+            self._db.close()
+
+    async def _call(self, func, *args):
+        def locked():
+            with self._lock:
+                return func(*args)
+
+        return await asyncio.to_thread(locked)
+
+    def _write(self, sql: str, params: tuple) -> asyncio.Future:
+        """Queue a write for the next group commit.
+
+        The future resolves to the number of rows changed once the write is durable.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((sql, params, future))
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+        return future
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self.commit_interval)
+        batch, self._pending = self._pending, []
+        self._flusher = None
+
+        def commit() -> list[int]:
+            with self._db:
+                return [self._db.execute(sql, params).rowcount for sql, params, _ in batch]
+
+        try:
+            counts = await self._call(commit)
+        except Exception as exc:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, _, future), count in zip(batch, counts):
+            if not future.done():
+                future.set_result(count)
+
+    def _message_file(self, entry_id: str) -> str:
+        return os.path.join(self.message_dir, f"{entry_id}.eml")
+
+    def _remove_file(self, entry_id: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._message_file(entry_id))
+
+    async def _write_file(self, entry_id: str, message: mime_stream.StreamingMessage) -> None:
+        """Render ``message`` into its spool file one chunk at a time and make it durable."""
+        path = self._message_file(entry_id)
+        async with aiofiles.open(path, "wb") as file:
+            async for chunk in message.chunks():
+                await file.write(chunk)
+            await file.flush()
+            await asyncio.to_thread(os.fsync, file.fileno())
+
+    async def add(self, message: Message | mime_stream.StreamingMessage) -> str:
+        """Journal ``message`` leased to this process and return its entry id.
+
+        A streaming message is rendered to its spool file before the entry
+        is committed, so the journal holds the exact bytes that will be
+        sent without loading them into memory.
+        """
+        entry_id = uuid.uuid4().hex
+        if isinstance(message, mime_stream.StreamingMessage):
+            headers, data = message.headers, None
+            await self._write_file(entry_id, message)
+        else:
+            headers, data = message, flatten_message(message)
+        sender = extract_sender(headers) or ""
+        recipients = extract_recipients(headers)
+        now = time.time()
+        await self._write(
+            "INSERT INTO spool (id, sender, recipients, message, status, attempts, owner, lease_expires, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?)",
+            (entry_id, sender, "\n".join(recipients), data, PENDING, self.owner, now + self.lease_timeout, now, now),
+        )
+        return entry_id
+
+    async def add_job(self, request: str) -> str:
+        """Journal a job's serialized ``request`` leased to this process and return its entry id."""
+        entry_id = uuid.uuid4().hex
+        now = time.time()
+        await self._write(
+            "INSERT INTO spool (id, sender, recipients, status, attempts, owner, lease_expires, created_at, "
+            "updated_at, request) VALUES (?, '', '', ?, 0, ?, ?, ?, ?, ?)",
+            (entry_id, PENDING, self.owner, now + self.lease_timeout, now, now, request),
+        )
+        return entry_id
+
+    async def begin(self, entry_id: str) -> bool:
+        """Count a delivery attempt and renew the lease, unless another process has taken the entry."""
+        now = time.time()
+        changed = await self._write(
+            "UPDATE spool SET attempts = attempts + 1, lease_expires = ?, updated_at = ? "
+            "WHERE id = ? AND owner = ? AND status = ?",
+            (now + self.lease_timeout, now, entry_id, self.owner, PENDING),
+        )
+        return changed == 1
+
+    async def mark_sent(self, entry_id: str, response: str) -> None:
+        await self._write(
+            "UPDATE spool SET status = ?, message = NULL, owner = NULL, smtp_response = ?, last_error = NULL, "
+            "updated_at = ? WHERE id = ?",
+            (SENT, response, time.time(), entry_id),
+        )
+        self._remove_file(entry_id)
+
+    async def mark_failed(self, entry_id: str, error: str) -> None:
+        await self._write(
+            "UPDATE spool SET status = ?, message = NULL, owner = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+            (FAILED, error, time.time(), entry_id),
+        )
+        self._remove_file(entry_id)
+
+    async def release(self, entry_id: str, error: str, delay: float) -> None:
+        """Give up the lease after a temporary failure so the entry is retried after ``delay``."""
+        now = time.time()
+        await self._write(
+            "UPDATE spool SET owner = NULL, lease_expires = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (now + delay, error, now, entry_id),
+        )
+
+    async def fail(self, entry_id: str, exc: Exception, attempts: int) -> None:
+        """Record a failed attempt: permanent errors and the last attempt fail, others are retried."""
+        if smtp_pool.is_permanent(exc) or attempts >= self.max_attempts:
+            await self.mark_failed(entry_id, str(exc))
+        else:
+            await self.release(entry_id, str(exc), min(2 ** attempts, self.lease_timeout))
+
+    async def status(self, entry_id: str) -> Optional[tuple[str, int, Optional[str], Optional[str]]]:
+        """Return ``(status, attempts, last_error, smtp_response)`` for an entry."""
+
+        def query():
+            return self._db.execute(
+                "SELECT status, attempts, last_error, smtp_response FROM spool WHERE id = ?",
+                (entry_id,),
+            ).fetchone()
+
+        return await self._call(query)
+
+    async def job(self, entry_id: str) -> Optional[SpoolJob]:
+        """Return the state of the job journaled as ``entry_id``."""
+
+        def query():
+            return self._db.execute(
+                "SELECT id, request, status, attempts, owner, lease_expires, created_at, updated_at, last_error, "
+                "smtp_response FROM spool WHERE id = ? AND request IS NOT NULL",
+                (entry_id,),
+            ).fetchone()
+
+        row = await self._call(query)
+        return SpoolJob(*row) if row is not None else None
+
+    async def claim(self, limit: int = 50, jobs: bool = False) -> list[SpoolEntry]:
+        """Lease up to ``limit`` pending entries whose lease has expired.
+
+        Rendered messages count the claim as an attempt. With ``jobs`` only
+        journaled requests are claimed instead, and their attempts are
+        counted by :meth:`begin` when delivery starts.
+        """
+        now = time.time()
+        expires = now + self.lease_timeout
+        kind = "request IS NOT NULL" if jobs else "request IS NULL"
+        counted = "" if jobs else ", attempts = attempts + 1"
+
+        def claim() -> list[SpoolEntry]:
+            with self._db:
+                self._db.execute(
+                    f"UPDATE spool SET owner = ?, lease_expires = ?{counted} WHERE id IN ("
+                    f"SELECT id FROM spool WHERE status = ? AND {kind} AND lease_expires <= ? "
+                    "ORDER BY created_at LIMIT ?)",
+                    (self.owner, expires, PENDING, now, limit),
+                )
+                rows = self._db.execute(
+                    "SELECT id, sender, recipients, message, attempts, request FROM spool "
+                    f"WHERE status = ? AND {kind} AND owner = ? AND lease_expires = ? ORDER BY created_at",
+                    (PENDING, self.owner, expires),
+                ).fetchall()
+            return [
+                SpoolEntry(
+                    entry_id,
+                    sender,
+                    recipients.split("\n"),
+                    message,
+                    attempts,
+                    request,
+                    self._message_file(entry_id) if message is None and request is None else None,
+                )
+                for entry_id, sender, recipients, message, attempts, request in rows
+            ]
+
+        return await self._call(claim)
+
+    async def purge(self) -> None:
+        """Drop finished entries older than ``retention``, and message files no pending entry uses."""
+        cutoff = time.time() - self.retention
+
+        def purge() -> None:
+            with self._db:
+                self._db.execute(
+                    "DELETE FROM spool WHERE status != ? AND updated_at < ?",
+                    (PENDING, cutoff),
+                )
+            # Left behind when a process died between writing the file and committing its entry.
+            pending = {row[0] for row in self._db.execute("SELECT id FROM spool WHERE status = ?", (PENDING,))}
+            for name in os.listdir(self.message_dir):
+                path = os.path.join(self.message_dir, name)
+                if name[:-4] not in pending and os.path.getmtime(path) < cutoff:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+
+        await self._call(purge)
+
+    async def replay(self) -> int:
+        """Resend every entry whose lease has expired; returns how many were claimed."""
+        entries = await self.claim()
+        if not entries:
+            return 0
+        pool = smtp_pool.pool or smtp_pool.SMTPPool(**self.connection_kwargs)
+        try:
+            for entry in entries:
+                try:
+                    if entry.path is not None:
+                        _, reply = await pool.send_stream(
+                            mime_stream.RenderedFile(entry.path), sender=entry.sender, recipients=entry.recipients
+                        )
+                    else:
+                        _, reply = await pool.send_raw(entry.sender, entry.recipients, entry.message)
+                except Exception as exc:
+                    await self.fail(entry.id, exc, entry.attempts)
+                    continue
+                await self.mark_sent(entry.id, reply)
+        finally:
+            if pool is not smtp_pool.pool:
+                await pool.close()
+        return len(entries)
+
+    async def _replay_loop(self) -> None:
+        while True:
+            try:
+                while await self.replay():
+                    pass
+                await self.purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"Spool replay failed: {exc}")
+            await asyncio.sleep(self.replay_interval)
+
+
+spool: Spool | None = None
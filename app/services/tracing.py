@@ -0,0 +1,143 @@
+# flake8: noqa
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Set from the settings at startup; 0 disables the slow-request log.
+slow_request_threshold: float = 0.0
+server_timing: bool = True
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    """One timed step of a request, with the steps it ran nested below it."""
+
+    name: str
+    attrs: dict[str, Any] = field(default_factory=dict)
+    start: float = field(default_factory=time.perf_counter)
+    end: Optional[float] = None
+    children: list["Span"] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def walk(self) -> Iterator["Span"]:
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_dict(self, origin: Optional[float] = None) -> dict:
+        origin = self.start if origin is None else origin
+        entry = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+        if self.attrs:
+            entry["attrs"] = self.attrs
+        if self.children:
+            entry["children"] = [child.to_dict(origin) for child in self.children]
+        return entry
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+    """Time the block as a child of the current span.
+
+    Outside a traced request this yields ``None`` and records nothing, so
+    background workers pay only for one context variable lookup. Tasks
+    started inside the block inherit it, so concurrent downloads show up
+    as siblings.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attrs)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    finally:
+        child.end = time.perf_counter()
+        _current.reset(token)
+
+
+def annotate(**attrs: Any) -> None:
+    """Attach ``attrs`` to the current span, if there is one."""
+    current = _current.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+def server_timing_header(root: Span) -> str:
+    """Render the spans under ``root`` as a ``Server-Timing`` value.
+
+    Spans sharing a name are summed into one entry, so the values of
+    nested or concurrent steps can add up to more than ``total``.
+    """
+    totals: dict[str, float] = {}
+    for item in root.walk():
+        if item is not root:
+            totals[item.name] = totals.get(item.name, 0.0) + item.duration
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items()]
+    entries.append(f"total;dur={root.duration * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class TimingMiddleware:
+    """ASGI middleware that traces each request.
+
+    The spans finished by the time the response starts are reported in a
+    ``Server-Timing`` header, and requests slower than
+    ``slow_request_threshold`` are logged as one JSON entry holding the
+    whole span tree.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        root = Span("request")
+        token = _current.set(root)
+        status = 500
+
+        async def send_wrapper(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing_header(root).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            root.end = time.perf_counter()
+            _current.reset(token)
+            if slow_request_threshold > 0 and root.duration >= slow_request_threshold:
+                route = scope.get("route")
+                entry = {
+                    "event": "slow_request",
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": getattr(route, "path", None),
+                    "status": status,
+                    "duration_ms": round(root.duration * 1000, 3),
+                    "spans": [child.to_dict(root.start) for child in root.children],
+                }
+                logger.warning(json.dumps(entry, default=str))
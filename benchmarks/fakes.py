@@ -0,0 +1,368 @@
+# flake8: noqa
+"""Local stand-ins for the IMAP, SMTP and HTTP servers the API talks to.
+
+Each server listens on 127.0.0.1 on a free port, answers just enough of
+its protocol for every route to work, and sleeps ``latency`` seconds
+before each reply to imitate a remote server. Counters on each server
+record how much work the API asked of it.
+"""
+import asyncio
+import re
+from collections import Counter
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from aiohttp import web
+
+LITERAL_RE = re.compile(rb"\{(\d+)(\+?)\}$")
+UID_RANGE_RE = re.compile(r"\bUID (\d+|\*):(\d+|\*)", re.IGNORECASE)
+SECTION_RE = re.compile(r"BODY\.PEEK\[([\d.]*)\]", re.IGNORECASE)
+FOLDERS = ["INBOX", "Archive", "Drafts", "Sent", "Trash"]
+CAPABILITIES = "IMAP4rev1 LITERAL+ UIDPLUS MOVE"
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _quoted(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _literal(data: bytes) -> bytes:
+    return b"{%d}\r\n%s" % (len(data), data)
+
+
+class _TCPServer:
+    """Asyncio TCP server that closes its open sessions when stopped."""
+
+    port = 0
+    _server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._sessions: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self._server = await asyncio.start_server(self._accept, "127.0.0.1", 0, limit=64 * 1024 * 1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in self._sessions.values():
+            writer.close()
+        await asyncio.gather(*self._sessions, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._sessions[task] = writer
+        try:
+            await self._handle(reader, writer)
+        finally:
+            del self._sessions[task]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        raise NotImplementedError
+
+
+class FakeMailbox:
+    """Generated messages shared by every folder, numbered from UID 1."""
+
+    def __init__(self, messages: int = 1000, body_size: int = 2048) -> None:
+        self.messages = messages
+        self.body_size = body_size
+        self._raw: dict[int, bytes] = {}
+
+    def date(self, uid: int) -> datetime:
+        return START + timedelta(minutes=uid)
+
+    def subject(self, uid: int) -> str:
+        return f"Benchmark message {uid}"
+
+    def sender(self, uid: int) -> str:
+        return f"sender{uid % 50}@example.com"
+
+    def body(self, uid: int) -> bytes:
+        line = f"Line of message {uid} for the benchmark.\n".encode()
+        return (line * (self.body_size // len(line) + 1))[: self.body_size]
+
+    def raw(self, uid: int) -> bytes:
+        if uid not in self._raw:
+            msg = EmailMessage()
+            msg["From"] = self.sender(uid)
+            msg["To"] = "user@example.com"
+            msg["Subject"] = self.subject(uid)
+            msg["Date"] = format_datetime(self.date(uid))
+            msg["Message-ID"] = f"<{uid}@bench.example.com>"
+            msg.set_content(self.body(uid).decode(), cte="7bit")
+            self._raw[uid] = msg.as_bytes()
+        return self._raw[uid]
+
+    def envelope(self, uid: int) -> str:
+        mailbox, host = self.sender(uid).split("@")
+        address = f'((NIL NIL {_quoted(mailbox)} {_quoted(host)}))'
+        return (
+            f"({_quoted(format_datetime(self.date(uid)))} {_quoted(self.subject(uid))} "
+            f"{address} {address} {address} ((NIL NIL \"user\" \"example.com\")) NIL NIL NIL "
+            f"{_quoted(f'<{uid}@bench.example.com>')})"
+        )
+
+    def internaldate(self, uid: int) -> str:
+        return self.date(uid).strftime("%d-%b-%Y %H:%M:%S +0000")
+
+
+class FakeIMAPServer(_TCPServer):
+    """Scriptable IMAP4rev1 server over plain TCP.
+
+    Supports LOGIN, CAPABILITY, SELECT/EXAMINE, LIST, STATUS, SEARCH,
+    FETCH of summaries, whole messages, BODYSTRUCTURE and body sections,
+    MOVE, COPY, STORE, EXPUNGE, APPEND and NOOP. Every folder holds the
+    same generated messages and nothing is ever removed, so repeated runs
+    see the same mailbox.
+    """
+
+    def __init__(self, mailbox: Optional[FakeMailbox] = None, latency: float = 0.0, capabilities: str = CAPABILITIES) -> None:
+        self.mailbox = mailbox or FakeMailbox()
+        self.latency = latency
+        self.capabilities = capabilities
+        self.commands: Counter[str] = Counter()
+
+    async def _read_command(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[bytes]:
+        line = await reader.readline()
+        if not line:
+            return None
+        line = line.rstrip(b"\r\n")
+        # Inline literals so the handlers see one command string.
+        while True:
+            match = LITERAL_RE.search(line)
+            if not match:
+                return line
+            if not match.group(2):
+                writer.write(b"+ go ahead\r\n")
+                await writer.drain()
+            data = await reader.readexactly(int(match.group(1)))
+            line = line[: match.start()] + b"{literal:%d}" % len(data) + (await reader.readline()).rstrip(b"\r\n")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.write(f"* OK [CAPABILITY {self.capabilities}] fake IMAP ready\r\n".encode())
+        try:
+            while True:
+                line = await self._read_command(reader, writer)
+                if line is None:
+                    break
+                tag, _, rest = line.decode("utf-8", errors="replace").partition(" ")
+                name, _, args = rest.partition(" ")
+                name = name.upper()
+                if name == "UID":
+                    sub, _, args = args.partition(" ")
+                    name = f"UID {sub.upper()}"
+                self.commands[name] += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if name == "LOGOUT":
+                    writer.write(f"* BYE logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+                    await writer.drain()
+                    break
+                writer.write(self._respond(name, args) + f"{tag} OK {name} completed\r\n".encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, name: str, args: str) -> bytes:
+        count = self.mailbox.messages
+        if name == "CAPABILITY":
+            return f"* CAPABILITY {self.capabilities}\r\n".encode()
+        if name in ("SELECT", "EXAMINE"):
+            return (
+                f"* {count} EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY 1] UIDs valid\r\n"
+                f"* OK [UIDNEXT {count + 1}] next UID\r\n* FLAGS (\\Seen \\Deleted)\r\n"
+            ).encode()
+        if name == "LIST":
+            return b"".join(f'* LIST (\\HasNoChildren) "/" {_quoted(folder)}\r\n'.encode() for folder in FOLDERS)
+        if name == "STATUS":
+            folder = args.split(" (")[0]
+            return f"* STATUS {folder} (MESSAGES {count} UNSEEN {count // 10} UIDNEXT {count + 1})\r\n".encode()
+        if name in ("UID SEARCH", "SEARCH"):
+            return self._search(args)
+        if name == "UID FETCH":
+            return self._fetch(args)
+        return b""
+
+    def _uids(self, uid_set: str) -> list[int]:
+        count = self.mailbox.messages
+        uids: list[int] = []
+        for part in uid_set.split(","):
+            low, _, high = part.partition(":")
+            low_value = count if low == "*" else int(low)
+            high_value = low_value if not high else (count if high == "*" else int(high))
+            low_value, high_value = sorted((low_value, high_value))
+            uids.extend(range(max(low_value, 1), min(high_value, count) + 1))
+        return uids
+
+    def _search(self, args: str) -> bytes:
+        match = UID_RANGE_RE.search(args)
+        uids = self._uids(f"{match.group(1)}:{match.group(2)}") if match else list(range(1, self.mailbox.messages + 1))
+        if "UNSEEN" in args.upper():
+            uids = [uid for uid in uids if uid % 10 == 0]
+        return ("* SEARCH " + " ".join(map(str, uids))).rstrip().encode() + b"\r\n"
+
+    def _fetch(self, args: str) -> bytes:
+        uid_set, _, items = args.partition(" ")
+        items = items.upper()
+        out = []
+        for uid in self._uids(uid_set):
+            if "ENVELOPE" in items:
+                flags = "" if uid % 10 == 0 else "\\Seen"
+                data = (
+                    f"UID {uid} FLAGS ({flags}) INTERNALDATE {_quoted(self.mailbox.internaldate(uid))} "
+                    f"ENVELOPE {self.mailbox.envelope(uid)}"
+                ).encode()
+            elif "BODYSTRUCTURE" in items:
+                body = self.mailbox.body(uid)
+                lines = body.count(b"\n")
+                headers = (
+                    f"Subject: {self.mailbox.subject(uid)}\r\nMessage-ID: <{uid}@bench.example.com>\r\n\r\n"
+                ).encode()
+                data = (
+                    f'UID {uid} BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" {len(body)} {lines}) '
+                    f"BODY[HEADER.FIELDS (SUBJECT MESSAGE-ID REFERENCES)] "
+                ).encode() + _literal(headers)
+            elif SECTION_RE.search(items):
+                section = SECTION_RE.search(items).group(1)
+                content = self.mailbox.body(uid) if section else self.mailbox.raw(uid)
+                data = f"UID {uid} BODY[{section}] ".encode() + _literal(content)
+            elif "RFC822" in items:
+                data = f"UID {uid} RFC822 ".encode() + _literal(self.mailbox.raw(uid))
+            else:
+                flags = "" if uid % 10 == 0 else "\\Seen"
+                data = f"UID {uid} FLAGS ({flags})".encode()
+            out.append(b"* %d FETCH (%s)\r\n" % (uid, data))
+        return b"".join(out)
+
+
+class FakeSMTPServer(_TCPServer):
+    """ESMTP server that accepts and discards every message.
+
+    Advertises PIPELINING, 8BITMIME, SIZE and AUTH PLAIN/LOGIN, plus
+    CHUNKING when ``chunking`` is set, and counts sessions, logins and
+    delivered messages.
+    """
+
+    def __init__(self, latency: float = 0.0, chunking: bool = False) -> None:
+        self.latency = latency
+        self.chunking = chunking
+        self.sessions = 0
+        self.logins = 0
+        self.messages = 0
+        self.bytes = 0
+
+    async def _reply(self, writer: asyncio.StreamWriter, text: str) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        writer.write(text.encode() + b"\r\n")
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.sessions += 1
+        extensions = ["PIPELINING", "8BITMIME", "SIZE 52428800", "AUTH PLAIN LOGIN"]
+        if self.chunking:
+            extensions.append("CHUNKING")
+        try:
+            await self._reply(writer, "220 fake SMTP ready")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors="replace").strip()
+                verb = command.split(" ")[0].upper()
+                if verb in ("EHLO", "HELO"):
+                    await self._reply(writer, "\r\n".join(f"250-{ext}" for ext in ["localhost", *extensions[:-1]]) + f"\r\n250 {extensions[-1]}")
+                elif verb == "AUTH":
+                    if command.upper().startswith("AUTH LOGIN"):
+                        await self._reply(writer, "334 VXNlcm5hbWU6")
+                        await reader.readline()
+                        await self._reply(writer, "334 UGFzc3dvcmQ6")
+                        await reader.readline()
+                    self.logins += 1
+                    await self._reply(writer, "235 authenticated")
+                elif verb == "DATA":
+                    await self._reply(writer, "354 end with .")
+                    size = 0
+                    while True:
+                        chunk = await reader.readline()
+                        if chunk in (b".\r\n", b""):
+                            break
+                        size += len(chunk)
+                    self._delivered(size)
+                    await self._reply(writer, "250 queued")
+                elif verb == "BDAT":
+                    parts = command.split()
+                    size = int(parts[1])
+                    await reader.readexactly(size)
+                    self.bytes += size
+                    if len(parts) > 2 and parts[2].upper() == "LAST":
+                        self._delivered(0)
+                        await self._reply(writer, "250 queued")
+                    else:
+                        await self._reply(writer, f"250 {size} octets received")
+                elif verb == "QUIT":
+                    await self._reply(writer, "221 bye")
+                    break
+                else:
+                    await self._reply(writer, "250 ok")
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _delivered(self, size: int) -> None:
+        self.messages += 1
+        self.bytes += size
+
+
+class FakeHTTPServer:
+    """HTTP server handing out generated attachments.
+
+    ``GET /files/<name>?size=N`` returns ``N`` bytes (default
+    ``file_size``) with an ``ETag`` and honours ``If-None-Match``, so the
+    attachment cache can be exercised too.
+    """
+
+    def __init__(self, latency: float = 0.0, file_size: int = 256 * 1024) -> None:
+        self.latency = latency
+        self.file_size = file_size
+        self.downloads = 0
+        self.not_modified = 0
+        self.bytes = 0
+        self.port = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def url(self, name: str = "report.pdf", size: Optional[int] = None) -> str:
+        query = f"?size={size}" if size is not None else ""
+        return f"http://127.0.0.1:{self.port}/files/{name}{query}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/files/{name}", self._file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _file(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        size = int(request.query.get("size", self.file_size))
+        etag = f'"{request.match_info["name"]}-{size}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        self.downloads += 1
+        self.bytes += size
+        return web.Response(body=b"x" * size, headers={"ETag": etag}, content_type="application/octet-stream")
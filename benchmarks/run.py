@@ -0,0 +1,301 @@
+# flake8: noqa
+"""Drive every route against local fake servers and report latency and throughput.
+
+Usage::
+
+    python -m benchmarks.run --requests 500 --concurrency 32 --output bench.json
+    python -m benchmarks.run --baseline bench.json --routes list_emails,reply
+
+The API runs under uvicorn in a subprocess configured against fake IMAP,
+SMTP and HTTP servers started in this process. Each route is driven in
+turn for ``--requests`` requests at ``--concurrency``, and the JSON
+report holds p50/p95/p99 latency, requests per second, status counts,
+the server's peak RSS and what the fakes were asked to do. With
+``--baseline`` the report also carries the relative change of each
+route's throughput and p95 against an earlier report.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import httpx
+
+from .fakes import FakeHTTPServer, FakeIMAPServer, FakeMailbox, FakeSMTPServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+@dataclass
+class Scenario:
+    """One route to benchmark; ``build`` returns the ``(path, httpx kwargs)`` of request ``i``."""
+
+    method: str
+    build: Callable[[int, random.Random], tuple[str, dict]]
+
+
+def _message(fakes: dict, attachments: int = 0) -> dict:
+    payload = {"to_addresses": ["rcpt@example.com"], "subject": "Benchmark", "body": "<p>Hello from the benchmark.</p>"}
+    if attachments:
+        payload["file_url"] = [fakes["http"].url(f"file{i}.pdf") for i in range(attachments)]
+    return payload
+
+
+def scenarios(fakes: dict, attachments: int) -> dict[str, Scenario]:
+    messages = fakes["imap"].mailbox.messages
+
+    def uid(rng: random.Random) -> int:
+        return rng.randint(1, messages)
+
+    return {
+        "list_emails": Scenario("GET", lambda i, rng: ("/emails", {"params": {"limit": 20}})),
+        "list_folders": Scenario("GET", lambda i, rng: ("/folders", {"params": {"status": "true"}})),
+        "move": Scenario("POST", lambda i, rng: (f"/emails/{uid(rng)}/move", {"params": {"folder": "Archive"}})),
+        "reply": Scenario("POST", lambda i, rng: (f"/emails/{uid(rng)}/reply", {"json": _message(fakes)})),
+        "forward": Scenario("POST", lambda i, rng: (f"/emails/{uid(rng)}/forward", {"json": _message(fakes, attachments)})),
+        "draft": Scenario("POST", lambda i, rng: ("/drafts", {"json": _message(fakes)})),
+        "send": Scenario("POST", lambda i, rng: ("/", {"json": _message(fakes, attachments)})),
+    }
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of already sorted ``values``."""
+    if not values:
+        return 0.0
+    rank = max(1, min(len(values), math.ceil(q / 100 * len(values))))
+    return values[rank - 1]
+
+
+def summarize(latencies: list[float], statuses: dict[str, int], elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    return {
+        "requests": len(ordered),
+        "errors": len(ordered) - ok,
+        "status": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(ordered) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(ordered, 50) * 1000, 3),
+            "p95": round(percentile(ordered, 95) * 1000, 3),
+            "p99": round(percentile(ordered, 99) * 1000, 3),
+            "mean": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+            "max": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        },
+    }
+
+
+async def drive(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int, seed: int) -> dict:
+    """Send ``requests`` requests from ``concurrency`` workers and summarize them."""
+    rng = random.Random(seed)
+    plan = [scenario.build(i, rng) for i in range(requests)]
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    position = 0
+
+    async def worker() -> None:
+        nonlocal position
+        while position < len(plan):
+            path, kwargs = plan[position]
+            position += 1
+            start = time.perf_counter()
+            try:
+                response = await client.request(scenario.method, path, **kwargs)
+                status = str(response.status_code)
+            except httpx.HTTPError as exc:
+                status = type(exc).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, statuses, time.perf_counter() - start)
+
+
+def _children(pid: int) -> list[int]:
+    found = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # The command name may hold spaces, so split after its closing parenthesis.
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            found.append(int(entry))
+    return found
+
+
+def peak_rss(pid: int) -> Optional[int]:
+    """Peak resident set size in bytes of ``pid`` and its descendants, on Linux."""
+    if not os.path.isdir("/proc"):
+        return None
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+        pending.extend(_children(current))
+    return total
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_env(fakes: dict, extra: dict[str, str]) -> dict[str, str]:
+    env = {key: value for key, value in os.environ.items() if key != "PROMETHEUS_MULTIPROC_DIR"}
+    env.pop("API_KEY", None)
+    env.update(
+        ACCOUNT_EMAIL="user@example.com",
+        ACCOUNT_PASSWORD="password",
+        ACCOUNT_IMAP_SERVER="127.0.0.1",
+        ACCOUNT_IMAP_PORT=str(fakes["imap"].port),
+        ACCOUNT_IMAP_SSL="false",
+        ACCOUNT_SMTP_SERVER="127.0.0.1",
+        ACCOUNT_SMTP_PORT=str(fakes["smtp"].port),
+        START_TLS="false",
+        SLOW_REQUEST_THRESHOLD="0",
+    )
+    env.update(extra)
+    return env
+
+
+async def wait_ready(client: httpx.AsyncClient, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API server exited with status {process.returncode}")
+        try:
+            if (await client.get("/openapi.json")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("API server did not start in time")
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Relative change of throughput and p95 per route, as fractions of the baseline."""
+    changes = {}
+    for name, result in report["routes"].items():
+        previous = baseline.get("routes", {}).get(name)
+        if not previous:
+            continue
+        change = {}
+        if previous["rps"]:
+            change["rps"] = round(result["rps"] / previous["rps"] - 1, 4)
+        if previous["latency_ms"]["p95"]:
+            change["p95"] = round(result["latency_ms"]["p95"] / previous["latency_ms"]["p95"] - 1, 4)
+        changes[name] = change
+    return changes
+
+
+async def run(args: argparse.Namespace) -> dict:
+    fakes = {
+        "imap": FakeIMAPServer(FakeMailbox(args.messages, args.body_size), latency=args.imap_latency),
+        "smtp": FakeSMTPServer(latency=args.smtp_latency, chunking=args.chunking),
+        "http": FakeHTTPServer(latency=args.http_latency, file_size=args.attachment_size),
+    }
+    for fake in fakes.values():
+        await fake.start()
+    port = _free_port()
+    extra = dict(item.split("=", 1) for item in args.env)
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+        ],
+        cwd=ROOT,
+        env=server_env(fakes, extra),
+        # Keep stdout for the report.
+        stdout=sys.stderr,
+    )
+    routes = scenarios(fakes, args.attachments)
+    selected = list(routes) if args.routes == "all" else args.routes.split(",")
+    report: dict = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "routes": {},
+    }
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=args.timeout, limits=limits) as client:
+            await wait_ready(client, process)
+            for offset, name in enumerate(selected):
+                scenario = routes[name]
+                if args.warmup:
+                    await drive(client, scenario, args.warmup, args.concurrency, args.seed - 1 - offset)
+                report["routes"][name] = await drive(client, scenario, args.requests, args.concurrency, args.seed + offset)
+        report["server"] = {"workers": args.workers, "peak_rss_bytes": peak_rss(process.pid)}
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        for fake in fakes.values():
+            await fake.stop()
+    report["fakes"] = {
+        "imap_commands": dict(fakes["imap"].commands),
+        "smtp": {"sessions": fakes["smtp"].sessions, "logins": fakes["smtp"].logins, "messages": fakes["smtp"].messages},
+        "http": {"downloads": fakes["http"].downloads, "not_modified": fakes["http"].not_modified, "bytes": fakes["http"].bytes},
+    }
+    if args.baseline:
+        with open(args.baseline) as file:
+            report["baseline"] = {"path": args.baseline, "change": compare(report, json.load(file))}
+    return report
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--routes", default="all", help="Comma-separated scenarios, or 'all': list_emails, list_folders, move, reply, forward, draft, send.")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per route.")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests per route sent first.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once.")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes.")
+    parser.add_argument("--messages", type=int, default=1000, help="Messages in every fake folder.")
+    parser.add_argument("--body-size", type=int, default=2048, help="Bytes of body text per fake message.")
+    parser.add_argument("--attachments", type=int, default=1, help="Attachments on send and forward requests.")
+    parser.add_argument("--attachment-size", type=int, default=256 * 1024, help="Bytes per attachment.")
+    parser.add_argument("--imap-latency", type=float, default=0.002, help="Seconds the fake IMAP server waits before each reply.")
+    parser.add_argument("--smtp-latency", type=float, default=0.002, help="Seconds the fake SMTP server waits before each reply.")
+    parser.add_argument("--http-latency", type=float, default=0.005, help="Seconds the fake HTTP server waits before each file.")
+    parser.add_argument("--chunking", action="store_true", help="Advertise SMTP CHUNKING so messages go out as BDAT.")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra API setting, e.g. HEADER_INDEX_PATH=/tmp/index.db; repeatable.")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request client timeout in seconds.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the UIDs each scenario picks.")
+    parser.add_argument("--baseline", help="Earlier report to compare against.")
+    parser.add_argument("--output", help="Write the JSON report here as well as to stdout.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# flake8: noqa
+import asyncio
+import base64
+import os
+import sys
+
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import attachment_cache  # noqa: E402
+from app import dependencies  # noqa: E402
+
+URL = "http://example.com/logo.png"
+
+
+@pytest.fixture(autouse=True)
+def reset_cache():
+    yield
+    attachment_cache.cache = None
+
+
+class FakeContent:
+    def __init__(self, data):
+        self._data = data
+
+    async def iter_chunked(self, size):
+        for i in range(0, len(self._data), size):
+            yield self._data[i : i + size]
+
+
+class FakeResponse:
+    def __init__(self, status, data=b"", headers=None):
+        self.status = status
+        self.content_length = len(data) if status == 200 else None
+        self.content = FakeContent(data)
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append((url, headers or {}))
+        return self.responses.pop(0)
+
+
+def fetch(session, temp_dir):
+    return asyncio.run(dependencies.fetch_cached(session, URL, str(temp_dir)))
+
+
+def decoded(cached):
+    with open(cached.path, "rb") as file:
+        return base64.b64decode(file.read())
+
+
+def test_miss_then_fresh_hit(tmp_path):
+    attachment_cache.cache = attachment_cache.AttachmentCache(str(tmp_path / "cache"))
+    session = FakeSession(FakeResponse(200, b"png-bytes", {"ETag": '"v1"'}))
+    first = fetch(session, tmp_path)
+    second = fetch(session, tmp_path)
+    assert decoded(first) == decoded(second) == b"png-bytes"
+    assert second.size == len(b"png-bytes")
+    assert len(session.requests) == 1
+
+
+def test_hit_stays_readable_after_eviction(tmp_path):
+    cache = attachment_cache.AttachmentCache(str(tmp_path / "cache"))
+    attachment_cache.cache = cache
+    fetch(FakeSession(FakeResponse(200, b"png-bytes")), tmp_path)
+    hit = fetch(FakeSession(), tmp_path)
+    cache._forget(URL)
+    assert os.path.dirname(hit.path) == str(tmp_path)
+    assert decoded(hit) == b"png-bytes"
+
+
+def test_stale_entry_is_revalidated(tmp_path):
+    cache = attachment_cache.AttachmentCache(str(tmp_path / "cache"), ttl=0)
+    attachment_cache.cache = cache
+    session = FakeSession(
+        FakeResponse(200, b"v1", {"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}),
+        FakeResponse(304),
+        FakeResponse(200, b"v2", {"ETag": '"v2"'}),
+    )
+    fetch(session, tmp_path)
+    not_modified = fetch(session, tmp_path)
+    assert session.requests[1][1] == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT",
+    }
+    assert decoded(not_modified) == b"v1"
+
+    changed = fetch(session, tmp_path)
+    assert decoded(changed) == b"v2"
+    assert cache.get(URL).etag == '"v2"'
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    encoded_size = len(base64.encodebytes(b"x" * 30))
+    cache = attachment_cache.AttachmentCache(str(tmp_path / "cache"), max_bytes=2 * encoded_size)
+    attachment_cache.cache = cache
+    urls = [f"http://example.com/{name}.pdf" for name in "abc"]
+    session = FakeSession(*(FakeResponse(200, b"x" * 30) for _ in urls))
+
+    async def run():
+        await dependencies.fetch_cached(session, urls[0], str(tmp_path))
+        await dependencies.fetch_cached(session, urls[1], str(tmp_path))
+        cache.get(urls[0])
+        await dependencies.fetch_cached(session, urls[2], str(tmp_path))
+
+    asyncio.run(run())
+    assert cache.get(urls[1]) is None
+    assert cache.get(urls[0]) is not None
+    assert cache.total_bytes == 2 * encoded_size
+    assert len([name for name in os.listdir(tmp_path / "cache") if name != ".lock"]) == 4
+
+
+def test_cache_survives_restart(tmp_path):
+    attachment_cache.cache = attachment_cache.AttachmentCache(str(tmp_path / "cache"))
+    fetch(FakeSession(FakeResponse(200, b"data", {"ETag": '"v1"'})), tmp_path)
+    reloaded = attachment_cache.AttachmentCache(str(tmp_path / "cache"))
+    assert reloaded.get(URL).etag == '"v1"'
+    assert reloaded.total_bytes == len(base64.encodebytes(b"data"))
+
+
+def test_build_email_uses_cached_payload(tmp_path, monkeypatch):
+    dependencies.settings = dependencies.Config()
+    attachment_cache.cache = attachment_cache.AttachmentCache(str(tmp_path / "cache"))
+
+    async def cached(session, url, temp_dir, budget=None):
+        path = os.path.join(temp_dir, "logo.b64")
+        with open(path, "wb") as file:
+            file.write(base64.encodebytes(b"data"))
+        return attachment_cache.CachedAttachment("logo.png", 4, path)
+
+    async def no_download(*args, **kwargs):
+        raise AssertionError("cache hit must not download")
+
+    monkeypatch.setattr(dependencies, "fetch_cached", cached)
+    monkeypatch.setattr(dependencies, "fetch_file", no_download)
+    try:
+        msg = asyncio.run(dependencies.build_email(["a@b.com"], "S", "B", file_urls=[URL]))
+    finally:
+        dependencies.settings = None
+    part = msg.get_payload()[1]
+    assert part.get_content_type() == "image/png"
+    assert part["Content-Transfer-Encoding"] == "base64"
+    assert part.get_payload(decode=True) == b"data"
+
+
+def test_workers_share_the_byte_limit(tmp_path):
+    encoded_size = len(base64.encodebytes(b"x" * 30))
+    directory = str(tmp_path / "cache")
+    first = attachment_cache.AttachmentCache(directory, max_bytes=2 * encoded_size)
+    second = attachment_cache.AttachmentCache(directory, max_bytes=2 * encoded_size)
+    urls = [f"http://example.com/{name}.pdf" for name in "abc"]
+
+    async def run():
+        attachment_cache.cache = first
+        await dependencies.fetch_cached(FakeSession(FakeResponse(200, b"x" * 30)), urls[0], str(tmp_path))
+        attachment_cache.cache = second
+        # A URL stored by the other worker is a hit.
+        await dependencies.fetch_cached(FakeSession(), urls[0], str(tmp_path))
+        await dependencies.fetch_cached(FakeSession(FakeResponse(200, b"x" * 30)), urls[1], str(tmp_path))
+        attachment_cache.cache = first
+        await dependencies.fetch_cached(FakeSession(FakeResponse(200, b"x" * 30)), urls[2], str(tmp_path))
+
+    asyncio.run(run())
+    payloads = [name for name in os.listdir(directory) if name.endswith(".b64")]
+    assert len(payloads) == 2
+    assert first.total_bytes == 2 * encoded_size
+    assert first.get(urls[0]) is None
+
+
+def test_concurrent_stores_of_one_url_use_separate_temp_files(tmp_path):
+    directory = str(tmp_path / "cache")
+    workers = [attachment_cache.AttachmentCache(directory) for _ in range(2)]
+    sources = []
+    for i, data in enumerate((b"a" * 100_000, b"b" * 100_000)):
+        path = tmp_path / f"download{i}"
+        path.write_bytes(data)
+        sources.append(str(path))
+
+    async def run():
+        return await asyncio.gather(
+            *(cache.store(URL, "logo.png", source, str(tmp_path)) for cache, source in zip(workers, sources))
+        )
+
+    results = asyncio.run(run())
+    assert [decoded(cached) for cached in results] == [b"a" * 100_000, b"b" * 100_000]
+    assert not [name for name in os.listdir(directory) if name.endswith(".tmp")]
+
+
+def test_unpinnable_download_is_sent_directly(tmp_path, monkeypatch):
+    cache = attachment_cache.AttachmentCache(str(tmp_path / "cache"))
+    attachment_cache.cache = cache
+    monkeypatch.setattr(cache, "_link", lambda url, source, directory: None)
+    result = fetch(FakeSession(FakeResponse(200, b"png-bytes")), tmp_path)
+    assert result == str(tmp_path / "logo.png")
+    with open(result, "rb") as file:
+        assert file.read() == b"png-bytes"
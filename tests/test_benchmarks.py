@@ -0,0 +1,86 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+from email.message import EmailMessage
+
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import dependencies  # noqa: E402
+from app.services import imap_client, imap_pool, smtp_pool  # noqa: E402
+from benchmarks import run  # noqa: E402
+from benchmarks.fakes import FakeIMAPServer, FakeMailbox, FakeSMTPServer  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def settings():
+    previous = dependencies.settings
+    dependencies.settings = dependencies.Config()
+    yield
+    dependencies.settings = previous
+    imap_pool.pool = None
+
+
+def test_imap_client_runs_against_fake_server():
+    async def scenario():
+        server = FakeIMAPServer(FakeMailbox(messages=50, body_size=100))
+        await server.start()
+        imap_pool.pool = imap_pool.IMAPPool("127.0.0.1", server.port, "user", "pass", size=1, use_ssl=False)
+        try:
+            page = await imap_client.fetch_page(limit=5)
+            context = await imap_client.fetch_reply_context("7")
+            await imap_client.move_message("7", "Archive")
+            folders = await imap_client.list_folders(with_status=True)
+        finally:
+            await imap_pool.pool.close()
+            await server.stop()
+        return server, page, context, folders
+
+    server, page, context, folders = asyncio.run(scenario())
+    assert [summary.uid for summary in page.messages] == ["46", "47", "48", "49", "50"]
+    assert page.messages[0].from_ == "sender46@example.com"
+    assert (context.subject, context.message_id) == ("Benchmark message 7", "<7@bench.example.com>")
+    assert context.body.startswith("Line of message 7")
+    assert folders[0].name == "INBOX" and folders[0].messages == 50
+    assert server.commands["LOGIN"] == 1 and server.commands["UID MOVE"] == 1
+
+
+def test_smtp_sessions_against_fake_server():
+    async def scenario():
+        server = FakeSMTPServer()
+        await server.start()
+        smtp = await smtp_pool.open_connection("127.0.0.1", server.port, "user", "pass", start_tls=False)
+        msg = EmailMessage()
+        msg["From"] = "me@example.com"
+        msg["To"] = "you@example.com"
+        msg["Subject"] = "Hi"
+        msg.set_content("hello")
+        _, reply = await smtp_pool.send_message(smtp, msg)
+        await smtp.quit()
+        await server.stop()
+        return server, reply
+
+    server, reply = asyncio.run(scenario())
+    assert reply == "queued"
+    assert (server.sessions, server.logins, server.messages) == (1, 1, 1)
+
+
+def test_summary_percentiles_and_baseline_change():
+    result = run.summarize([i / 1000 for i in range(1, 101)], {"200": 98, "500": 2}, elapsed=2.0)
+    assert result["latency_ms"]["p50"] == 50.0
+    assert result["latency_ms"]["p95"] == 95.0
+    assert result["latency_ms"]["p99"] == 99.0
+    assert (result["rps"], result["errors"]) == (50.0, 2)
+
+    baseline = {"routes": {"send": {"rps": 40.0, "latency_ms": {"p95": 100.0}}}}
+    report = {"routes": {"send": {"rps": 50.0, "latency_ms": {"p95": 80.0}}, "move": result}}
+    assert run.compare(report, baseline) == {"send": {"rps": 0.25, "p95": -0.2}}
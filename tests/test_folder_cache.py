@@ -0,0 +1,79 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import events, folder_cache, imap_client  # noqa: E402
+
+
+class FakeServer:
+    def __init__(self):
+        self.listings = 0
+        self.status_calls = []
+        self.unseen = 3
+
+    async def list_folders(self, with_status=False):
+        self.listings += 1
+        folders = [imap_client.Folder("INBOX"), imap_client.Folder("Archive")]
+        if with_status:
+            for folder in folders:
+                folder.messages, folder.unseen, folder.uidnext = 10, self.unseen, 11
+        return folders
+
+    async def folder_status(self, names):
+        self.status_calls.append(names)
+        return {name: imap_client.Folder(name, messages=10, unseen=self.unseen, uidnext=11) for name in names}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    fake = FakeServer()
+    monkeypatch.setattr(imap_client, "list_folders", fake.list_folders)
+    monkeypatch.setattr(imap_client, "folder_status", fake.folder_status)
+    return fake
+
+
+def test_listing_is_cached_until_ttl(server):
+    cache = folder_cache.FolderCache(ttl=300, status_ttl=300)
+
+    async def run():
+        await cache.folders()
+        await cache.folders()
+        await cache.folders(refresh=True)
+
+    asyncio.run(run())
+    assert server.listings == 2
+
+
+def test_event_refreshes_only_that_folders_counts(server):
+    cache = folder_cache.FolderCache(ttl=300, status_ttl=300)
+    cache.start()
+    try:
+
+        async def run():
+            await cache.folders(with_status=True)
+            server.unseen = 4
+            events.bus.publish(events.MailEvent("Archive", "new", [12], 1))
+            return await cache.folders(with_status=True)
+
+        folders = asyncio.run(run())
+    finally:
+        cache.stop()
+    assert server.listings == 1
+    assert server.status_calls == [["Archive"]]
+    assert [folder.unseen for folder in folders] == [3, 4]
+
+
+def test_concurrent_callers_share_one_refresh(server):
+    cache = folder_cache.FolderCache()
+
+    async def run():
+        return await asyncio.gather(*(cache.folders(with_status=True) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert server.listings == 1
+    assert all(result[0].messages == 10 for result in results)
@@ -0,0 +1,317 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import dependencies  # noqa: E402
+from app.services import header_index, imap_client, imap_pool, mail_watcher  # noqa: E402
+from app.services.imap_protocol import IMAPResponse, MailboxState, parse_uid_set, parse_untagged  # noqa: E402
+
+
+class FakeMailbox:
+    """In-memory mailbox answering the commands the index sync issues."""
+
+    def __init__(self, capabilities=()):
+        self.capabilities = set(capabilities)
+        self.uidvalidity = 1
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = {}
+        self.commands = []
+
+    def add(self, subject, seen=False, size=100, body="hello"):
+        self.modseq += 1
+        self.messages[self.uidnext] = {
+            "subject": subject, "seen": seen, "modseq": self.modseq, "size": size, "body": body
+        }
+        self.uidnext += 1
+
+    def set_seen(self, uid, seen=True):
+        self.modseq += 1
+        self.messages[uid].update(seen=seen, modseq=self.modseq)
+
+    def expunge(self, uid):
+        del self.messages[uid]
+
+
+class FakeConnection:
+    def __init__(self, box):
+        self.box = box
+        self.untagged_handlers = []
+        self.mailbox = None
+
+    def has_capability(self, name):
+        return name in self.box.capabilities
+
+    async def enable(self, *extensions):
+        pass
+
+    async def select(self, folder, readonly=False, params=None, force=False):
+        self.box.commands.append(("SELECT", params))
+        condstore = "CONDSTORE" in self.box.capabilities
+        self.mailbox = MailboxState(
+            folder,
+            exists=len(self.box.messages),
+            uidvalidity=self.box.uidvalidity,
+            uidnext=self.box.uidnext,
+            highestmodseq=self.box.modseq if condstore else None,
+        )
+        return self.mailbox
+
+    def _uids(self, spec):
+        if spec.endswith(":*"):
+            start = int(spec[:-2])
+            uids = [uid for uid in self.box.messages if uid >= start]
+            return uids or ([max(self.box.messages)] if self.box.messages else [])
+        return [uid for uid in parse_uid_set(spec) if uid in self.box.messages]
+
+    async def uid(self, cmd, *args):
+        self.box.commands.append((cmd, args))
+        if cmd == "SEARCH":
+            spec = args[0].split(" ", 1)[1] if args[0].startswith("UID ") else "1:*"
+            uids = " ".join(str(uid) for uid in sorted(self._uids(spec)))
+            return IMAPResponse("OK", "", [parse_untagged(f"* SEARCH {uids}\r\n".encode())])
+        uids = sorted(self._uids(args[0]))
+        if len(args) > 2:
+            since = int(args[2].strip("()").split()[1])
+            uids = [uid for uid in uids if self.box.messages[uid]["modseq"] > since]
+        untagged = []
+        for seq, uid in enumerate(uids, 1):
+            message = self.box.messages[uid]
+            flags = "\\Seen" if message["seen"] else ""
+            raw = f"* {seq} FETCH (UID {uid} FLAGS ({flags}) MODSEQ ({message['modseq']})".encode()
+            if "ENVELOPE" in args[1]:
+                envelope = f'(NIL "{message["subject"]}" ((NIL NIL "a" "example.com")) NIL NIL NIL NIL NIL NIL NIL)'
+                raw += b" RFC822.SIZE %d ENVELOPE %s" % (message["size"], envelope.encode())
+            if "BODYSTRUCTURE" in args[1]:
+                raw += b' BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" %d 1)' % message["size"]
+            if "BODY.PEEK[1]" in args[1]:
+                text = message["body"].encode()
+                raw += b" BODY[1] {%d}\r\n%s" % (len(text), text)
+            untagged.append(parse_untagged(raw + b")\r\n"))
+        return IMAPResponse("OK", "", untagged)
+
+    async def logout(self):
+        pass
+
+
+@pytest.fixture
+def box(monkeypatch, tmp_path):
+    dependencies.settings = dependencies.Config()
+    mailbox = FakeMailbox()
+
+    async def opener(*args, **kwargs):
+        return FakeConnection(mailbox)
+
+    monkeypatch.setattr(imap_pool, "open_connection", opener)
+    header_index.index = header_index.HeaderIndex(str(tmp_path / "index.sqlite3"))
+    yield mailbox
+    header_index.index.close()
+    header_index.index = None
+    dependencies.settings = None
+
+
+def fetched_headers(box):
+    return [args[0] for cmd, args in box.commands if cmd == "FETCH" and "ENVELOPE" in args[1]]
+
+
+def test_index_sync_downloads_only_new_messages(box):
+    for i in range(3):
+        box.add(f"m{i}")
+    first = asyncio.run(imap_client.fetch_messages(limit=2))
+    assert [s.subject for s in first] == ["m1", "m2"]
+    box.add("m3")
+    box.commands.clear()
+    second = asyncio.run(imap_client.fetch_messages(limit=2))
+    assert [s.subject for s in second] == ["m2", "m3"]
+    assert fetched_headers(box) == ["4"]
+
+
+def test_index_sync_refreshes_flags_and_unread_filter(box):
+    box.add("a")
+    box.add("b")
+    asyncio.run(imap_client.fetch_messages())
+    box.set_seen(1)
+    unread = asyncio.run(imap_client.fetch_messages(unread_only=True))
+    assert [s.subject for s in unread] == ["b"]
+
+
+def test_index_sync_uses_condstore_changedsince(box):
+    box.capabilities.add("CONDSTORE")
+    box.add("a")
+    box.add("b")
+    asyncio.run(imap_client.fetch_messages())
+    box.commands.clear()
+    asyncio.run(imap_client.fetch_messages())
+    assert [cmd for cmd, _ in box.commands] == ["SELECT"]
+    box.set_seen(2)
+    box.commands.clear()
+    summaries = asyncio.run(imap_client.fetch_messages())
+    flag_fetch = [args for cmd, args in box.commands if cmd == "FETCH"]
+    assert flag_fetch == [("1:2", "(UID FLAGS)", "(CHANGEDSINCE 3)")]
+    assert [s.seen for s in summaries] == [False, True]
+
+
+def test_index_sync_drops_expunged_messages(box):
+    for i in range(3):
+        box.add(f"m{i}")
+    asyncio.run(imap_client.fetch_messages())
+    box.expunge(2)
+    summaries = asyncio.run(imap_client.fetch_messages())
+    assert [s.uid for s in summaries] == ["1", "3"]
+
+
+def test_index_invalidated_on_uidvalidity_change(box):
+    box.add("old")
+    asyncio.run(imap_client.fetch_messages())
+    box.uidvalidity = 2
+    box.messages = {}
+    box.uidnext = 1
+    box.add("new")
+    summaries = asyncio.run(imap_client.fetch_messages())
+    assert [s.subject for s in summaries] == ["new"]
+
+
+def test_index_serves_fresh_folder_without_imap(box):
+    header_index.index.max_age = 60
+    box.add("a")
+    asyncio.run(imap_client.fetch_messages())
+    box.commands.clear()
+    summaries = asyncio.run(imap_client.fetch_messages())
+    assert box.commands == []
+    assert [s.subject for s in summaries] == ["a"]
+
+
+def test_index_pages_by_cursor_in_sort_order(box):
+    for subject, size in [("c", 300), ("a", 100), ("d", 400), ("b", 200), ("e", 500)]:
+        box.add(subject, size=size)
+    header_index.index.max_age = 60
+    walked = []
+    cursor = None
+    while True:
+        page = asyncio.run(imap_client.fetch_page(limit=2, sort="size", cursor=cursor))
+        walked = [s.subject for s in page.messages] + walked
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert walked == ["a", "b", "c", "d", "e"]
+    assert [cmd for cmd, _ in box.commands].count("SELECT") == 1
+    first = asyncio.run(imap_client.fetch_page(limit=2, sort="size"))
+    with pytest.raises(imap_client.InvalidCursor):
+        asyncio.run(imap_client.fetch_page(limit=2, sort="date", cursor=first.next_cursor))
+    tampered = imap_client.PageCursor.decode(first.next_cursor)
+    tampered.key = {"nested": [1]}
+    with pytest.raises(imap_client.InvalidCursor):
+        asyncio.run(imap_client.fetch_page(limit=2, sort="size", cursor=tampered.encode()))
+
+
+def test_index_syncs_only_for_the_first_page(box):
+    for i in range(5):
+        box.add(f"m{i}")
+    page = asyncio.run(imap_client.fetch_page(limit=2))
+    box.commands.clear()
+    while page.next_cursor:
+        page = asyncio.run(imap_client.fetch_page(limit=2, cursor=page.next_cursor))
+    assert box.commands == []
+    asyncio.run(imap_client.fetch_page(limit=2))
+    assert [cmd for cmd, _ in box.commands][0] == "SELECT"
+
+
+@pytest.fixture
+def fulltext_box(box, tmp_path):
+    header_index.index.close()
+    header_index.index = header_index.HeaderIndex(str(tmp_path / "fulltext.sqlite3"), fulltext=True)
+    return box
+
+
+def search(text, folder=None):
+    return asyncio.run(header_index.index.search(text, folder))
+
+
+def sync_and_backfill():
+    async def run():
+        await imap_client.fetch_messages()
+        await asyncio.gather(*imap_client._body_tasks.values())
+
+    asyncio.run(run())
+
+
+def body_fetches(box):
+    return [args for cmd, args in box.commands if cmd == "FETCH" and "BODY.PEEK[" in args[1]]
+
+
+def test_fulltext_backfills_text_sections_in_background(fulltext_box, monkeypatch):
+    fulltext_box.add("Quarterly report", body="numbers attached")
+    fulltext_box.add("Lunch", body="the quarterly numbers look great")
+    fulltext_box.add("Huge scan", body="quarterly", size=10 * 1024 * 1024)
+    index_bodies = imap_client.index_bodies
+
+    async def run():
+        release = asyncio.Event()
+
+        async def held(*args):
+            await release.wait()
+            await index_bodies(*args)
+
+        monkeypatch.setattr(imap_client, "index_bodies", held)
+        # The listing returns while the body backfill is still waiting to run.
+        await imap_client.fetch_messages()
+        assert body_fetches(fulltext_box) == []
+        release.set()
+        await asyncio.gather(*imap_client._body_tasks.values())
+
+    asyncio.run(run())
+    monkeypatch.setattr(imap_client, "index_bodies", index_bodies)
+    assert body_fetches(fulltext_box) == [("1:2", "(UID BODY.PEEK[1])")]
+    hits = search("quarterly numbers")
+    # Subject matches outrank body matches; the oversized text part is not downloaded.
+    assert [hit.summary.subject for hit in hits] == ["Quarterly report", "Lunch"]
+    assert hits[0].folder == "INBOX" and hits[0].score > hits[1].score
+    assert [hit.summary.uid for hit in search("scan")] == ["3"]
+
+    fulltext_box.add("Later", body="more")
+    fulltext_box.commands.clear()
+    sync_and_backfill()
+    assert body_fetches(fulltext_box) == [("4", "(UID BODY.PEEK[1])")]
+
+
+def test_watcher_backfills_bodies_after_sync(fulltext_box):
+    fulltext_box.add("Minutes", body="budget approved")
+    conn = FakeConnection(fulltext_box)
+    watcher = mail_watcher.MailWatcher(["INBOX"], {})
+    asyncio.run(watcher._sync(conn, "INBOX"))
+    assert [hit.summary.subject for hit in search("budget")] == ["Minutes"]
+
+
+def test_fulltext_follows_expunge_and_uidvalidity(fulltext_box):
+    fulltext_box.add("first", body="alpha")
+    fulltext_box.add("second", body="alpha beta")
+    sync_and_backfill()
+    fulltext_box.expunge(1)
+    asyncio.run(imap_client.fetch_messages())
+    assert [hit.summary.subject for hit in search("alpha")] == ["second"]
+
+    fulltext_box.uidvalidity = 2
+    fulltext_box.messages = {}
+    fulltext_box.uidnext = 1
+    fulltext_box.add("third", body="gamma")
+    sync_and_backfill()
+    assert search("alpha") == []
+    assert [hit.summary.subject for hit in search("gamma", folder="INBOX")] == ["third"]
+
+
+def test_fulltext_terms_ignore_query_syntax(fulltext_box):
+    fulltext_box.add("a", body='say "NEAR" OR (this)')
+    sync_and_backfill()
+    assert [hit.summary.subject for hit in search('NEAR" OR (this')] == ["a"]
@@ -0,0 +1,71 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import http_client  # noqa: E402
+from app import dependencies  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def reset_session():
+    yield
+    http_client.session = None
+
+
+def test_create_session_applies_connector_settings(monkeypatch):
+    monkeypatch.setenv("HTTP_POOL_LIMIT", "20")
+    monkeypatch.setenv("HTTP_POOL_LIMIT_PER_HOST", "4")
+    monkeypatch.setenv("HTTP_DNS_CACHE_TTL", "60")
+    settings = dependencies.Config()
+
+    async def run():
+        session = http_client.create_session(settings)
+        connector = session.connector
+        await session.close()
+        return connector
+
+    connector = asyncio.run(run())
+    assert connector.limit == 20
+    assert connector.limit_per_host == 4
+    assert connector.use_dns_cache
+    assert connector._cached_hosts._ttl == 60
+
+
+def test_client_reuses_shared_session():
+    settings = dependencies.Config()
+
+    async def run():
+        http_client.session = http_client.create_session(settings)
+        async with http_client.client(settings) as first:
+            pass
+        async with http_client.client(settings) as second:
+            pass
+        shared = http_client.session
+        await shared.close()
+        return first, second, shared
+
+    first, second, shared = asyncio.run(run())
+    assert first is shared and second is shared
+
+
+def test_client_falls_back_to_temporary_session():
+    settings = dependencies.Config()
+
+    async def run():
+        async with http_client.client(settings) as session:
+            assert not session.closed
+        return session
+
+    assert asyncio.run(run()).closed
@@ -2,11 +2,10 @@
 import asyncio
 import os
 import sys
-from datetime import datetime
+from datetime import date, datetime
 from email.message import EmailMessage, Message
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import imaplib
 import pytest
 
 os.environ["ACCOUNT_EMAIL"] = "user@example.com"
@@ -18,7 +17,9 @@ os.environ["ACCOUNT_IMAP_PORT"] = "993"
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from app.services import imap_client  # noqa: E402
+from app.services import imap_client, imap_pool  # noqa: E402
+from app.services.imap_protocol import IMAPResponse, Literal, MailboxState, parse_untagged  # noqa: E402
+from app.models import SearchRequest  # noqa: E402
 from app import dependencies  # noqa: E402
 
 
@@ -26,6 +27,7 @@ from app import dependencies  # noqa: E402
 def setup_settings():
     dependencies.settings = dependencies.Config()
     imap_client.settings = dependencies.settings
+    imap_client._sort_cache.clear()
     yield
     dependencies.settings = None
 
@@ -48,299 +50,693 @@ def test_extract_body_multipart():
     assert imap_client.extract_body(msg).strip() == "plain"
 
 
-class DummyIMAPList:
-    def login(self, *args, **kwargs):
-        pass
+def responses(*raw: bytes, status: str = "OK") -> IMAPResponse:
+    return IMAPResponse(status, "", [parse_untagged(r) for r in raw])
 
-    def list(self):
-        return "OK", [
-            b'(\\HasNoChildren) "/" "INBOX"',
-            b'(\\HasNoChildren) "/" "Archive"',
-        ]
 
-    def __enter__(self):
-        return self
+def use_connection(monkeypatch, conn):
+    async def opener(*args, **kwargs):
+        return conn
+
+    monkeypatch.setattr(imap_pool, "open_connection", opener)
+
+
+class DummyIMAP:
+    mailbox = None
+    capabilities: set = set()
+
+    def has_capability(self, name):
+        return name in self.capabilities
+
+    async def select(self, folder, readonly=False):
+        self.folder = folder
+
+    async def logout(self):
+        self.logged_out = True
+
 
-    def __exit__(self, *args):
-        pass
+class DummyIMAPList(DummyIMAP):
+    async def command(self, name, *args):
+        return responses(
+            b'* LIST (\\HasNoChildren) "/" "INBOX"\r\n',
+            b'* LIST (\\HasNoChildren) "/" "Archive"\r\n',
+        )
 
 
 def test_list_mailboxes(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPList())
+    use_connection(monkeypatch, DummyIMAPList())
     boxes = asyncio.run(imap_client.list_mailboxes())
     assert boxes == ["INBOX", "Archive"]
 
 
-class DummyIMAPListFail:
-    def login(self, *args, **kwargs):
-        pass
+class DummyIMAPListQuoted(DummyIMAP):
+    async def command(self, name, *args):
+        return responses(b'* LIST () "/" "My \\"Quoted\\" Box"\r\n')
 
-    def list(self):
-        return "NO", None
 
-    def __enter__(self):
-        return self
+def test_list_mailboxes_quoted_names(monkeypatch):
+    use_connection(monkeypatch, DummyIMAPListQuoted())
+    assert asyncio.run(imap_client.list_mailboxes()) == ['My "Quoted" Box']
 
-    def __exit__(self, *args):
-        pass
 
+class DummyIMAPListStatus(DummyIMAP):
+    def __init__(self, capabilities=()):
+        self.capabilities = set(capabilities)
+        self.commands = []
+        self.pipelined = []
 
-def test_list_mailboxes_failure(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPListFail())
-    boxes = asyncio.run(imap_client.list_mailboxes())
-    assert boxes == []
+    async def command(self, name, *args):
+        self.commands.append((name,) + args)
+        if name == "STATUS":
+            return responses(b'* STATUS "Caf\xc3\xa9" (MESSAGES 1 UNSEEN 1 UIDNEXT 2)\r\n')
+        listing = [
+            b'* LIST (\\HasNoChildren) "/" "INBOX"\r\n',
+            b'* LIST (\\Noselect) "/" "Shared"\r\n',
+            b'* LIST () "/" {5}\r\nCaf\xc3\xa9\r\n',
+        ]
+        if "LIST-STATUS" in self.capabilities:
+            listing.append(b'* STATUS "INBOX" (MESSAGES 12 UNSEEN 3 UIDNEXT 40)\r\n')
+        return responses(*listing)
 
+    async def pipeline(self, commands):
+        self.pipelined.extend(commands)
+        return [responses(b'* STATUS "INBOX" (MESSAGES 12 UNSEEN 3 UIDNEXT 40)\r\n')]
 
-class DummyIMAPFetch:
-    def login(self, *args, **kwargs):
-        pass
 
-    def select(self, folder):
-        pass
+def test_list_folders_uses_list_status(monkeypatch):
+    dummy = DummyIMAPListStatus({"LIST-STATUS"})
+    use_connection(monkeypatch, dummy)
+    folders = asyncio.run(imap_client.list_folders(with_status=True))
+    assert dummy.commands == [("LIST", '""', '"*"', "RETURN (STATUS (MESSAGES UNSEEN UIDNEXT))")]
+    assert (folders[0].name, folders[0].messages, folders[0].unseen, folders[0].uidnext) == ("INBOX", 12, 3, 40)
+    assert folders[1].flags == ["\\Noselect"] and folders[1].messages is None
 
-    def search(self, charset, criteria):
-        return "OK", [b"1"]
 
-    def uid(self, cmd, uid, args):
-        if cmd == "fetch":
-            msg = EmailMessage()
-            msg["Subject"] = "=?utf-8?B?VGVzdA==?="
-            msg["From"] = "test@example.com"
-            msg["Date"] = "Mon, 02 Oct 2023 13:00:00 +0000"
-            return "OK", [(b"1 (FLAGS (\\Seen))", bytes(msg))]
-        return "NO", []
+def test_list_folders_pipelines_status(monkeypatch):
+    dummy = DummyIMAPListStatus()
+    use_connection(monkeypatch, dummy)
+    folders = asyncio.run(imap_client.list_folders(with_status=True))
+    # Shared is not selectable; the non-ASCII name needs a literal, so it is sent on its own.
+    assert dummy.pipelined == [("STATUS", '"INBOX"', "(MESSAGES UNSEEN UIDNEXT)")]
+    assert [command[0] for command in dummy.commands] == ["LIST", "STATUS"]
+    assert folders[0].unseen == 3
+    assert folders[2].name == "Café" and folders[2].uidnext == 2
+
+
+class DummyIMAPListFail(DummyIMAP):
+    async def command(self, name, *args):
+        return IMAPResponse("NO", "failed")
+
 
-    def __enter__(self):
-        return self
+def test_list_mailboxes_failure(monkeypatch):
+    use_connection(monkeypatch, DummyIMAPListFail())
+    boxes = asyncio.run(imap_client.list_mailboxes())
+    assert boxes == []
+
+
+def envelope(subject: str = "=?utf-8?B?VGVzdA==?=", sender: str = "test@example.com", date: str = "Mon, 02 Oct 2023 13:00:00 +0000") -> bytes:
+    mailbox, host = sender.split("@")
+    return (
+        f'ENVELOPE ("{date}" "{subject}" (("Tester" NIL "{mailbox}" "{host}")) NIL NIL NIL NIL NIL NIL "<1@x>")'
+    ).encode()
 
-    def __exit__(self, *args):
-        pass
+
+class DummyIMAPFetch(DummyIMAP):
+    async def uid(self, cmd, *args):
+        if cmd == "SEARCH":
+            return responses(b"* SEARCH 1\r\n")
+        if cmd == "FETCH":
+            return responses(b"* 1 FETCH (UID 1 FLAGS (\\Seen) " + envelope() + b")\r\n")
+        return IMAPResponse("NO", "")
 
 
 def test_fetch_messages(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPFetch())
+    use_connection(monkeypatch, DummyIMAPFetch())
     summaries = asyncio.run(imap_client.fetch_messages())
     assert summaries[0].subject == "Test"
+    assert summaries[0].from_ == "test@example.com"
+    assert summaries[0].date.isoformat() == "2023-10-02T13:00:00+00:00"
 
 
-class DummyIMAPFetchFail:
-    def login(self, *args, **kwargs):
-        pass
-
-    def select(self, folder):
-        pass
+def test_parse_summary_falls_back_to_internaldate():
+    item = parse_untagged(
+        b'* 1 FETCH (UID 3 FLAGS () INTERNALDATE "17-Jul-1996 02:44:25 -0700" '
+        b'ENVELOPE (NIL NIL ((NIL NIL "undisclosed-recipients" NIL)) NIL NIL NIL NIL NIL NIL NIL))\r\n'
+    )
+    summary = imap_client._parse_summary(imap_client.fetch_items(item))
+    assert summary.subject == ""
+    assert summary.from_ == "undisclosed-recipients"
+    assert summary.date.isoformat() == "1996-07-17T02:44:25-07:00"
 
-    def search(self, charset, criteria):
-        return "NO", None
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *args):
-        pass
+class DummyIMAPFetchBatch(DummyIMAP):
+    def __init__(self):
+        self.commands = []
+
+    async def uid(self, cmd, *args):
+        self.commands.append((cmd, args))
+        if cmd == "SEARCH":
+            return responses(b"* SEARCH 1 2 3 4 5 9 12\r\n")
+        header = envelope("Hi", "a@example.com")
+        return responses(
+            b"* 4 FETCH (UID 12 " + header + b" FLAGS (\\Seen))\r\n",
+            b"* 2 FETCH (UID 9 FLAGS () " + header + b")\r\n",
+            b"* 1 FETCH (UID 5 FLAGS (\\Seen) " + header + b")\r\n",
+        )
+
+
+def test_fetch_messages_single_batched_fetch(monkeypatch):
+    dummy = DummyIMAPFetchBatch()
+    use_connection(monkeypatch, dummy)
+    summaries = asyncio.run(imap_client.fetch_messages(limit=3))
+    assert [cmd for cmd, _ in dummy.commands] == ["SEARCH", "FETCH"]
+    assert dummy.commands[1][1][0] == "5,9,12"
+    assert [s.uid for s in summaries] == ["5", "9", "12"]
+    assert [s.seen for s in summaries] == [True, False, True]
+
+
+class DummyIMAPPaged(DummyIMAP):
+    """Folder of UIDs 1..n answering windowed SEARCH, SORT, and header FETCH."""
+
+    def __init__(self, uids, capabilities=(), uidvalidity=7):
+        self.uids = list(uids)
+        self.capabilities = set(capabilities)
+        self.commands = []
+        self.mailbox = MailboxState("INBOX", exists=len(self.uids), uidvalidity=uidvalidity, uidnext=max(self.uids) + 1)
+
+    def has_capability(self, name):
+        return name in self.capabilities
+
+    async def uid(self, cmd, *args):
+        self.commands.append((cmd, args))
+        if cmd == "SEARCH":
+            matched = self.uids
+            if len(args) > 1:
+                low, high = args[1].split(" ")[1].split(":")
+                top = max(self.uids) if high == "*" else int(high)
+                matched = [uid for uid in self.uids if int(low) <= uid <= top]
+            return responses(b"* SEARCH " + " ".join(map(str, matched)).encode() + b"\r\n")
+        if cmd == "SORT":
+            # Reverse size order: sizes grow with the UID modulo three.
+            ordered = sorted(self.uids, key=lambda uid: (uid % 3, uid), reverse=True)
+            if args[0].startswith("RETURN (PARTIAL "):
+                low, high = map(int, args[0][len("RETURN (PARTIAL "):-1].split(":"))
+                window = ",".join(map(str, ordered[low - 1:high])) or "NIL"
+                return responses(b'* ESEARCH (TAG "A1") UID PARTIAL (%d:%d %s)\r\n' % (low, high, window.encode()))
+            return responses(b"* SORT " + " ".join(map(str, ordered)).encode() + b"\r\n")
+        header = envelope("Hi", "a@example.com")
+        return responses(*[
+            b"* 1 FETCH (UID %d FLAGS () " % uid + header + b")\r\n"
+            for uid in imap_client.parse_uid_set(args[0])
+        ])
+
+    async def stream(self, name, cmd, *args):
+        for item in (await self.uid(cmd, *args)).untagged:
+            yield item
+
+
+def test_fetch_page_walks_folder_with_windowed_search(monkeypatch):
+    dummy = DummyIMAPPaged(range(1, 301))
+    use_connection(monkeypatch, dummy)
+    first = asyncio.run(imap_client.fetch_page(limit=5))
+    assert [s.uid for s in first.messages] == ["296", "297", "298", "299", "300"]
+    assert dummy.commands[0] == ("SEARCH", ("ALL", "UID 237:*"))
+    uids = [s.uid for s in first.messages]
+    cursor = first.next_cursor
+    while cursor:
+        page = asyncio.run(imap_client.fetch_page(limit=50, cursor=cursor))
+        uids = [s.uid for s in page.messages] + uids
+        cursor = page.next_cursor
+    assert uids == [str(uid) for uid in range(1, 301)]
+
+
+def test_fetch_page_uses_server_sort(monkeypatch):
+    dummy = DummyIMAPPaged(range(1, 7), capabilities=("SORT",))
+    use_connection(monkeypatch, dummy)
+    first = asyncio.run(imap_client.fetch_page(limit=2, sort="size"))
+    assert dummy.commands[0] == ("SORT", ("(REVERSE SIZE)", "UTF-8", "ALL"))
+    assert [s.uid for s in first.messages] == ["2", "5"]
+    second = asyncio.run(imap_client.fetch_page(limit=2, sort="size", cursor=first.next_cursor))
+    assert [s.uid for s in second.messages] == ["1", "4"]
+
+
+def test_fetch_page_reuses_sort_result_across_pages(monkeypatch):
+    dummy = DummyIMAPPaged(range(1, 7), capabilities=("SORT",))
+    use_connection(monkeypatch, dummy)
+    first = asyncio.run(imap_client.fetch_page(limit=2, sort="size"))
+    asyncio.run(imap_client.fetch_page(limit=2, sort="size", cursor=first.next_cursor))
+    assert [cmd for cmd, _ in dummy.commands].count("SORT") == 1
+    dummy.uids.append(7)
+    dummy.mailbox.uidnext = 8
+    page = asyncio.run(imap_client.fetch_page(limit=2, sort="size"))
+    assert [cmd for cmd, _ in dummy.commands].count("SORT") == 2
+    second = asyncio.run(imap_client.fetch_page(limit=2, sort="size", cursor=page.next_cursor))
+    assert [s.uid for s in second.messages] == ["4", "7"]
+
+
+def test_fetch_page_requests_only_the_window_with_context_sort(monkeypatch):
+    dummy = DummyIMAPPaged(range(1, 7), capabilities=("SORT", "CONTEXT=SORT"))
+    use_connection(monkeypatch, dummy)
+    first = asyncio.run(imap_client.fetch_page(limit=2, sort="size"))
+    assert dummy.commands[0] == ("SORT", ("RETURN (PARTIAL 1:3)", "(REVERSE SIZE)", "UTF-8", "ALL"))
+    assert [s.uid for s in first.messages] == ["2", "5"]
+    second = asyncio.run(imap_client.fetch_page(limit=2, sort="size", cursor=first.next_cursor))
+    assert dummy.commands[-2] == ("SORT", ("RETURN (PARTIAL 2:5)", "(REVERSE SIZE)", "UTF-8", "ALL"))
+    assert [s.uid for s in second.messages] == ["1", "4"]
+    # A message sorting ahead of the cursor shifts the window; the page still follows the cursor.
+    dummy.uids.append(8)
+    third = asyncio.run(imap_client.fetch_page(limit=2, sort="size", cursor=second.next_cursor))
+    assert [s.uid for s in third.messages] == ["3", "6"]
+
+
+def test_fetch_page_refuses_sort_without_server_support(monkeypatch):
+    dummy = DummyIMAPPaged(range(1, 7))
+    use_connection(monkeypatch, dummy)
+    with pytest.raises(imap_client.UnsupportedSort):
+        asyncio.run(imap_client.fetch_page(limit=2, sort="date"))
+    assert [cmd for cmd, _ in dummy.commands] == []
+
+
+def test_fetch_page_rejects_mismatched_cursor(monkeypatch):
+    dummy = DummyIMAPPaged(range(1, 20))
+    use_connection(monkeypatch, dummy)
+    cursor = asyncio.run(imap_client.fetch_page(limit=5)).next_cursor
+    with pytest.raises(imap_client.InvalidCursor):
+        asyncio.run(imap_client.fetch_page(limit=5, sort="date", cursor=cursor))
+    with pytest.raises(imap_client.InvalidCursor):
+        asyncio.run(imap_client.fetch_page(limit=5, cursor="not-a-cursor"))
+    dummy.mailbox.uidvalidity = 8
+    with pytest.raises(imap_client.InvalidCursor):
+        asyncio.run(imap_client.fetch_page(limit=5, cursor=cursor))
+
+
+def test_fetch_page_caps_page_size(monkeypatch):
+    dependencies.settings.max_page_size = 3
+    use_connection(monkeypatch, DummyIMAPPaged(range(1, 20)))
+    page = asyncio.run(imap_client.fetch_page(limit=50))
+    assert [s.uid for s in page.messages] == ["17", "18", "19"]
+
+
+def collect_stream(**kwargs):
+    async def run():
+        items = [item async for item in imap_client.stream_page(**kwargs)]
+        return items[0], items[1:]
+
+    return asyncio.run(run())
+
+
+def test_stream_page_yields_cursor_then_summaries(monkeypatch):
+    dummy = DummyIMAPPaged(range(1, 7), capabilities=("SORT",))
+    use_connection(monkeypatch, dummy)
+    head, summaries = collect_stream(limit=2, sort="size")
+    expected = asyncio.run(imap_client.fetch_page(limit=2, sort="size"))
+    assert head.messages == [] and head.next_cursor == expected.next_cursor
+    assert [s.uid for s in summaries] == ["2", "5"]
+    _, summaries = collect_stream(limit=2, sort="size", cursor=head.next_cursor)
+    assert [s.uid for s in summaries] == ["1", "4"]
+
+
+def test_stream_page_rejects_mismatched_cursor(monkeypatch):
+    use_connection(monkeypatch, DummyIMAPPaged(range(1, 7)))
+    with pytest.raises(imap_client.InvalidCursor):
+        collect_stream(limit=2, unread_only=True, cursor=imap_client.PageCursor("arrival", False, 3).encode())
+
+
+def test_compress_uids():
+    assert imap_client._compress_uids([12, 1, 2, 3, 4, 5, 9]) == "1:5,9,12"
+    assert imap_client._compress_uids([7]) == "7"
+
+
+class DummyIMAPFetchFail(DummyIMAP):
+    async def uid(self, cmd, *args):
+        return IMAPResponse("NO", "")
 
 
 def test_fetch_messages_failure(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPFetchFail())
+    use_connection(monkeypatch, DummyIMAPFetchFail())
     summaries = asyncio.run(imap_client.fetch_messages())
     assert summaries == []
 
 
-class DummyIMAPMove:
+def test_search_criteria_compiles_every_key():
+    request = SearchRequest(**{
+        "from": "alice@example.com",
+        "subject": "Résumé",
+        "since": date(2024, 3, 5),
+        "before": date(2024, 4, 1),
+        "flags": ["\\Flagged", "$Important"],
+        "without_flags": ["\\Seen"],
+        "larger": 1000,
+        "header": {"X-Priority": "1"},
+    })
+    criteria = imap_client.search_criteria(request)
+    assert criteria[:3] == ["FROM", '"alice@example.com"', "SUBJECT"]
+    assert isinstance(criteria[3], Literal) and criteria[3].data == "Résumé".encode()
+    assert criteria[4:] == [
+        "SINCE", "5-Mar-2024", "BEFORE", "1-Apr-2024",
+        "FLAGGED", "KEYWORD", "$Important", "UNSEEN",
+        "LARGER", "1000", "HEADER", '"X-Priority"', '"1"',
+    ]
+    assert imap_client.search_criteria(SearchRequest()) == ["ALL"]
+
+
+class DummyIMAPSearch(DummyIMAPPaged):
+    async def uid(self, cmd, *args):
+        if cmd != "SEARCH":
+            return await super().uid(cmd, *args)
+        self.commands.append((cmd, args))
+        low, high = args[-1].split(" ")[1].split(":")
+        top = max(self.uids) if high == "*" else int(high)
+        matched = [uid for uid in self.uids if int(low) <= uid <= top and uid % 2 == 0]
+        return responses(b"* SEARCH " + " ".join(map(str, matched)).encode() + b"\r\n")
+
+
+def test_search_page_pushes_criteria_to_server(monkeypatch):
+    dummy = DummyIMAPSearch(range(1, 101))
+    use_connection(monkeypatch, dummy)
+    criteria = imap_client.search_criteria(SearchRequest(subject="report"))
+    first = asyncio.run(imap_client.search_page(criteria, limit=3))
+    assert [s.uid for s in first.messages] == ["96", "98", "100"]
+    assert dummy.commands[0] == ("SEARCH", ("CHARSET", "UTF-8", "SUBJECT", '"report"', "UID 37:*"))
+    second = asyncio.run(imap_client.search_page(criteria, limit=3, cursor=first.next_cursor))
+    assert [s.uid for s in second.messages] == ["90", "92", "94"]
+
+    other = imap_client.search_criteria(SearchRequest(subject="invoice"))
+    with pytest.raises(imap_client.InvalidCursor):
+        asyncio.run(imap_client.search_page(other, limit=3, cursor=first.next_cursor))
+    with pytest.raises(imap_client.InvalidCursor):
+        asyncio.run(imap_client.fetch_page(limit=3, cursor=first.next_cursor))
+
+
+class DummyIMAPMove(DummyIMAP):
     def __init__(self):
         self.copied = False
         self.deleted = False
+        self.expunged = False
 
-    def login(self, *a, **k):
-        pass
-
-    def select(self, folder):
-        self.folder = folder
-
-    def uid(self, cmd, uid, *args):
+    async def uid(self, cmd, uid, *args):
         if cmd == "COPY":
             self.copied = True
         elif cmd == "STORE":
             self.deleted = True
+        return IMAPResponse("OK", "")
 
-    def expunge(self):
-        pass
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *a):
-        pass
+    async def command(self, name, *args):
+        self.expunged = name == "EXPUNGE"
+        return IMAPResponse("OK", "")
 
 
 def test_move_message(monkeypatch):
     dummy = DummyIMAPMove()
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: dummy)
+    use_connection(monkeypatch, dummy)
     asyncio.run(imap_client.move_message("1", "Dest", "INBOX"))
-    assert dummy.copied and dummy.deleted
-
+    assert dummy.folder == "INBOX"
+    assert dummy.copied and dummy.deleted and dummy.expunged
 
-class DummyIMAPMoveFail:
-    def login(self, *a, **k):
-        pass
 
-    def select(self, folder):
-        pass
-
-    def uid(self, *a, **k):
+class DummyIMAPMoveFail(DummyIMAP):
+    async def uid(self, *a, **k):
         raise RuntimeError("fail")
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *a):
-        pass
-
 
 def test_move_message_failure(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPMoveFail())
+    use_connection(monkeypatch, DummyIMAPMoveFail())
     with pytest.raises(RuntimeError):
         asyncio.run(imap_client.move_message("1", "Dest", "INBOX"))
 
 
-class DummyIMAPDelete:
-    def login(self, *a, **k):
-        pass
+class DummyIMAPMoveCopyRejected(DummyIMAPMove):
+    async def uid(self, cmd, uid, *args):
+        if cmd == "COPY":
+            return IMAPResponse("NO", "no such mailbox")
+        return await super().uid(cmd, uid, *args)
 
-    def select(self, folder):
-        pass
 
-    def uid(self, *a, **k):
-        pass
+def test_move_message_keeps_original_when_copy_fails(monkeypatch):
+    dummy = DummyIMAPMoveCopyRejected()
+    use_connection(monkeypatch, dummy)
+    with pytest.raises(RuntimeError):
+        asyncio.run(imap_client.move_message("1", "Missing", "INBOX"))
+    assert not dummy.deleted
 
-    def expunge(self):
-        self.expunge_called = True
 
-    def __enter__(self):
-        return self
+class DummyIMAPDelete(DummyIMAP):
+    async def uid(self, *a, **k):
+        return IMAPResponse("OK", "")
 
-    def __exit__(self, *a):
-        pass
+    async def command(self, name, *args):
+        self.expunge_called = name == "EXPUNGE"
+        return IMAPResponse("OK", "")
 
 
 def test_delete_message(monkeypatch):
     dummy = DummyIMAPDelete()
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: dummy)
+    use_connection(monkeypatch, dummy)
     asyncio.run(imap_client.delete_message("1"))
     assert dummy.expunge_called
 
 
-class DummyIMAPDeleteFail:
-    def login(self, *a, **k):
-        pass
-
-    def select(self, folder):
-        pass
-
-    def uid(self, *a, **k):
+class DummyIMAPDeleteFail(DummyIMAP):
+    async def uid(self, *a, **k):
         raise RuntimeError("fail")
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *a):
-        pass
-
 
 def test_delete_message_failure(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPDeleteFail())
+    use_connection(monkeypatch, DummyIMAPDeleteFail())
     with pytest.raises(RuntimeError):
         asyncio.run(imap_client.delete_message("1"))
 
 
-class DummyIMAPAppend:
-    def login(self, *a, **k):
-        pass
-
-    def append(self, folder, flags, date, data):
+class DummyIMAPBulk(DummyIMAP):
+    def __init__(self, capabilities=()):
+        self.capabilities = set(capabilities)
+        self.mailbox = MailboxState("INBOX", uidvalidity=9)
+        self.calls = []
+
+    async def uid(self, cmd, *args):
+        self.calls.append((cmd,) + args)
+        return IMAPResponse("OK", "")
+
+    async def command(self, name, *args):
+        self.calls.append((name,) + args)
+        return IMAPResponse("OK", "")
+
+
+def test_move_messages_uses_uid_move(monkeypatch):
+    dummy = DummyIMAPBulk({"MOVE"})
+    use_connection(monkeypatch, dummy)
+    count = asyncio.run(imap_client.move_messages(list(range(1, 5001)), "Archive"))
+    assert count == 5000
+    assert dummy.calls == [
+        ("MOVE", f"{start}:{start + 999}", '"Archive"') for start in range(1, 5001, 1000)
+    ]
+
+
+def test_move_messages_without_move_expunges_only_batch(monkeypatch):
+    dummy = DummyIMAPBulk({"UIDPLUS"})
+    use_connection(monkeypatch, dummy)
+    asyncio.run(imap_client.move_messages([3, 1, 2, 9], "Archive"))
+    assert dummy.calls == [
+        ("COPY", "1:3,9", '"Archive"'),
+        ("STORE", "1:3,9", "+FLAGS.SILENT", "(\\Deleted)"),
+        ("EXPUNGE", "1:3,9"),
+    ]
+
+
+class DummyIMAPDropping(DummyIMAPBulk):
+    """Session that loses the connection on its ``fail_at``-th command."""
+
+    def __init__(self, capabilities, calls, fail_at=None):
+        super().__init__(capabilities)
+        self.calls = calls
+        self.fail_at = fail_at
+        self.broken = False
+        self.sent = 0
+
+    async def uid(self, cmd, *args):
+        self.sent += 1
+        self.calls.append((cmd,) + args)
+        if self.sent == self.fail_at:
+            raise ConnectionResetError("dropped")
+        return IMAPResponse("OK", "")
+
+
+def use_sessions(monkeypatch, *sessions):
+    queue = list(sessions)
+
+    async def opener(*args, **kwargs):
+        return queue.pop(0)
+
+    monkeypatch.setattr(imap_pool, "open_connection", opener)
+    monkeypatch.setattr(imap_pool, "pool", imap_pool.IMAPPool("imap.example.com", 993, "u", "p"))
+
+
+def test_move_messages_resumes_after_drop_without_recopying(monkeypatch):
+    monkeypatch.setattr(imap_client, "BULK_BATCH_SIZE", 2)
+    calls = []
+    # The first session drops on the second batch's STORE, after its COPY succeeded.
+    use_sessions(
+        monkeypatch,
+        DummyIMAPDropping({"UIDPLUS"}, calls, fail_at=5),
+        DummyIMAPDropping({"UIDPLUS"}, calls),
+    )
+    asyncio.run(imap_client.move_messages([1, 2, 3, 4], "Archive"))
+    assert [call[:2] for call in calls] == [
+        ("COPY", "1:2"),
+        ("STORE", "1:2"),
+        ("EXPUNGE", "1:2"),
+        ("COPY", "3:4"),
+        ("STORE", "3:4"),
+        ("STORE", "3:4"),
+        ("EXPUNGE", "3:4"),
+    ]
+
+
+def test_move_messages_does_not_replay_unanswered_copy(monkeypatch):
+    calls = []
+    use_sessions(
+        monkeypatch,
+        DummyIMAPDropping({"UIDPLUS"}, calls, fail_at=1),
+        DummyIMAPDropping({"UIDPLUS"}, calls),
+    )
+    with pytest.raises(imap_client.IMAPError):
+        asyncio.run(imap_client.move_messages([1, 2], "Archive"))
+    assert [call[0] for call in calls] == ["COPY"]
+
+
+def test_delete_messages_publishes_expunged(monkeypatch):
+    dummy = DummyIMAPBulk({"UIDPLUS"})
+    use_connection(monkeypatch, dummy)
+    seen = []
+    monkeypatch.setattr(imap_client.events.bus, "publish", seen.append)
+    asyncio.run(imap_client.delete_messages([5, 6]))
+    assert dummy.calls == [("STORE", "5:6", "+FLAGS.SILENT", "(\\Deleted)"), ("EXPUNGE", "5:6")]
+    assert seen[0].kind == "expunged" and seen[0].uids == [5, 6]
+
+
+class DummyIMAPAppend(DummyIMAP):
+    async def append(self, folder, flags, date, data):
         self.appended = True
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *a):
-        pass
+        return IMAPResponse("OK", "")
 
 
 def test_append_message(monkeypatch):
     dummy = DummyIMAPAppend()
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: dummy)
+    use_connection(monkeypatch, dummy)
     msg = MIMEMultipart()
     asyncio.run(imap_client.append_message("Drafts", msg))
     assert dummy.appended
 
 
-class DummyIMAPAppendFail:
-    def login(self, *a, **k):
-        pass
-
-    def append(self, *a, **k):
+class DummyIMAPAppendFail(DummyIMAP):
+    async def append(self, *a, **k):
         raise RuntimeError("fail")
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *a):
-        pass
-
 
 def test_append_message_failure(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPAppendFail())
+    use_connection(monkeypatch, DummyIMAPAppendFail())
     msg = MIMEMultipart()
     with pytest.raises(RuntimeError):
         asyncio.run(imap_client.append_message("Drafts", msg))
 
 
-class DummyIMAPFetchMsg:
-    def login(self, *a, **k):
-        pass
-
-    def select(self, folder):
-        pass
-
-    def uid(self, cmd, uid, spec):
-        if cmd == "fetch":
+class DummyIMAPFetchMsg(DummyIMAP):
+    async def uid(self, cmd, uid, spec):
+        if cmd == "FETCH":
             msg = EmailMessage()
             msg.set_content("hi")
-            return "OK", [(None, msg.as_bytes())]
-        return "NO", []
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *a):
-        pass
+            data = msg.as_bytes()
+            return responses(b"* 1 FETCH (UID 1 RFC822 {%d}\r\n%s)\r\n" % (len(data), data))
+        return IMAPResponse("NO", "")
 
 
 def test_fetch_message(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPFetchMsg())
+    use_connection(monkeypatch, DummyIMAPFetchMsg())
     msg = asyncio.run(imap_client.fetch_message("1"))
     assert isinstance(msg, Message)
 
 
-class DummyIMAPFetchMsgFail:
-    def login(self, *a, **k):
-        pass
+class DummyIMAPFetchMsgFail(DummyIMAP):
+    async def uid(self, *a, **k):
+        return IMAPResponse("NO", "")
 
-    def select(self, folder):
-        pass
 
-    def uid(self, *a, **k):
-        return "NO", None
+def test_fetch_message_failure(monkeypatch):
+    use_connection(monkeypatch, DummyIMAPFetchMsgFail())
+    with pytest.raises(RuntimeError):
+        asyncio.run(imap_client.fetch_message("1"))
 
-    def __enter__(self):
-        return self
 
-    def __exit__(self, *a):
-        pass
+MIXED_STRUCTURE = (
+    b'((("TEXT" "PLAIN" ("CHARSET" "iso-8859-1") NIL NIL "QUOTED-PRINTABLE" 12 1 NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 20 1 NIL NIL NIL) "ALTERNATIVE")'
+    b'("APPLICATION" "PDF" ("NAME" "big.pdf") NIL NIL "BASE64" 9000000 NIL ("attachment" ("FILENAME" "big.pdf")) NIL)'
+    b' "MIXED")'
+)
 
 
-def test_fetch_message_failure(monkeypatch):
-    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda *a, **k: DummyIMAPFetchMsgFail())
+def structure(raw):
+    return parse_untagged(b"* 1 FETCH (BODYSTRUCTURE " + raw + b")").data[0][1]
+
+
+def test_text_section_walks_nested_parts():
+    section, part = imap_client._text_section(structure(MIXED_STRUCTURE))
+    assert section == "1.1"
+    assert part[1] == "PLAIN"
+
+
+def test_text_section_skips_named_text_and_enters_attached_message():
+    raw = (
+        b'(("TEXT" "PLAIN" ("NAME" "notes.txt") NIL NIL "7BIT" 5 1 NIL NIL NIL)'
+        b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 300 (NIL NIL NIL NIL NIL NIL NIL NIL NIL NIL)'
+        b' ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL) 10) "MIXED")'
+    )
+    section, _ = imap_client._text_section(structure(raw))
+    assert section == "2.1"
+
+
+def test_text_section_single_part():
+    section, _ = imap_client._text_section(structure(b'("TEXT" "HTML" NIL NIL NIL "7BIT" 5 1)'))
+    assert section == "1"
+
+
+def test_decode_part_tolerates_malformed_base64():
+    part = structure(b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 16 1)')
+    assert imap_client._decode_part(b"aGVsbG8gd29ybGQ", part) == "hello world"
+    assert imap_client._decode_part(b"aGVs\r\nbG8g*d29ybGQhx\r\n", part) == "hello world!"
+
+
+class DummyIMAPFetchParts(DummyIMAP):
+    def __init__(self):
+        self.specs = []
+
+    async def uid(self, cmd, uid, spec):
+        self.specs.append(spec)
+        if "BODYSTRUCTURE" in spec:
+            headers = b"Subject: Hello\r\nMessage-ID: <2@x>\r\nReferences: <1@x>\r\n\r\n"
+            return responses(
+                b"* 1 FETCH (UID 7 BODYSTRUCTURE " + MIXED_STRUCTURE
+                + b" BODY[HEADER.FIELDS (SUBJECT MESSAGE-ID REFERENCES)] {%d}\r\n%s)" % (len(headers), headers)
+            )
+        body = b"caf=E9 ol=\r\n\xe9"
+        return responses(b"* 1 FETCH (UID 7 BODY[1.1] {%d}\r\n%s)" % (len(body), body))
+
+
+def test_fetch_reply_context_fetches_only_text_part(monkeypatch):
+    conn = DummyIMAPFetchParts()
+    use_connection(monkeypatch, conn)
+    context = asyncio.run(imap_client.fetch_reply_context("7"))
+    assert conn.specs == [
+        "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT MESSAGE-ID REFERENCES)])",
+        "(BODY.PEEK[1.1])",
+    ]
+    assert context.subject == "Hello"
+    assert context.message_id == "<2@x>"
+    assert context.references == "<1@x>"
+    assert context.body == "café olé"
+
+
+def test_fetch_reply_context_failure(monkeypatch):
+    use_connection(monkeypatch, DummyIMAPFetchMsgFail())
     with pytest.raises(RuntimeError):
-        asyncio.run(imap_client.fetch_message("1"))
+        asyncio.run(imap_client.fetch_reply_context("1"))
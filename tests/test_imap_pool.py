@@ -0,0 +1,204 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import imap_client, imap_pool  # noqa: E402
+from app.services.imap_protocol import IMAPAbort, IMAPResponse, parse_untagged  # noqa: E402
+from app import dependencies  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def setup_settings():
+    dependencies.settings = dependencies.Config()
+    yield
+    dependencies.settings = None
+    imap_pool.pool = None
+
+
+class DummyConnection:
+    def __init__(self):
+        self.selects = []
+        self.logged_out = False
+        self.noop_ok = True
+        self.broken = False
+        self.last_used = 0.0
+        self.selected = None
+
+    async def select(self, folder, readonly=False):
+        if self.selected != folder:
+            self.selects.append(folder)
+            self.selected = folder
+
+    async def noop(self):
+        return self.noop_ok
+
+    async def logout(self):
+        self.logged_out = True
+
+    async def command(self, name, *args):
+        return IMAPResponse("OK", "", [parse_untagged(b'* LIST () "/" "INBOX"\r\n')])
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    conns = []
+
+    async def fake_open(*args, **kwargs):
+        conn = DummyConnection()
+        conns.append(conn)
+        return conn
+
+    monkeypatch.setattr(imap_pool, "open_connection", fake_open)
+    return conns
+
+
+def make_pool(**kwargs):
+    return imap_pool.IMAPPool("imap.example.com", 993, "u", "p", **kwargs)
+
+
+async def identity(conn):
+    return conn
+
+
+def test_pool_reuses_session_and_skips_redundant_select(opened):
+    async def run():
+        pool = make_pool(size=2)
+        conns = []
+        for _ in range(3):
+            conns.append(await pool.run(identity, folder="INBOX"))
+        await pool.close()
+        return conns
+
+    conns = asyncio.run(run())
+    assert len(opened) == 1
+    assert conns[0] is conns[1] is conns[2]
+    assert conns[0].selects == ["INBOX"]
+    assert conns[0].logged_out
+
+
+def test_pool_replaces_session_failing_health_check(opened):
+    async def run():
+        pool = make_pool(health_check_interval=0)
+        first = await pool.run(identity)
+        first.noop_ok = False
+        second = await pool.run(identity)
+        await pool.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first is not second
+    assert first.logged_out
+    assert len(opened) == 2
+
+
+def test_pool_evicts_idle_sessions(opened):
+    async def run():
+        pool = make_pool(idle_timeout=0)
+        first = await pool.run(identity)
+        await asyncio.sleep(0.01)
+        second = await pool.run(identity)
+        await pool.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first is not second
+    assert first.logged_out
+
+
+def test_pool_reconnects_after_abort(opened):
+    calls = []
+
+    async def op(conn):
+        calls.append(conn)
+        if len(calls) == 1:
+            raise IMAPAbort("socket error")
+        return "ok"
+
+    async def run():
+        pool = make_pool()
+        result = await pool.run(op)
+        await pool.close()
+        return result
+
+    assert asyncio.run(run()) == "ok"
+    assert calls[0] is not calls[1]
+    assert calls[0].logged_out
+
+
+def test_pool_does_not_retry_when_disabled(opened):
+    async def op(conn):
+        raise IMAPAbort("socket error")
+
+    async def run():
+        pool = make_pool()
+        try:
+            await pool.run(op, retry=False)
+        finally:
+            await pool.close()
+
+    with pytest.raises(IMAPAbort):
+        asyncio.run(run())
+    assert len(opened) == 1
+
+
+def test_pool_discards_cancelled_session(opened):
+    async def run():
+        pool = make_pool()
+        task = asyncio.create_task(pool.run(lambda conn: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        second = await pool.run(identity)
+        await pool.close()
+        return second
+
+    second = asyncio.run(run())
+    assert opened[0].broken and opened[0].logged_out
+    assert second is opened[1]
+
+
+def test_pool_bounds_concurrent_sessions(opened):
+    async def run():
+        pool = make_pool(size=2)
+        active = 0
+        peak = 0
+
+        async def use():
+            nonlocal active, peak
+            async with pool.connection():
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+
+        await asyncio.gather(*(use() for _ in range(6)))
+        await pool.close()
+        return peak
+
+    assert asyncio.run(run()) == 2
+    assert len(opened) == 2
+
+
+def test_imap_client_uses_pool(opened):
+    async def run():
+        imap_pool.pool = make_pool()
+        await imap_client.list_mailboxes()
+        boxes = await imap_client.list_mailboxes()
+        await imap_pool.pool.close()
+        return boxes
+
+    assert asyncio.run(run()) == ["INBOX"]
+    assert len(opened) == 1
@@ -0,0 +1,278 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+
+import pytest
+from prometheus_client import REGISTRY
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services.imap_protocol import (  # noqa: E402
+    IMAPAbort,
+    IMAPConnection,
+    IMAPError,
+    Literal,
+    fetch_items,
+    parse_data,
+    parse_untagged,
+    quote,
+)
+
+
+class FakeIMAPServer:
+    """Scripted IMAP server answering over a plain TCP socket."""
+
+    def __init__(self, capabilities="IMAP4rev1"):
+        self.capabilities = capabilities
+        self.received = []
+        self.server = None
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        writer.write(f"* OK [CAPABILITY {self.capabilities}] ready\r\n".encode())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tag, _, rest = line.rstrip(b"\r\n").partition(b" ")
+                if rest.endswith(b"}"):
+                    size = int(rest[rest.rindex(b"{") + 1:-1].rstrip(b"+"))
+                    if not rest.endswith(b"+}"):
+                        writer.write(b"+ go ahead\r\n")
+                        await writer.drain()
+                    literal = await reader.readexactly(size)
+                    rest += b"\r\n" + literal + (await reader.readline()).rstrip(b"\r\n")
+                self.received.append(rest)
+                command = rest.split(b" ")[0].upper()
+                if command == b"SELECT":
+                    writer.write(b"* 3 EXISTS\r\n* OK [UIDVALIDITY 42] ok\r\n* OK [UIDNEXT 7] ok\r\n")
+                elif command == b"UID" and b"FETCH" in rest:
+                    writer.write(b"* 1 FETCH (UID 5 RFC822 {5}\r\nhello FLAGS (\\Seen))\r\n")
+                elif command == b"STATUS":
+                    name = rest.split(b" ")[1]
+                    writer.write(b"* STATUS " + name + b" (MESSAGES 2)\r\n")
+                elif command == b"IDLE":
+                    writer.write(b"+ idling\r\n* 4 EXISTS\r\n")
+                    await writer.drain()
+                    self.received.append((await reader.readline()).rstrip(b"\r\n"))
+                elif command == b"SLOW":
+                    continue
+                elif command == b"LOGOUT":
+                    writer.write(b"* BYE\r\n" + tag + b" OK bye\r\n")
+                    await writer.drain()
+                    break
+                writer.write(tag + b" OK done\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def connect(server):
+    conn = IMAPConnection("127.0.0.1", server.port, use_ssl=False, timeout=2)
+    await conn.open()
+    return conn
+
+
+def test_parse_fetch_with_literal_and_section():
+    raw = b'* 2 FETCH (UID 9 BODY[HEADER.FIELDS (SUBJECT)] {13}\r\nSubject: x\r\n\r FLAGS (\\Seen \\Flagged))\r\n'
+    item = parse_untagged(raw)
+    assert item.kind == "FETCH" and item.number == 2
+    items = fetch_items(item)
+    assert items["UID"] == "9"
+    assert items["BODY[HEADER.FIELDS (SUBJECT)]"] == b"Subject: x\r\n\r"
+    assert items["FLAGS"] == ["\\Seen", "\\Flagged"]
+
+
+def test_parse_status_response_code():
+    item = parse_untagged(b"* OK [UIDVALIDITY 3857529045] UIDs valid\r\n")
+    assert item.kind == "OK"
+    assert item.code == "UIDVALIDITY 3857529045"
+    assert item.text == "UIDs valid"
+
+
+def test_parse_quoted_nil_and_nested():
+    assert parse_data(b'("a \\"b\\"" NIL (1 2))') == [['a "b"', None, ["1", "2"]]]
+
+
+def test_quote_uses_literal_for_non_ascii():
+    assert quote('in"box') == '"in\\"box"'
+    assert isinstance(quote("Entwürfe"), Literal)
+
+
+def test_connection_select_fetch_and_state():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            await conn.login("user", "pass")
+            state = await conn.select("INBOX")
+            await conn.select("INBOX")
+            response = await conn.uid("FETCH", "5", "(RFC822)")
+            await conn.logout()
+            return server, state, response
+
+    server, state, response = asyncio.run(run())
+    assert state.exists == 3 and state.uidvalidity == 42 and state.uidnext == 7
+    assert [r.split(b" ")[0] for r in server.received] == [b"LOGIN", b"CAPABILITY", b"SELECT", b"UID", b"LOGOUT"]
+    assert fetch_items(response.of_kind("FETCH")[0])["RFC822"] == b"hello"
+
+
+def test_pipeline_writes_commands_before_reading_replies():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            results = await conn.pipeline(
+                [("STATUS", quote("INBOX"), "(MESSAGES)"), ("STATUS", quote("Sent"), "(MESSAGES)")]
+            )
+            await conn.logout()
+            return server.received, results
+
+    received, results = asyncio.run(run())
+    assert received[:2] == [b'STATUS "INBOX" (MESSAGES)', b'STATUS "Sent" (MESSAGES)']
+    assert all(result.ok for result in results)
+    assert [item.data[0] for item in results[0].of_kind("STATUS")] == ["INBOX", "Sent"]
+
+
+def test_pipeline_rejects_synchronising_literals():
+    conn = IMAPConnection("127.0.0.1", 1, use_ssl=False)
+    with pytest.raises(IMAPError):
+        asyncio.run(conn.pipeline([("STATUS", quote("Café"), "(MESSAGES)")]))
+
+
+def test_idle_returns_notifications_after_done():
+    async def run():
+        async with FakeIMAPServer("IMAP4rev1 IDLE") as server:
+            conn = await connect(server)
+            await conn.select("INBOX")
+            received = await conn.idle(0.05)
+            await conn.logout()
+            return server, conn, received
+
+    server, conn, received = asyncio.run(run())
+    assert [(item.kind, item.number) for item in received] == [("EXISTS", 4)]
+    assert server.received[1:3] == [b"IDLE", b"DONE"]
+    assert conn.mailbox.exists == 4
+
+
+def test_stream_yields_untagged_then_releases_connection():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            items = [item async for item in conn.stream("UID", "FETCH", "5", "(RFC822)")]
+            response = await conn.command("NOOP")
+            await conn.logout()
+            return items, response
+
+    items, response = asyncio.run(run())
+    assert [fetch_items(item)["UID"] for item in items] == ["5"]
+    assert response.ok
+
+
+def test_abandoned_stream_breaks_connection():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            stream = conn.stream("UID", "FETCH", "5", "(RFC822)")
+            await anext(stream)
+            await stream.aclose()
+            return conn
+
+    assert asyncio.run(run()).broken
+
+
+def test_connection_sends_synchronising_literal():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            response = await conn.append("Drafts", "", "", b"Subject: x\r\n\r\nbody")
+            await conn.logout()
+            return server, response
+
+    server, response = asyncio.run(run())
+    assert response.ok
+    assert server.received[0].endswith(b"Subject: x\r\n\r\nbody")
+
+
+def test_connection_uses_literal_plus_when_advertised():
+    async def run():
+        async with FakeIMAPServer("IMAP4rev1 LITERAL+") as server:
+            conn = await connect(server)
+            response = await conn.command("LOGIN", quote("üser"), quote("pass"))
+            await conn.logout()
+            return server, response
+
+    server, response = asyncio.run(run())
+    assert response.ok
+    assert "üser".encode() in server.received[0]
+
+
+def test_cancelled_command_breaks_connection():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            task = asyncio.create_task(conn.command("SLOW"))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert conn.broken
+            with pytest.raises(IMAPAbort):
+                await conn.command("NOOP")
+
+    asyncio.run(run())
+
+
+def test_command_timeout_raises_abort():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            with pytest.raises(IMAPAbort):
+                await conn.command("SLOW", timeout=0.05)
+            assert conn.broken
+
+    asyncio.run(run())
+
+
+def test_commands_observed_in_metrics():
+    def sample(name, command):
+        return REGISTRY.get_sample_value(name, {"command": command}) or 0.0
+
+    fetches = sample("imap_command_seconds_count", "UID FETCH")
+    fetch_errors = sample("imap_command_errors_total", "UID FETCH")
+    slow_errors = sample("imap_command_errors_total", "SLOW")
+
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            await conn.uid("FETCH", "5", "(RFC822)")
+            with pytest.raises(IMAPAbort):
+                await conn.command("SLOW", timeout=0.05)
+
+    asyncio.run(run())
+    assert sample("imap_command_seconds_count", "UID FETCH") == fetches + 1
+    assert sample("imap_command_errors_total", "UID FETCH") == fetch_errors
+    assert sample("imap_command_errors_total", "SLOW") == slow_errors + 1
+
+
+def test_pipeline_rejects_line_breaks_before_writing():
+    async def run():
+        async with FakeIMAPServer() as server:
+            conn = await connect(server)
+            with pytest.raises(ValueError):
+                await conn.pipeline(
+                    [("STATUS", quote("INBOX"), "(MESSAGES)"), ("UID", "FETCH", "1\r\nA9 DELETE INBOX", "(FLAGS)")]
+                )
+            await conn.logout()
+            return server.received
+
+    received = asyncio.run(run())
+    assert received == [b"LOGOUT"]
@@ -0,0 +1,121 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import events, header_index, imap_pool, mail_watcher  # noqa: E402
+from app.services.imap_protocol import IMAPResponse, MailboxState, parse_untagged  # noqa: E402
+
+
+class IdleConnection:
+    """Connection whose IDLE replays scripted notifications, then blocks."""
+
+    def __init__(self, notifications, capabilities=("IDLE",)):
+        self.notifications = list(notifications)
+        self.capabilities = set(capabilities)
+        self.mailbox = None
+        self.selected = []
+        self.noops = 0
+        self.logged_out = False
+
+    def has_capability(self, name):
+        return name in self.capabilities
+
+    async def select(self, folder, readonly=False, params=None, force=False):
+        self.selected.append(folder)
+        self.mailbox = MailboxState(folder, exists=1, uidvalidity=7, uidnext=2)
+        return self.mailbox
+
+    async def idle(self, duration):
+        if not self.notifications:
+            await asyncio.Event().wait()
+        return [parse_untagged(self.notifications.pop(0))]
+
+    async def command(self, name, *args, timeout=None):
+        self.noops += 1
+        if not self.notifications:
+            await asyncio.Event().wait()
+        return IMAPResponse("OK", "", [parse_untagged(self.notifications.pop(0))])
+
+    async def logout(self):
+        self.logged_out = True
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = events.EventBus()
+    monkeypatch.setattr(events, "bus", bus)
+    return bus
+
+
+def watch(monkeypatch, conn, **kwargs):
+    async def opener(**connection_kwargs):
+        return conn
+
+    monkeypatch.setattr(imap_pool, "open_connection", opener)
+
+    async def run():
+        queue = events.bus.subscribe()
+        watcher = mail_watcher.MailWatcher(["INBOX"], {}, poll_interval=0, **kwargs)
+        await watcher.start()
+        received = [await asyncio.wait_for(queue.get(), 1) for _ in range(2)]
+        await watcher.stop()
+        return received
+
+    return asyncio.run(run())
+
+
+def test_watcher_publishes_idle_notifications(monkeypatch, bus):
+    conn = IdleConnection([b"* 2 EXISTS\r\n", b"* 1 FETCH (UID 1 FLAGS (\\Seen))\r\n"])
+    received = watch(monkeypatch, conn)
+    assert [(e.folder, e.kind, e.uids, e.number) for e in received] == [
+        ("INBOX", "exists", [], 2),
+        ("INBOX", "fetch", [1], 1),
+    ]
+    assert received[0].uidvalidity == 7
+    assert conn.logged_out
+
+
+def test_watcher_polls_with_noop_without_idle(monkeypatch, bus):
+    conn = IdleConnection([b"* 2 EXISTS\r\n", b"* VANISHED 1:2\r\n"], capabilities=())
+    received = watch(monkeypatch, conn)
+    assert [(e.kind, e.uids) for e in received] == [("exists", []), ("vanished", [1, 2])]
+    assert conn.noops >= 2
+
+
+def test_watcher_marks_index_folder_live(monkeypatch, bus, tmp_path):
+    conn = IdleConnection([])
+    synced = []
+
+    async def sync(conn, index, folder):
+        synced.append(folder)
+
+    monkeypatch.setattr(mail_watcher.imap_client, "sync_folder_index", sync)
+    monkeypatch.setattr(imap_pool, "open_connection", lambda **kwargs: asyncio.sleep(0, conn))
+    index = header_index.HeaderIndex(str(tmp_path / "index.sqlite3"))
+    monkeypatch.setattr(header_index, "index", index)
+
+    async def run():
+        watcher = mail_watcher.MailWatcher(["INBOX"], {})
+        await watcher.start()
+        await asyncio.sleep(0.05)
+        live = set(index.live_folders)
+        await watcher.stop()
+        return live
+
+    live = asyncio.run(run())
+    index.close()
+    assert live == {"INBOX"}
+    assert index.live_folders == set()
+    assert synced == ["INBOX"]
@@ -15,6 +15,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from app.main import app  # noqa: E402
 from app import dependencies  # noqa: E402
+from app.services import outbox  # noqa: E402
 
 
 def test_startup_with_signature(tmp_path):
@@ -40,3 +41,12 @@ def test_startup_without_signature(tmp_path):
     assert dependencies.signature_text == ""
     if temp.exists():
         temp.rename(sig_file)
+
+
+def test_async_sending_needs_a_single_worker(monkeypatch):
+    monkeypatch.setenv("WORKERS", "2")
+    with TestClient(app):
+        assert outbox.outbox is None
+    monkeypatch.setenv("WORKERS", "1")
+    with TestClient(app):
+        assert outbox.outbox is not None
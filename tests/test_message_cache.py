@@ -0,0 +1,115 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+from email.message import EmailMessage
+
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import dependencies  # noqa: E402
+from app.services import events, imap_client, imap_pool, message_cache  # noqa: E402
+from app.services.imap_protocol import IMAPResponse, MailboxState, parse_untagged  # noqa: E402
+from prometheus_client import REGISTRY  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache():
+    previous = dependencies.settings
+    dependencies.settings = dependencies.Config()
+    message_cache.cache = message_cache.MessageCache(max_bytes=10_000)
+    message_cache.cache.start()
+    yield message_cache.cache
+    message_cache.cache.stop()
+    message_cache.cache = None
+    dependencies.settings = previous
+
+
+def test_lru_evicts_by_bytes(cache):
+    overhead = message_cache.ENTRY_OVERHEAD
+    for uid in (1, 2, 3):
+        cache.put("INBOX", 7, uid, raw=b"x" * (4000 - overhead))
+    assert cache.get("INBOX", 7, 1) is None
+    assert cache.get("INBOX", 7, 3).raw.startswith(b"x")
+    assert cache.stats() == {"entries": 2, "bytes": 8000, "hits": 1, "misses": 1, "evictions": 1}
+
+
+def test_stats_are_exported_as_metrics(cache):
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    hits = sample("message_cache_lookups_total", result="hit")
+    misses = sample("message_cache_lookups_total", result="miss")
+    evictions = sample("message_cache_evictions_total")
+    overhead = message_cache.ENTRY_OVERHEAD
+    for uid in (1, 2, 3):
+        cache.put("INBOX", 7, uid, raw=b"x" * (4000 - overhead))
+    cache.get("INBOX", 7, 1)
+    cache.get("INBOX", 7, 3)
+    assert sample("message_cache_lookups_total", result="hit") == hits + 1
+    assert sample("message_cache_lookups_total", result="miss") == misses + 1
+    assert sample("message_cache_evictions_total") == evictions + 1
+    assert sample("message_cache_bytes") == 8000
+    assert sample("message_cache_entries") == 2
+    cache.discard("INBOX", 7, [3])
+    assert sample("message_cache_bytes") == 4000
+
+
+def test_expunge_event_drops_entries(cache):
+    cache.put("INBOX", 7, 1, raw=b"a")
+    cache.put("INBOX", 7, 2, raw=b"b")
+    events.bus.publish(events.MailEvent("INBOX", "expunged", [1], 7))
+    assert cache.get("INBOX", 7, 1) is None
+    assert cache.get("INBOX", 7, 2) is not None
+    assert cache.total_bytes == message_cache.CachedMessage(b"b").size
+
+
+class FakeConnection:
+    def __init__(self):
+        self.mailbox = None
+        self.fetches = []
+
+    async def select(self, folder, readonly=False):
+        self.mailbox = MailboxState(folder, uidvalidity=7)
+
+    async def uid(self, cmd, uid, spec):
+        self.fetches.append(spec)
+        msg = EmailMessage()
+        msg["Subject"] = "Hello"
+        msg["Message-ID"] = "<1@x>"
+        msg.set_content("body text")
+        data = msg.as_bytes()
+        return IMAPResponse("OK", "", [parse_untagged(b"* 1 FETCH (UID 5 RFC822 {%d}\r\n%s)\r\n" % (len(data), data))])
+
+    async def logout(self):
+        pass
+
+
+def test_reply_context_decoded_from_cached_message(monkeypatch, cache):
+    conn = FakeConnection()
+
+    async def opener(*args, **kwargs):
+        return conn
+
+    monkeypatch.setattr(imap_pool, "open_connection", opener)
+
+    async def run():
+        await imap_client.fetch_message("5")
+        await imap_client.fetch_message("5")
+        first = await imap_client.fetch_reply_context("5")
+        second = await imap_client.fetch_reply_context("5")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert conn.fetches == ["(RFC822)"]
+    assert first is second
+    assert (first.subject, first.message_id, first.body.strip()) == ("Hello", "<1@x>", "body text")
+    assert cache.stats()["hits"] == 3
@@ -0,0 +1,115 @@
+# flake8: noqa
+import asyncio
+import os
+import subprocess
+import sys
+import textwrap
+
+import aiosmtplib
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(ROOT)
+
+from app.main import app  # noqa: E402
+from app.services import smtp_pool  # noqa: E402
+from app.services.imap_protocol import _metric_label  # noqa: E402
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_imap_commands_labelled_with_uid_subcommand():
+    assert _metric_label("UID", ("fetch", "1:5", "(FLAGS)")) == "UID FETCH"
+    assert _metric_label("select", ('"INBOX"',)) == "SELECT"
+
+
+class FailingLoginSMTP:
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.closed = False
+        self.instances.append(self)
+
+    async def connect(self):
+        pass
+
+    async def login(self, username, password):
+        raise aiosmtplib.SMTPAuthenticationError(535, "bad credentials")
+
+    def close(self):
+        self.closed = True
+
+
+def test_smtp_connect_and_auth_observed_separately(monkeypatch):
+    monkeypatch.setattr(smtp_pool.aiosmtplib, "SMTP", FailingLoginSMTP)
+    connects = sample("smtp_operation_seconds_count", operation="connect")
+    connect_errors = sample("smtp_operation_errors_total", operation="connect")
+    auth_errors = sample("smtp_operation_errors_total", operation="auth")
+
+    with pytest.raises(aiosmtplib.SMTPAuthenticationError):
+        asyncio.run(smtp_pool.open_connection("smtp.example.com", 587, "user", "wrong"))
+
+    assert sample("smtp_operation_seconds_count", operation="connect") == connects + 1
+    assert sample("smtp_operation_errors_total", operation="connect") == connect_errors
+    assert sample("smtp_operation_errors_total", operation="auth") == auth_errors + 1
+    assert FailingLoginSMTP.instances[-1].closed
+
+
+def test_request_latency_labelled_by_route_template():
+    with TestClient(app) as client:
+        client.get("/jobs/abc123")
+        client.get("/jobs/def456")
+        client.get("/no/such/path")
+        response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'route="/jobs/{job_id}"' in body
+    assert "abc123" not in body and "/no/such/path" not in body
+    assert 'route="unmatched",status="404"' in body
+
+
+def test_multiprocess_scrape_sums_workers(tmp_path):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path), "PYTHONPATH": ROOT}
+    worker = textwrap.dedent(
+        """
+        from app.services import metrics
+        metrics.SMTP_SECONDS.labels("data").observe(0.2)
+        metrics.OUTBOX_QUEUE_DEPTH.set(3)
+        """
+    )
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", worker], env=env, check=True)
+    scrape = textwrap.dedent(
+        """
+        from app.services import metrics
+        print(metrics.render()[0].decode())
+        """
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", scrape], env=env, check=True, capture_output=True, text=True
+    ).stdout
+
+    assert 'smtp_operation_seconds_count{operation="data"} 2.0' in output
+    # Both writers exited without mark_process_dead, so livesum still counts them.
+    assert "outbox_queue_depth 6.0" in output
+
+
+def test_metrics_require_the_api_key(monkeypatch):
+    monkeypatch.setenv("API_KEY", "secret")
+    with TestClient(app) as client:
+        assert client.get("/metrics").status_code == 403
+        response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
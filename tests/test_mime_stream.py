@@ -0,0 +1,75 @@
+# flake8: noqa
+import asyncio
+import base64
+import email
+import os
+import sys
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import mime_stream  # noqa: E402
+
+
+def make_root():
+    root = MIMEMultipart()
+    root["From"] = "me@example.com"
+    root["To"] = "a@example.com"
+    root["Bcc"] = "hidden@example.com"
+    root["Subject"] = "Report"
+    root.attach(MIMEText("<p>hi</p>", "html"))
+    return root
+
+
+def test_stream_round_trips_attachments(tmp_path):
+    on_disk = os.urandom(mime_stream.CHUNK_SIZE * 2 + 100)
+    path = tmp_path / "data.bin"
+    path.write_bytes(on_disk)
+    cached = os.urandom(mime_stream.ENCODED_CHUNK_SIZE)
+    encoded = tmp_path / "logo.b64"
+    encoded.write_bytes(base64.encodebytes(cached))
+
+    msg = mime_stream.StreamingMessage(make_root())
+    msg.attach_file("data.bin", "application", "octet-stream", str(path))
+    msg.attach_encoded("logo.png", "image", "png", str(encoded))
+
+    async def collect():
+        return [chunk async for chunk in msg.chunks()]
+
+    chunks = asyncio.run(collect())
+    raw = b"".join(chunks)
+    assert len(raw) == len(msg)
+    assert all(chunk.endswith(b"\r\n") for chunk in chunks)
+    assert max(len(chunk) for chunk in chunks) <= mime_stream.encoded_length(mime_stream.CHUNK_SIZE)
+    assert b"hidden@example.com" not in raw
+
+    parsed = email.message_from_bytes(raw)
+    parts = parsed.get_payload()
+    assert parsed["Subject"] == "Report"
+    assert parts[0].get_payload(decode=True) == b"<p>hi</p>"
+    assert parts[1].get_filename() == "data.bin"
+    assert parts[1].get_payload(decode=True) == on_disk
+    assert parts[2].get_content_type() == "image/png"
+    assert parts[2].get_payload(decode=True) == cached
+
+
+def test_encoded_length_matches_base64():
+    for size in (0, 1, 56, 57, 58, 114, 1000):
+        expected = len(base64.encodebytes(b"x" * size).replace(b"\n", b"\r\n"))
+        assert mime_stream.encoded_length(size) == expected
+
+
+def test_rendered_file_chunks_end_on_line_breaks(tmp_path):
+    line = b"x" * 70 + b"\r\n"
+    data = line * (mime_stream.CHUNK_SIZE // len(line) * 3) + b".tail"
+    path = tmp_path / "message.eml"
+    path.write_bytes(data)
+    rendered = mime_stream.RenderedFile(str(path))
+
+    async def collect():
+        return [chunk async for chunk in rendered.chunks()]
+
+    chunks = asyncio.run(collect())
+    assert len(chunks) > 2 and b"".join(chunks) == data and len(rendered) == len(data)
+    assert all(chunk.endswith(b"\r\n") for chunk in chunks[:-1])
@@ -0,0 +1,229 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import aiosmtplib
+import pytest
+from fastapi import HTTPException
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import outbox, spool  # noqa: E402
+from app import dependencies  # noqa: E402
+from app.models import SendEmailRequest  # noqa: E402
+
+
+def make_request(**kwargs):
+    return SendEmailRequest(to_addresses=["a@b.com"], subject="S", body="B", **kwargs)
+
+
+@asynccontextmanager
+async def fake_compose_email(to_addresses, subject, body, file_urls=None, headers=None):
+    yield subject
+
+
+def patch_send(monkeypatch, outcomes):
+    """Make ``smtp_send`` raise or return each of ``outcomes`` in turn."""
+    calls = []
+
+    async def fake_send(msg, journal=True):
+        calls.append(msg)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(dependencies, "compose_email", fake_compose_email)
+    monkeypatch.setattr(dependencies, "smtp_send", fake_send)
+    return calls
+
+
+async def wait_finished(job, timeout=2.0):
+    async def poll():
+        while not job.finished:
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_job_is_delivered(monkeypatch):
+    calls = patch_send(monkeypatch, ["2.0.0 queued as 1"])
+
+    async def run():
+        box = outbox.Outbox(workers=1)
+        await box.start()
+        job = await box.submit(make_request())
+        await wait_finished(job)
+        await box.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == outbox.SENT
+    assert job.attempts == 1
+    assert job.smtp_response == "2.0.0 queued as 1"
+    assert calls == ["S"]
+
+
+def test_transient_failure_is_retried(monkeypatch):
+    patch_send(
+        monkeypatch,
+        [aiosmtplib.SMTPServerDisconnected("gone"), aiosmtplib.SMTPResponseException(451, "try later"), "OK"],
+    )
+
+    async def run():
+        box = outbox.Outbox(workers=1, backoff_base=0.01)
+        await box.start()
+        job = await box.submit(make_request())
+        await wait_finished(job)
+        await box.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == outbox.SENT
+    assert job.attempts == 3
+    assert job.last_error is None
+
+
+def test_permanent_failure_is_not_retried(monkeypatch):
+    patch_send(monkeypatch, [aiosmtplib.SMTPRecipientsRefused([aiosmtplib.SMTPRecipientRefused(550, "no such user", "a@b.com")])])
+
+    async def run():
+        box = outbox.Outbox(workers=1, backoff_base=0.01)
+        await box.start()
+        job = await box.submit(make_request())
+        await wait_finished(job)
+        await box.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == outbox.FAILED
+    assert job.attempts == 1
+
+
+def test_gives_up_after_max_attempts(monkeypatch):
+    patch_send(monkeypatch, [HTTPException(status_code=500, detail="down")] * 3)
+
+    async def run():
+        box = outbox.Outbox(workers=1, max_attempts=3, backoff_base=0.01)
+        await box.start()
+        job = await box.submit(make_request())
+        await wait_finished(job)
+        await box.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == outbox.FAILED
+    assert job.attempts == 3
+    assert job.last_error == "down"
+
+
+def test_backoff_is_capped():
+    box = outbox.Outbox(backoff_base=2.0, backoff_max=10.0)
+    assert [box.backoff(n) for n in range(1, 5)] == [2.0, 4.0, 8.0, 10.0]
+
+
+def test_submit_rejects_when_full():
+    async def run():
+        box = outbox.Outbox(workers=0, queue_size=1)
+        await box.submit(make_request())
+        with pytest.raises(outbox.OutboxFull):
+            await box.submit(make_request())
+
+    asyncio.run(run())
+
+
+def test_finished_jobs_are_pruned():
+    async def run():
+        box = outbox.Outbox(workers=0, job_ttl=60)
+        old = await box.submit(make_request())
+        old.status = outbox.SENT
+        old.updated_at -= 120
+        fresh = await box.submit(make_request())
+        await box.submit(make_request())
+        return box, old, fresh
+
+    box, old, fresh = asyncio.run(run())
+    assert asyncio.run(box.get(old.id)) is None
+    assert asyncio.run(box.get(fresh.id)) is fresh
+
+
+async def wait_journaled(box, job_id, timeout=2.0):
+    async def poll():
+        while True:
+            job = await box.get(job_id)
+            if job.finished:
+                return job
+            await asyncio.sleep(0.01)
+
+    return await asyncio.wait_for(poll(), timeout)
+
+
+def test_journaled_job_status_is_shared(tmp_path, monkeypatch):
+    patch_send(monkeypatch, [])
+    path = str(tmp_path / "spool.db")
+
+    async def run():
+        box = outbox.Outbox(workers=0, journal=spool.Spool(path))
+        other = outbox.Outbox(workers=0, journal=spool.Spool(path))
+        job = await box.submit(make_request())
+        seen = await other.get(job.id)
+        await box.journal.close()
+        await other.journal.close()
+        return job, seen
+
+    job, seen = asyncio.run(run())
+    assert (seen.id, seen.status, seen.attempts) == (job.id, outbox.QUEUED, 0)
+    assert seen.request.subject == "S"
+
+
+def test_journaled_job_survives_a_dead_worker(tmp_path, monkeypatch):
+    calls = patch_send(monkeypatch, ["2.0.0 OK"])
+    path = str(tmp_path / "spool.db")
+
+    async def run():
+        crashed = outbox.Outbox(workers=0, journal=spool.Spool(path, lease_timeout=0))
+        job = await crashed.submit(make_request())
+        crashed.journal._db.close()
+
+        survivor = outbox.Outbox(workers=1, journal=spool.Spool(path), poll_interval=0.01)
+        await survivor.start()
+        finished = await wait_journaled(survivor, job.id)
+        await survivor.stop()
+        await survivor.journal.close()
+        return finished
+
+    job = asyncio.run(run())
+    assert (job.status, job.attempts, job.smtp_response) == (outbox.SENT, 1, "2.0.0 OK")
+    assert calls == ["S"]
+
+
+def test_journaled_retry_is_released_to_the_spool(tmp_path, monkeypatch):
+    patch_send(monkeypatch, [aiosmtplib.SMTPResponseException(451, "try later"), "OK"])
+    path = str(tmp_path / "spool.db")
+
+    async def run():
+        journal = spool.Spool(path)
+        box = outbox.Outbox(workers=1, backoff_base=0.2, journal=journal, poll_interval=0.01)
+        await box.start()
+        job = await box.submit(make_request())
+        while (await box.get(job.id)).attempts < 1 or (await box.get(job.id)).status == outbox.SENDING:
+            await asyncio.sleep(0.005)
+        retrying = await box.get(job.id)
+        finished = await wait_journaled(box, job.id)
+        await box.stop()
+        await journal.close()
+        return retrying, finished
+
+    retrying, finished = asyncio.run(run())
+    assert retrying.status == outbox.RETRYING
+    assert "try later" in retrying.last_error and retrying.next_attempt_at is not None
+    assert (finished.status, finished.attempts, finished.last_error) == (outbox.SENT, 2, None)
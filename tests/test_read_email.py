@@ -1,4 +1,6 @@
 # flake8: noqa
+import asyncio
+import json
 import os
 import sys
 from fastapi.testclient import TestClient
@@ -13,7 +15,7 @@ os.environ["ACCOUNT_IMAP_PORT"] = "993"
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from app.main import app  # noqa: E402
-from app.services import imap_client
+from app.services import header_index, imap_client
 from app.models import EmailSummary
 from app import dependencies
 from datetime import datetime
@@ -24,26 +26,93 @@ client = TestClient(app)
 
 
 def test_get_folders(monkeypatch):
-    async def mock_list_mailboxes():
-        return ["INBOX", "Archive"]
+    async def mock_list_folders(with_status=False):
+        return [imap_client.Folder("INBOX"), imap_client.Folder("Archive")]
 
-    monkeypatch.setattr(imap_client, "list_mailboxes", mock_list_mailboxes)
+    monkeypatch.setattr(imap_client, "list_folders", mock_list_folders)
     response = client.get("/folders")
     assert response.status_code == 200
     assert response.json() == ["INBOX", "Archive"]
 
 
+def test_get_folders_with_status(monkeypatch):
+    async def mock_list_folders(with_status=False):
+        assert with_status
+        return [imap_client.Folder("INBOX", "/", ["\\HasNoChildren"], 12, 3, 40)]
+
+    monkeypatch.setattr(imap_client, "list_folders", mock_list_folders)
+    response = client.get("/folders?status=true")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"name": "INBOX", "delimiter": "/", "flags": ["\\HasNoChildren"], "messages": 12, "unseen": 3, "uidnext": 40}
+    ]
+
+
 def test_get_emails(monkeypatch):
     sample = [EmailSummary(uid="1", subject="Test", from_="a@example.com", date=datetime.utcnow(), seen=False)]
 
-    async def mock_fetch_messages(folder: str, limit: int, unread_only: bool):
-        return sample
+    async def mock_fetch_page(folder, limit, unread_only, sort, cursor):
+        return imap_client.MessagePage(sample, "next")
 
-    monkeypatch.setattr(imap_client, "fetch_messages", mock_fetch_messages)
+    monkeypatch.setattr(imap_client, "fetch_page", mock_fetch_page)
     response = client.get("/emails?folder=INBOX&limit=1")
     assert response.status_code == 200
     data = response.json()
     assert data[0]["uid"] == "1"
+    assert response.headers["X-Next-Cursor"] == "next"
+
+
+def test_get_emails_passes_sort_and_cursor(monkeypatch):
+    calls = []
+
+    async def mock_fetch_page(folder, limit, unread_only, sort, cursor):
+        calls.append((folder, limit, unread_only, sort, cursor))
+        return imap_client.MessagePage([])
+
+    monkeypatch.setattr(imap_client, "fetch_page", mock_fetch_page)
+    response = client.get("/emails?sort=size&cursor=abc&limit=5")
+    assert response.status_code == 200
+    assert "X-Next-Cursor" not in response.headers
+    assert calls == [("INBOX", 5, False, "size", "abc")]
+    assert client.get("/emails?limit=0").status_code == 422
+    assert client.get("/emails?sort=subject").status_code == 422
+
+
+def test_get_emails_streams_ndjson(monkeypatch):
+    sample = EmailSummary(uid="1", subject="Test", from_="a@example.com", date=datetime(2024, 1, 2), seen=False)
+
+    async def mock_stream_page(folder, limit, unread_only, sort, cursor):
+        yield imap_client.MessagePage([], "next")
+        yield sample
+        yield sample
+
+    monkeypatch.setattr(imap_client, "stream_page", mock_stream_page)
+    response = client.get("/emails", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert response.headers["X-Next-Cursor"] == "next"
+    lines = response.text.splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0]) == {"uid": "1", "subject": "Test", "from": "a@example.com", "date": "2024-01-02T00:00:00", "seen": False}
+
+
+def test_get_emails_stream_invalid_cursor(monkeypatch):
+    async def mock_stream_page(folder, limit, unread_only, sort, cursor):
+        raise imap_client.InvalidCursor("Invalid cursor")
+        yield
+
+    monkeypatch.setattr(imap_client, "stream_page", mock_stream_page)
+    response = client.get("/emails?cursor=x", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 400
+
+
+def test_get_emails_invalid_cursor(monkeypatch):
+    async def fail(folder, limit, unread_only, sort, cursor):
+        raise imap_client.InvalidCursor("Invalid cursor")
+
+    monkeypatch.setattr(imap_client, "fetch_page", fail)
+    resp = client.get("/emails?cursor=bogus")
+    assert resp.status_code == 400
 
 
 def test_move_email(monkeypatch):
@@ -75,23 +144,94 @@ def test_delete_email(monkeypatch):
     assert response.json() == {"message": "Email deleted"}
 
 
-def test_forward_email(monkeypatch):
-    class DummyMessage:
-        def __init__(self):
-            self.headers = {"Message-ID": "<1@example.com>", "Subject": "Original"}
-        def get(self, key, default=""):
-            return self.headers.get(key, default)
+def test_search_emails(monkeypatch):
+    called = {}
+    sample = [EmailSummary(uid="4", subject="Report", from_="a@example.com", date=None, seen=True)]
+
+    async def mock_search(criteria, folder, limit, sort, cursor):
+        called.update({"criteria": criteria, "folder": folder, "limit": limit, "sort": sort})
+        return imap_client.MessagePage(sample, "next")
+
+    monkeypatch.setattr(imap_client, "search_page", mock_search)
+    response = client.post("/emails/search", json={"from": "a@example.com", "folder": "Archive", "limit": 5})
+    assert response.status_code == 200
+    assert response.headers["X-Next-Cursor"] == "next"
+    assert response.json()[0]["uid"] == "4"
+    assert called == {"criteria": ["FROM", '"a@example.com"'], "folder": "Archive", "limit": 5, "sort": "arrival"}
+
+
+def test_search_emails_invalid_cursor():
+    response = client.post("/emails/search", json={"cursor": "garbage"})
+    assert response.status_code == 400
+
+
+def test_fulltext_search_requires_index():
+    response = client.get("/emails/fulltext?q=report")
+    assert response.status_code == 503
+
+
+def test_fulltext_search(tmp_path, monkeypatch):
+    index = header_index.HeaderIndex(str(tmp_path / "index.sqlite3"), fulltext=True)
+    summary = EmailSummary(uid="7", subject="Report", from_="a@example.com", date=None, seen=False)
+
+    async def fill():
+        await index.save_state("INBOX", 1, 8, None)
+        await index.upsert("INBOX", 1, [header_index.IndexedMessage(summary)])
+        await index.add_bodies("INBOX", 1, [(7, "quarterly figures")])
+
+    asyncio.run(fill())
+    monkeypatch.setattr(header_index, "index", index)
+    try:
+        response = client.get("/emails/fulltext?q=figures")
+    finally:
+        index.close()
+    assert response.status_code == 200
+    [hit] = response.json()
+    assert (hit["uid"], hit["folder"], hit["from"]) == ("7", "INBOX", "a@example.com")
+    assert hit["score"] > 0
+
+
+def test_move_emails_bulk(monkeypatch):
+    called = {}
+
+    async def mock_move(uids, folder, source_folder):
+        called.update({"uids": uids, "folder": folder, "source": source_folder})
+        return len(uids)
+
+    monkeypatch.setattr(imap_client, "move_messages", mock_move)
+    response = client.post("/emails/move", json={"uids": [7, "1:3"], "folder": "Archive"})
+    assert response.status_code == 200
+    assert called == {"uids": [7, 1, 2, 3], "folder": "Archive", "source": "INBOX"}
+    assert response.json() == {"message": "4 emails moved"}
+
+
+def test_single_email_routes_reject_non_numeric_uid(monkeypatch):
+    async def fail(*args, **kwargs):
+        raise AssertionError("IMAP must not be reached")
 
+    monkeypatch.setattr(imap_client, "delete_message", fail)
+    monkeypatch.setattr(imap_client, "fetch_reply_context", fail)
+    response = client.delete("/emails/2%0D%0AA9%20DELETE%20INBOX?folder=INBOX")
+    assert response.status_code == 400
+    response = client.post("/emails/1%0D%0AA9%20DELETE%20INBOX/reply", json={"to_addresses": ["a@b.com"], "subject": "S", "body": "B"})
+    assert response.status_code == 400
+
+
+def test_delete_emails_bulk_rejects_bad_range():
+    response = client.post("/emails/delete", json={"uids": ["1:x"]})
+    assert response.status_code == 422
+
+
+def test_forward_email(monkeypatch):
     async def mock_fetch(uid):
-        return DummyMessage()
+        return imap_client.ReplyContext("Original", "<1@example.com>", None, "body")
 
     sent = {}
 
     async def mock_send(to, subject, body, file_urls, headers):
         sent.update({"to": to, "subject": subject, "body": body, "headers": headers, "files": file_urls})
 
-    monkeypatch.setattr(imap_client, "fetch_message", mock_fetch)
-    monkeypatch.setattr(imap_client, "extract_body", lambda msg: "body")
+    monkeypatch.setattr(imap_client, "fetch_reply_context", mock_fetch)
     monkeypatch.setattr(imap_client, "decode_header_value", lambda v: v)
     monkeypatch.setattr("app.routes.read_email.send_email", mock_send)
     response = client.post(
@@ -107,22 +247,15 @@ def test_forward_email(monkeypatch):
 
 
 def test_reply_email(monkeypatch):
-    class DummyMessage:
-        def __init__(self):
-            self.headers = {"Message-ID": "<2@example.com>", "Subject": "Orig"}
-        def get(self, key, default=""):
-            return self.headers.get(key, default)
-
     async def mock_fetch(uid):
-        return DummyMessage()
+        return imap_client.ReplyContext("Orig", "<2@example.com>", "<0@example.com>", "orig body")
 
     sent = {}
 
     async def mock_send(to, subject, body, file_urls, headers):
         sent.update({"to": to, "subject": subject, "body": body, "headers": headers, "files": file_urls})
 
-    monkeypatch.setattr(imap_client, "fetch_message", mock_fetch)
-    monkeypatch.setattr(imap_client, "extract_body", lambda msg: "orig body")
+    monkeypatch.setattr(imap_client, "fetch_reply_context", mock_fetch)
     monkeypatch.setattr(imap_client, "decode_header_value", lambda v: v)
     monkeypatch.setattr("app.routes.read_email.send_email", mock_send)
     response = client.post(
@@ -133,6 +266,7 @@ def test_reply_email(monkeypatch):
     assert sent["subject"] == "S"
     assert sent["body"] == "B"
     assert sent["headers"]["In-Reply-To"] == "<2@example.com>"
+    assert sent["headers"]["References"] == "<0@example.com> <2@example.com>"
     assert response.json() == {"message": "Email sent"}
 
 
@@ -152,17 +286,17 @@ def test_create_draft(monkeypatch):
     assert response.json() == {"message": "Draft stored"}
 
 def test_get_folders_error(monkeypatch):
-    async def fail():
+    async def fail(with_status=False):
         raise RuntimeError("boom")
-    monkeypatch.setattr(imap_client, "list_mailboxes", fail)
+    monkeypatch.setattr(imap_client, "list_folders", fail)
     resp = client.get("/folders")
     assert resp.status_code == 500
 
 
 def test_get_emails_error(monkeypatch):
-    async def fail(folder, limit, unread_only):
+    async def fail(folder, limit, unread_only, sort, cursor):
         raise RuntimeError("boom")
-    monkeypatch.setattr(imap_client, "fetch_messages", fail)
+    monkeypatch.setattr(imap_client, "fetch_page", fail)
     resp = client.get("/emails")
     assert resp.status_code == 500
 
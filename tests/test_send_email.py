@@ -15,6 +15,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from app.main import app  # noqa: E402
 from app import dependencies
+from app.services import outbox
 
 dependencies.settings = dependencies.Config()
 client = TestClient(app)
@@ -71,3 +72,103 @@ def test_send_email_missing_settings(monkeypatch):
         json={"to_addresses": ["a@b.com"], "subject": "S", "body": "B", "file_url": None},
     )
     assert resp.status_code == 500
+
+
+def test_send_batch_reports_partial_failure(monkeypatch):
+    import aiosmtplib
+
+    async def mock_send_batch(requests):
+        assert [r.subject for r in requests] == ["A", "B", "C"]
+        return [None, HTTPException(status_code=400, detail="bad file"), aiosmtplib.SMTPDataError(554, "rejected")]
+
+    monkeypatch.setattr("app.routes.send_email.send_batch", mock_send_batch)
+    message = {"to_addresses": ["a@b.com"], "body": "B"}
+    resp = client.post(
+        "/batch",
+        json={"messages": [dict(message, subject=s) for s in ("A", "B", "C")]},
+    )
+    assert resp.status_code == 200
+    data = resp.json()
+    assert (data["sent"], data["failed"]) == (1, 2)
+    assert [(r["index"], r["status"], r["status_code"]) for r in data["results"]] == [
+        (0, "sent", 201),
+        (1, "failed", 400),
+        (2, "failed", 500),
+    ]
+    assert data["results"][1]["error"] == "bad file"
+
+
+def test_send_batch_rejects_empty_batch():
+    resp = client.post("/batch", json={"messages": []})
+    assert resp.status_code == 422
+
+
+class DummyOutbox:
+    def __init__(self, full=False):
+        self.full = full
+        self.jobs = {}
+
+    async def submit(self, request):
+        if self.full:
+            raise outbox.OutboxFull("Outbound queue is full")
+        job = outbox.Job(request)
+        self.jobs[job.id] = job
+        return job
+
+    async def get(self, job_id):
+        return self.jobs.get(job_id)
+
+
+def test_send_email_async_returns_job(monkeypatch):
+    dummy = DummyOutbox()
+    monkeypatch.setattr(outbox, "outbox", dummy)
+    resp = client.post(
+        "/?async=true",
+        json={"to_addresses": ["a@b.com"], "subject": "S", "body": "B"},
+    )
+    assert resp.status_code == 202
+    job_id = resp.json()["id"]
+    assert resp.headers["location"] == f"/jobs/{job_id}"
+    assert resp.json()["status"] == "queued"
+
+    dummy.jobs[job_id].status = "sent"
+    dummy.jobs[job_id].attempts = 1
+    dummy.jobs[job_id].smtp_response = "2.0.0 OK"
+    status = client.get(f"/jobs/{job_id}").json()
+    assert status["status"] == "sent"
+    assert status["attempts"] == 1
+    assert status["smtp_response"] == "2.0.0 OK"
+
+
+def test_send_email_prefer_respond_async(monkeypatch):
+    monkeypatch.setattr(outbox, "outbox", DummyOutbox())
+    resp = client.post(
+        "/",
+        json={"to_addresses": ["a@b.com"], "subject": "S", "body": "B"},
+        headers={"Prefer": "respond-async"},
+    )
+    assert resp.status_code == 202
+
+
+def test_send_email_async_rejects_bad_attachment(monkeypatch):
+    dummy = DummyOutbox()
+    monkeypatch.setattr(outbox, "outbox", dummy)
+    resp = client.post(
+        "/?async=true",
+        json={"to_addresses": ["a@b.com"], "subject": "S", "body": "B", "file_url": ["http://x/f.exe"]},
+    )
+    assert resp.status_code == 400
+    assert dummy.jobs == {}
+
+
+def test_send_email_async_unavailable(monkeypatch):
+    monkeypatch.setattr(outbox, "outbox", None)
+    body = {"to_addresses": ["a@b.com"], "subject": "S", "body": "B"}
+    assert client.post("/?async=true", json=body).status_code == 503
+    monkeypatch.setattr(outbox, "outbox", DummyOutbox(full=True))
+    assert client.post("/?async=true", json=body).status_code == 503
+
+
+def test_get_unknown_job(monkeypatch):
+    monkeypatch.setattr(outbox, "outbox", DummyOutbox())
+    assert client.get("/jobs/missing").status_code == 404
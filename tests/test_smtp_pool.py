@@ -0,0 +1,484 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+import email
+from email.message import EmailMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import aiosmtplib
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import mime_stream, smtp_pool  # noqa: E402
+from app import dependencies  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def setup_settings():
+    dependencies.settings = dependencies.Config()
+    yield
+    dependencies.settings = None
+    smtp_pool.pool = None
+
+
+class DummySMTP:
+    def __init__(self):
+        self.is_connected = True
+        self.sent = []
+        self.resets = 0
+        self.quit_called = False
+        self.fail_with = None
+
+    is_ehlo_or_helo_needed = False
+
+    def supports_extension(self, name):
+        return False
+
+    async def send_message(self, message):
+        if self.fail_with is not None:
+            exc, self.fail_with = self.fail_with, None
+            raise exc
+        self.sent.append(message["Subject"])
+        return {}, "OK"
+
+    async def rset(self):
+        self.resets += 1
+        if not self.is_connected:
+            raise aiosmtplib.SMTPServerDisconnected("gone")
+
+    async def quit(self):
+        self.quit_called = True
+        self.is_connected = False
+
+    def close(self):
+        self.is_connected = False
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    sessions = []
+
+    async def fake_open(*args, **kwargs):
+        smtp = DummySMTP()
+        sessions.append(smtp)
+        return smtp
+
+    monkeypatch.setattr(smtp_pool, "open_connection", fake_open)
+    return sessions
+
+
+def make_pool(**kwargs):
+    return smtp_pool.SMTPPool("smtp.example.com", 587, "u", "p", **kwargs)
+
+
+def message(subject="Hi"):
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    return msg
+
+
+def test_pool_reuses_session_with_rset(opened):
+    async def run():
+        pool = make_pool()
+        for i in range(3):
+            await pool.send(message(f"m{i}"))
+        await pool.close()
+
+    asyncio.run(run())
+    assert len(opened) == 1
+    assert opened[0].sent == ["m0", "m1", "m2"]
+    assert opened[0].resets == 2
+    assert opened[0].quit_called
+
+
+def test_pool_retries_on_disconnect_and_421(opened):
+    async def run():
+        pool = make_pool()
+        await pool.send(message("first"))
+        opened[0].fail_with = aiosmtplib.SMTPServerDisconnected("dropped")
+        await pool.send(message("second"))
+        opened[1].fail_with = aiosmtplib.SMTPResponseException(421, "closing")
+        await pool.send(message("third"))
+
+    asyncio.run(run())
+    assert [s.sent for s in opened] == [["first"], ["second"], ["third"]]
+
+
+def test_pool_does_not_retry_rejected_message(opened):
+    async def run():
+        pool = make_pool()
+        await pool.send(message("first"))
+        opened[0].fail_with = aiosmtplib.SMTPRecipientsRefused([])
+        with pytest.raises(aiosmtplib.SMTPRecipientsRefused):
+            await pool.send(message("second"))
+        await pool.send(message("third"))
+
+    asyncio.run(run())
+    assert len(opened) == 1
+    assert opened[0].sent == ["first", "third"]
+
+
+def test_pool_retires_sessions_by_message_count_and_lifetime(opened, monkeypatch):
+    async def run():
+        pool = make_pool(max_messages=2)
+        for i in range(3):
+            await pool.send(message(f"m{i}"))
+        pool.max_lifetime = 0
+        await pool.send(message("late"))
+
+    asyncio.run(run())
+    assert [s.sent for s in opened] == [["m0", "m1"], ["m2"], ["late"]]
+    assert opened[0].quit_called and opened[1].quit_called
+
+
+def test_pool_close_waits_for_inflight_send(opened):
+    async def run():
+        pool = make_pool()
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow(msg):
+            started.set()
+            await release.wait()
+            return {}, "OK"
+
+        async def send():
+            async with pool.connection() as smtp:
+                smtp.send_message = slow
+                await smtp.send_message(message())
+
+        task = asyncio.create_task(send())
+        await started.wait()
+        closing = asyncio.create_task(pool.close())
+        await asyncio.sleep(0.01)
+        assert not closing.done()
+        release.set()
+        await asyncio.gather(task, closing)
+        with pytest.raises(RuntimeError):
+            await pool.send(message())
+
+    asyncio.run(run())
+    assert opened[0].quit_called
+
+
+def test_send_email_uses_pool(opened, monkeypatch):
+    async def fake_send_stream(smtp, msg, sender=None, recipients=None):
+        smtp.sent.append(msg.headers["Subject"])
+        return {}, "OK"
+
+    monkeypatch.setattr(smtp_pool, "send_stream", fake_send_stream)
+    smtp_pool.pool = make_pool()
+    asyncio.run(dependencies.send_email(["a@b.com"], "Pooled", "Body"))
+    assert opened[0].sent == ["Pooled"]
+
+
+class FakeSMTPServer:
+    """Minimal ESMTP server recording each chunk it reads."""
+
+    def __init__(self, extensions=("PIPELINING", "SIZE 1000000")):
+        self.extensions = extensions
+        self.chunks = []
+        self.messages = []
+        self.drop_next = False  # hang up instead of replying to the next message
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        writer.write(b"220 fake ESMTP\r\n")
+        buffer = b""
+        in_data = False
+        bdat = None  # (bytes still expected, is LAST)
+        received = b""
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            self.chunks.append(chunk)
+            buffer += chunk
+            while True:
+                if bdat is not None:
+                    size, last = bdat
+                    if len(buffer) < size:
+                        break
+                    received += buffer[:size]
+                    buffer = buffer[size:]
+                    bdat = None
+                    if last:
+                        self.messages.append(received)
+                        received = b""
+                        if self.drop_next:
+                            self.drop_next = False
+                            writer.close()
+                            return
+                    writer.write(b"250 queued\r\n" if last else b"250 chunk ok\r\n")
+                    continue
+                if in_data:
+                    end = buffer.find(b"\r\n.\r\n")
+                    if end < 0:
+                        break
+                    self.messages.append(buffer[:end])
+                    buffer = buffer[end + 5:]
+                    in_data = False
+                    if self.drop_next:
+                        self.drop_next = False
+                        writer.close()
+                        return
+                    writer.write(b"250 queued\r\n")
+                    continue
+                line, sep, rest = buffer.partition(b"\r\n")
+                if not sep:
+                    break
+                buffer = rest
+                command = line.upper()
+                if command.startswith(b"EHLO"):
+                    lines = [b"fake"] + [ext.encode() for ext in self.extensions]
+                    writer.write(b"".join(b"250-" + l + b"\r\n" for l in lines[:-1]) + b"250 " + lines[-1] + b"\r\n")
+                elif command.startswith(b"RCPT") and b"BAD@" in command:
+                    writer.write(b"550 no such user\r\n")
+                elif command.startswith(b"BDAT"):
+                    parts = command.split()
+                    bdat = (int(parts[1]), len(parts) > 2 and parts[2] == b"LAST")
+                elif command == b"DATA":
+                    writer.write(b"354 go ahead\r\n")
+                    in_data = True
+                elif command == b"QUIT":
+                    writer.write(b"221 bye\r\n")
+                else:
+                    writer.write(b"250 ok\r\n")
+            await writer.drain()
+        writer.close()
+
+
+def test_send_message_pipelines_envelope():
+    async def run():
+        async with FakeSMTPServer() as server:
+            smtp = aiosmtplib.SMTP(hostname="127.0.0.1", port=server.port, start_tls=False)
+            await smtp.connect()
+            msg = message()
+            msg["From"] = "me@example.com"
+            msg["To"] = "a@example.com, bad@example.com"
+            msg.set_content(".leading dot\n")
+            refused, reply = await smtp_pool.send_message(smtp, msg)
+            await smtp.quit()
+            return server, refused, reply
+
+    server, refused, reply = asyncio.run(run())
+    assert reply == "queued"
+    assert list(refused) == ["bad@example.com"]
+    envelope = next(chunk for chunk in server.chunks if chunk.startswith(b"MAIL"))
+    assert envelope.count(b"\r\n") == 4 and envelope.endswith(b"DATA\r\n")
+    assert b"SIZE=" in envelope
+    assert b"\r\n..leading dot" in server.messages[0]
+
+
+def test_send_many_reports_each_message(opened):
+    async def run():
+        pool = make_pool(size=2)
+        messages = [message(f"m{i}") for i in range(5)]
+        original = DummySMTP.send_message
+        dropped = []
+
+        async def flaky(self, msg):
+            if msg["Subject"] == "m2":
+                raise aiosmtplib.SMTPDataError(554, "rejected")
+            if msg["Subject"] == "m3" and not dropped:
+                dropped.append(self)
+                raise aiosmtplib.SMTPServerDisconnected("dropped")
+            return await original(self, msg)
+
+        DummySMTP.send_message = flaky
+        try:
+            return await pool.send_many(messages, concurrency=2)
+        finally:
+            DummySMTP.send_message = original
+
+    results = asyncio.run(run())
+    assert [type(r).__name__ if r else None for r in results] == [None, None, "SMTPDataError", None, None]
+    assert sorted(s for smtp in opened for s in smtp.sent) == ["m0", "m1", "m3", "m4"]
+    assert opened[0].quit_called
+
+
+def test_send_many_reconnects_when_rset_fails(opened):
+    async def run():
+        original_send, original_rset = DummySMTP.send_message, DummySMTP.rset
+
+        async def rejecting(self, msg):
+            if msg["Subject"] == "m0":
+                raise aiosmtplib.SMTPDataError(554, "rejected")
+            return await original_send(self, msg)
+
+        async def failing_rset(self):
+            raise aiosmtplib.SMTPResponseException(500, "confused")
+
+        DummySMTP.send_message, DummySMTP.rset = rejecting, failing_rset
+        try:
+            return await make_pool(size=1).send_many([message("m0"), message("m1"), message("m2")])
+        finally:
+            DummySMTP.send_message, DummySMTP.rset = original_send, original_rset
+
+    results = asyncio.run(run())
+    assert isinstance(results[0], aiosmtplib.SMTPDataError) and results[1:] == [None, None]
+    assert len(opened) == 2 and opened[1].sent == ["m1", "m2"]
+
+
+def connect_without_auth(monkeypatch, server):
+    async def fake_open(*args, **kwargs):
+        smtp = aiosmtplib.SMTP(hostname="127.0.0.1", port=server.port, start_tls=False)
+        await smtp.connect()
+        return smtp
+
+    monkeypatch.setattr(smtp_pool, "open_connection", fake_open)
+
+
+@pytest.mark.parametrize("extensions", [("PIPELINING",), ()])
+def test_pool_does_not_resend_after_end_of_data(monkeypatch, extensions):
+    async def run():
+        async with FakeSMTPServer(extensions) as server:
+            connect_without_auth(monkeypatch, server)
+            pool = make_pool(size=1)
+            msg = message()
+            msg["From"] = "me@example.com"
+            msg["To"] = "a@example.com"
+            server.drop_next = True
+            with pytest.raises(aiosmtplib.SMTPServerDisconnected):
+                await pool.send(msg)
+            server.drop_next = True
+            results = await pool.send_many([msg, msg])
+            await pool.close()
+            return server, results
+
+    server, results = asyncio.run(run())
+    assert len(server.messages) == 3
+    assert isinstance(results[0], aiosmtplib.SMTPServerDisconnected) and results[1] is None
+
+
+def test_pool_does_not_resend_after_last_bdat_chunk(monkeypatch, tmp_path):
+    async def run():
+        async with FakeSMTPServer(("PIPELINING", "CHUNKING")) as server:
+            connect_without_auth(monkeypatch, server)
+            pool = make_pool(size=1)
+            server.drop_next = True
+            with pytest.raises(aiosmtplib.SMTPServerDisconnected):
+                await pool.send_stream(streaming_message(tmp_path, b"x" * 1000))
+            await pool.send_stream(streaming_message(tmp_path, b"y" * 1000))
+            await pool.close()
+            return server
+
+    server = asyncio.run(run())
+    assert len(server.messages) == 2
+
+
+def test_send_many_fails_remaining_when_connect_fails(monkeypatch):
+    async def refuse(*args, **kwargs):
+        raise aiosmtplib.SMTPAuthenticationError(535, "bad credentials")
+
+    monkeypatch.setattr(smtp_pool, "open_connection", refuse)
+    results = asyncio.run(make_pool().send_many([message(), message()]))
+    assert all(isinstance(r, aiosmtplib.SMTPAuthenticationError) for r in results)
+
+
+def test_send_many_prepares_each_message_just_before_sending(opened):
+    events = []
+
+    async def run():
+        original = DummySMTP.send_message
+
+        async def logged(self, msg):
+            events.append(("send", msg["Subject"]))
+            return await original(self, msg)
+
+        async def prepare(index, subject):
+            events.append(("build", subject))
+            if subject == "bad":
+                raise ValueError("attachment missing")
+            return message(subject)
+
+        DummySMTP.send_message = logged
+        try:
+            return await make_pool(size=1).send_many(["m0", "bad", "m1"], prepare=prepare)
+        finally:
+            DummySMTP.send_message = original
+
+    results = asyncio.run(run())
+    assert events == [("build", "m0"), ("send", "m0"), ("build", "bad"), ("build", "m1"), ("send", "m1")]
+    assert results[0] is None and isinstance(results[1], ValueError) and results[2] is None
+    assert opened[0].resets == 0
+
+
+def test_send_batch_uses_temporary_pool(opened):
+    requests = [
+        dependencies.SendEmailRequest(to_addresses=["a@b.com"], subject="ok", body="Body"),
+        dependencies.SendEmailRequest(to_addresses=["a@b.com"], subject="bad", body="Body", file_url=["http://x/f.exe"]),
+    ]
+    results = asyncio.run(dependencies.send_batch(requests))
+    assert results[0] is None
+    assert results[1].status_code == 400
+    assert opened[0].sent == ["ok"] and opened[0].quit_called
+
+
+def streaming_message(tmp_path, payload):
+    path = tmp_path / "report.pdf"
+    path.write_bytes(payload)
+    root = MIMEMultipart()
+    root["From"] = "me@example.com"
+    root["To"] = "a@example.com"
+    root["Subject"] = "Streamed"
+    root.attach(MIMEText("<p>hi</p>", "html"))
+    msg = mime_stream.StreamingMessage(root)
+    msg.attach_file("report.pdf", "application", "pdf", str(path))
+    return msg
+
+
+def send_streamed(msg, extensions):
+    async def run():
+        async with FakeSMTPServer(extensions) as server:
+            smtp = aiosmtplib.SMTP(hostname="127.0.0.1", port=server.port, start_tls=False)
+            await smtp.connect()
+            _, reply = await smtp_pool.send_stream(smtp, msg)
+            await smtp.quit()
+            return server, reply
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("extensions", [("PIPELINING", "SIZE 1000000"), ("SIZE 1000000",)])
+def test_send_stream_over_data(tmp_path, extensions):
+    payload = os.urandom(300_000)
+    msg = streaming_message(tmp_path, payload)
+    server, reply = send_streamed(msg, extensions)
+    assert reply == "queued"
+    # The fake server strips the CRLF that precedes the terminating dot.
+    assert len(server.messages[0]) + 2 == len(msg)
+    assert f"SIZE={len(msg)}".encode() in b"".join(server.chunks)
+    parsed = email.message_from_bytes(server.messages[0])
+    assert parsed.get_payload()[1].get_payload(decode=True) == payload
+
+
+def test_send_stream_over_bdat(tmp_path):
+    payload = os.urandom(300_000)
+    msg = streaming_message(tmp_path, payload)
+    server, reply = send_streamed(msg, ("PIPELINING", "CHUNKING", "SIZE 1000000"))
+    sent = b"".join(server.chunks)
+    assert reply == "queued"
+    assert b"\r\nDATA\r\n" not in sent
+    assert sent.count(b"BDAT ") > 1 and b" LAST\r\n" in sent
+    parsed = email.message_from_bytes(server.messages[0])
+    assert parsed["Subject"] == "Streamed"
+    assert parsed.get_payload()[1].get_payload(decode=True) == payload
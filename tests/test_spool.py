@@ -0,0 +1,272 @@
+# flake8: noqa
+import asyncio
+import os
+import sys
+from email.message import EmailMessage
+
+import aiosmtplib
+import pytest
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import smtp_pool, spool  # noqa: E402
+from app import dependencies  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def reset_globals():
+    yield
+    smtp_pool.pool = None
+    spool.spool = None
+
+
+def make_message(subject="Hello"):
+    msg = EmailMessage()
+    msg["From"] = "user@example.com"
+    msg["To"] = "a@b.com, c@d.com"
+    msg["Subject"] = subject
+    msg.set_content("Body")
+    return msg
+
+
+class DummyPool:
+    def __init__(self, fail_with=None):
+        self.sent = []
+        self.fail_with = fail_with
+
+    async def send(self, message, retry=True):
+        self.sent.append(message["Subject"])
+        return {}, "2.0.0 OK"
+
+    async def send_raw(self, sender, recipients, data, retry=True):
+        if self.fail_with is not None:
+            raise self.fail_with
+        self.sent.append((sender, recipients, data))
+        return {}, "2.0.0 OK"
+
+
+def count_rows(path, status):
+    import sqlite3
+
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("SELECT COUNT(*) FROM spool WHERE status = ?", (status,)).fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_burst_of_adds_shares_one_commit(tmp_path, monkeypatch):
+    path = str(tmp_path / "spool.db")
+    commits = []
+
+    async def run():
+        journal = spool.Spool(path, commit_interval=0.01)
+        original = journal._call
+
+        async def counting_call(func, *args):
+            commits.append(func.__name__)
+            return await original(func, *args)
+
+        monkeypatch.setattr(journal, "_call", counting_call)
+        ids = await asyncio.gather(*(journal.add(make_message(str(i))) for i in range(50)))
+        await journal.close()
+        return ids
+
+    ids = asyncio.run(run())
+    assert len(set(ids)) == 50
+    assert commits == ["commit"]
+    assert count_rows(path, spool.PENDING) == 50
+
+
+def test_replays_message_left_by_dead_process(tmp_path):
+    path = str(tmp_path / "spool.db")
+    pool = DummyPool()
+
+    async def run():
+        crashed = spool.Spool(path, lease_timeout=0)
+        entry_id = await crashed.add(make_message())
+        crashed._db.close()
+
+        smtp_pool.pool = pool
+        survivor = spool.Spool(path)
+        assert await survivor.replay() == 1
+        assert await survivor.replay() == 0
+        status = await survivor.status(entry_id)
+        await survivor.close()
+        return status
+
+    status = asyncio.run(run())
+    assert status == ("sent", 2, None, "2.0.0 OK")
+    sender, recipients, data = pool.sent[0]
+    assert sender == "user@example.com"
+    assert recipients == ["a@b.com", "c@d.com"]
+    assert b"Subject: Hello" in data
+
+
+def test_live_lease_is_not_replayed(tmp_path):
+    path = str(tmp_path / "spool.db")
+
+    async def run():
+        sender = spool.Spool(path, lease_timeout=300)
+        await sender.add(make_message())
+        other = spool.Spool(path)
+        claimed = await other.claim()
+        await other.close()
+        await sender.close()
+        return claimed
+
+    assert asyncio.run(run()) == []
+
+
+def test_replay_failures(tmp_path):
+    path = str(tmp_path / "spool.db")
+
+    async def run():
+        journal = spool.Spool(path, lease_timeout=0)
+        temporary = await journal.add(make_message("temporary"))
+        smtp_pool.pool = DummyPool(fail_with=aiosmtplib.SMTPResponseException(451, "later"))
+        await journal.replay()
+        retried = await journal.status(temporary)
+
+        permanent = await journal.add(make_message("permanent"))
+        journal.lease_timeout = 0
+        smtp_pool.pool = DummyPool(fail_with=aiosmtplib.SMTPResponseException(550, "no"))
+        await asyncio.sleep(0.01)
+        await journal.replay()
+        rejected = await journal.status(permanent)
+        await journal.close()
+        return retried, rejected
+
+    retried, rejected = asyncio.run(run())
+    assert retried[0] == spool.PENDING
+    assert "later" in retried[2]
+    assert rejected[0] == spool.FAILED
+
+
+def test_smtp_send_journals_message(tmp_path):
+    path = str(tmp_path / "spool.db")
+    dependencies.settings = dependencies.Config()
+
+    async def run():
+        smtp_pool.pool = DummyPool()
+        spool.spool = spool.Spool(path)
+        reply = await dependencies.smtp_send(make_message())
+        await spool.spool.close()
+        return reply
+
+    try:
+        assert asyncio.run(run()) == "2.0.0 OK"
+    finally:
+        dependencies.settings = None
+    assert count_rows(path, spool.SENT) == 1
+    assert count_rows(path, spool.PENDING) == 0
+
+
+def test_smtp_send_marks_reported_failure_failed(tmp_path):
+    path = str(tmp_path / "spool.db")
+    dependencies.settings = dependencies.Config()
+
+    async def run():
+        smtp_pool.pool = DummyPool()
+
+        async def refuse(message):
+            raise aiosmtplib.SMTPResponseException(451, "later")
+
+        smtp_pool.pool.send = refuse
+        spool.spool = spool.Spool(path)
+        with pytest.raises(aiosmtplib.SMTPResponseException):
+            await dependencies.smtp_send(make_message())
+        await spool.spool.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        dependencies.settings = None
+    # The caller got the error and may retry, so the spool must not resend it.
+    assert count_rows(path, spool.PENDING) == 0
+    assert count_rows(path, spool.FAILED) == 1
+
+
+class BatchPool:
+    async def send_many(self, messages, concurrency=None, prepare=None):
+        for i, message in enumerate(messages):
+            await prepare(i, message)
+        return [None, aiosmtplib.SMTPResponseException(451, "later")]
+
+
+def test_send_batch_marks_reported_failures_failed(tmp_path):
+    from app.models import SendEmailRequest
+
+    path = str(tmp_path / "spool.db")
+    dependencies.settings = dependencies.Config()
+    requests = [SendEmailRequest(to_addresses=["a@b.com"], subject=f"S{i}", body="B") for i in range(2)]
+
+    async def run():
+        smtp_pool.pool = BatchPool()
+        spool.spool = spool.Spool(path)
+        results = await dependencies.send_batch(requests)
+        await spool.spool.close()
+        return results
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        dependencies.settings = None
+    assert results[0] is None and results[1] is not None
+    assert count_rows(path, spool.SENT) == 1
+    assert count_rows(path, spool.FAILED) == 1
+    assert count_rows(path, spool.PENDING) == 0
+
+
+class StreamPool:
+    def __init__(self):
+        self.sent = []
+
+    async def send_stream(self, message, retry=True, sender=None, recipients=None):
+        self.sent.append((sender, recipients, b"".join([chunk async for chunk in message.chunks()])))
+        return {}, "2.0.0 OK"
+
+
+def test_streaming_message_is_spooled_to_a_file_and_replayed(tmp_path, monkeypatch):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    from app.services import mime_stream
+
+    attachment = tmp_path / "data.bin"
+    attachment.write_bytes(os.urandom(300_000))
+    root = MIMEMultipart()
+    root["From"] = "user@example.com"
+    root["To"] = "a@b.com"
+    root["Bcc"] = "hidden@b.com"
+    root.attach(MIMEText("hi"))
+    msg = mime_stream.StreamingMessage(root)
+    msg.attach_file("data.bin", "application", "octet-stream", str(attachment))
+    path = str(tmp_path / "spool.db")
+
+    async def run():
+        expected = await msg.read()
+
+        async def no_read():
+            raise AssertionError("the spool must not render the message into memory")
+
+        monkeypatch.setattr(msg, "read", no_read)
+        journal = spool.Spool(path, lease_timeout=0)
+        entry_id = await journal.add(msg)
+        files = os.listdir(journal.message_dir)
+        smtp_pool.pool = StreamPool()
+        await journal.replay()
+        await journal.close()
+        return expected, entry_id, files, os.listdir(journal.message_dir)
+
+    expected, entry_id, before, after = asyncio.run(run())
+    assert before == [f"{entry_id}.eml"] and after == []
+    assert smtp_pool.pool.sent == [("user@example.com", ["a@b.com", "hidden@b.com"], expected)]
+    assert count_rows(path, spool.SENT) == 1
@@ -0,0 +1,111 @@
+# flake8: noqa
+import asyncio
+import json
+import logging
+import os
+import sys
+from email.message import EmailMessage
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+os.environ["ACCOUNT_EMAIL"] = "user@example.com"
+os.environ["ACCOUNT_PASSWORD"] = "password"
+os.environ["ACCOUNT_SMTP_SERVER"] = "smtp.example.com"
+os.environ["ACCOUNT_SMTP_PORT"] = "587"
+os.environ["ACCOUNT_IMAP_SERVER"] = "imap.example.com"
+os.environ["ACCOUNT_IMAP_PORT"] = "993"
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import dependencies  # noqa: E402
+from app.services import imap_client, imap_pool, tracing  # noqa: E402
+from app.services.imap_protocol import IMAPResponse, parse_untagged  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    previous = dependencies.settings
+    dependencies.settings = dependencies.Config()
+    monkeypatch.setattr(tracing, "slow_request_threshold", 0.0)
+    monkeypatch.setattr(tracing, "server_timing", True)
+    yield
+    dependencies.settings = previous
+
+
+class FakeConnection:
+    mailbox = None
+
+    async def select(self, folder, readonly=False):
+        pass
+
+    async def uid(self, cmd, uid, spec):
+        with tracing.span("imap.uid-fetch"):
+            await asyncio.sleep(0.01)
+        msg = EmailMessage()
+        msg["Subject"] = "Hello"
+        data = msg.as_bytes()
+        return IMAPResponse("OK", "", [parse_untagged(b"* 1 FETCH (UID 5 RFC822 {%d}\r\n%s)\r\n" % (len(data), data))])
+
+    async def logout(self):
+        pass
+
+
+def make_app():
+    app = FastAPI()
+    app.add_middleware(tracing.TimingMiddleware)
+
+    @app.get("/messages/{uid}")
+    async def read(uid: str):
+        async def download(name):
+            with tracing.span("download", url=name):
+                await asyncio.sleep(0.01)
+
+        await imap_client.fetch_message(uid)
+        await asyncio.gather(download("a"), download("b"))
+        return {"ok": True}
+
+    return app
+
+
+def test_span_outside_request_records_nothing():
+    with tracing.span("imap.select") as span:
+        tracing.annotate(folder="INBOX")
+    assert span is None
+
+
+def test_server_timing_header_sums_spans_by_name(monkeypatch):
+    async def opener(*args, **kwargs):
+        return FakeConnection()
+
+    monkeypatch.setattr(imap_pool, "open_connection", opener)
+    with TestClient(make_app()) as client:
+        response = client.get("/messages/5")
+
+    entries = dict(entry.split(";dur=") for entry in response.headers["server-timing"].split(", "))
+    assert list(entries) == ["fetch_message", "imap.uid-fetch", "download", "total"]
+    assert float(entries["download"]) >= 20
+    assert float(entries["total"]) >= float(entries["fetch_message"]) >= float(entries["imap.uid-fetch"])
+
+
+def test_slow_request_logs_span_tree(monkeypatch, caplog):
+    async def opener(*args, **kwargs):
+        return FakeConnection()
+
+    monkeypatch.setattr(imap_pool, "open_connection", opener)
+    monkeypatch.setattr(tracing, "server_timing", False)
+    monkeypatch.setattr(tracing, "slow_request_threshold", 0.001)
+    with caplog.at_level(logging.WARNING, logger=tracing.logger.name):
+        with TestClient(make_app()) as client:
+            response = client.get("/messages/5")
+
+    assert "server-timing" not in response.headers
+    entry = json.loads(caplog.records[-1].getMessage())
+    assert (entry["event"], entry["route"], entry["status"]) == ("slow_request", "/messages/{uid}", 200)
+    fetch, first, second = entry["spans"]
+    assert fetch["name"] == "fetch_message" and fetch["attrs"] == {"folder": "INBOX"}
+    assert [child["name"] for child in fetch["children"]] == ["imap.uid-fetch"]
+    assert [first["attrs"]["url"], second["attrs"]["url"]] == ["a", "b"]
+    # The downloads ran concurrently, so the second starts before the first ends.
+    assert second["start_ms"] < first["start_ms"] + first["duration_ms"]